@@ -1,4 +1,11 @@
 # __init__.py
-from .dreamchain import DreamChainNode, DreamChain
+from .dreamchain import DreamChainNode, DreamChain, ChainSnapshot
+from .miner import Miner
+from .checkpoint import Checkpoint
+from .archive import BodyArchive
+from .blocks import Block, BlockHeader, Transaction
+from .admission import AdmissionControl
+from .consensus import ProofOfWork, ProofOfAuthority
+from .lightclient import BloomFilter, LightClient
 
-__all__ = ['DreamChainNode','DreamChain']
+__all__ = ['DreamChainNode','DreamChain','ChainSnapshot','Miner','Checkpoint','BodyArchive','Block','BlockHeader','Transaction','AdmissionControl','ProofOfWork','ProofOfAuthority','BloomFilter','LightClient']
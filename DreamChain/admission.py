@@ -0,0 +1,266 @@
+import io
+import pickle
+import re
+from collections import OrderedDict
+from queue import Queue, Full
+from threading import Lock, Semaphore, Thread
+from time import monotonic
+
+from .metrics import metrics
+
+# Largest push (a pickled block or registration) the server will read
+MAX_MESSAGE = 8 * 1024 * 1024
+
+# Messages that are requests rather than pushes, and fit in one read
+REQUEST_PREFIXES = (b"GET_", b"SUBSCRIBE")
+
+# Requests whose arguments can span several segments. Their clients shut
+# down their side of the connection once sent, so they are read to the
+# end like pushes.
+LONG_REQUESTS = (b"GET_FILTERED", b"GET_PAYLOADS", b"GET_BLOCK_TXS")
+
+# Requests that send the whole chain, which are capped separately
+CHAIN_SERVES = ('GET_CHAIN', 'GET_CHAIN_STREAM', 'GET_SNAPSHOT')
+
+# Messages for a named chain (see Node.add_chain) start with "@<name> "
+NAMESPACE_PREFIX = b"@"
+NAMESPACE_NAME = re.compile(r'[A-Za-z0-9_.-]{1,64}\Z')
+
+
+class MessageTooLarge(Exception):
+    pass
+
+
+def namespaced(message, namespace):
+    """
+    `message` addressed to the chain named `namespace` (None: the default chain).
+    """
+    if namespace is None:
+        return message
+    return NAMESPACE_PREFIX + namespace.encode() + b" " + message
+
+
+def split_namespace(message):
+    """
+    Returns (chain name or None, message without the prefix).
+    """
+    if not message.startswith(NAMESPACE_PREFIX):
+        return None, message
+    name, _, message = message[1:].partition(b" ")
+    return name.decode('ascii', 'replace'), message
+
+
+class TokenBucket:
+    """
+    Allows `rate` events per second on average, in bursts of up to `burst`.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    def take(self, cost=1, now=None):
+        if now is None:
+            now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class _RestrictedUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        # Pushes are plain dicts, lists and tuples; anything that needs a
+        # class or function to rebuild is refused rather than imported
+        raise pickle.UnpicklingError(f'refusing to load {module}.{name}')
+
+
+def loads_untrusted(data):
+    """
+    Unpickles a message from a peer, allowing only built-in container and
+    scalar types.
+    """
+    return _RestrictedUnpickler(io.BytesIO(data)).load()
+
+
+def load_untrusted(stream):
+    """
+    Unpickles the next message from a binary file object reading a peer's
+    stream, under the same restrictions as loads_untrusted.
+    """
+    return _RestrictedUnpickler(stream).load()
+
+
+def read_message(client_socket, max_message=MAX_MESSAGE):
+    """
+    Reads one message. Short requests fit in a single read; pushes and
+    LONG_REQUESTS are sent whole and then closed, so they are read to the
+    end, up to max_message bytes.
+    """
+    data = client_socket.recv(4096)
+    request = split_namespace(data)[1]
+    if not data or request.startswith(REQUEST_PREFIXES) and \
+            not request.startswith(LONG_REQUESTS):
+        return data
+    parts = [data]
+    size = len(data)
+    while True:
+        part = client_socket.recv(65536)
+        if not part:
+            break
+        size += len(part)
+        if size > max_message:
+            raise MessageTooLarge(f'message over {max_message} bytes')
+        parts.append(part)
+    return b"".join(parts)
+
+
+class AdmissionControl:
+    """
+    Decides which connections the peer server handles, and how many at once.
+
+    - Each peer address gets a token bucket of `rate` connections per
+      second with bursts of `burst`; connections over the limit are closed
+      unread. Buckets are kept for the `max_peers` most recent addresses.
+      Each peer may also hold at most `max_connections` connections at
+      once, so a few slow clients can't tie up every worker. None turns
+      either limit off, e.g. for many nodes sharing localhost.
+    - Accepted connections wait in a queue of `queue_size` for one of up to
+      `workers` threads, started as they are needed. When the queue is
+      full, new connections are shed (closed) instead of piling up threads.
+    - Whole-chain requests (CHAIN_SERVES) cost a further `chain_cost`
+      tokens, and at most `max_chain_serves` are served at once. Others
+      wait up to `chain_wait` seconds for a slot and are then dropped.
+    - Clients get `read_timeout` seconds per read, and pushes over
+      `max_message` bytes are dropped.
+
+    Rejections are counted in dreamchain_admission_rejected_total by reason.
+    """
+    def __init__(self, workers=16, queue_size=64, rate=50.0, burst=100, max_connections=8,
+                 max_peers=10000,
+                 chain_cost=10, max_chain_serves=2, chain_wait=1.0, read_timeout=10.0,
+                 max_message=MAX_MESSAGE):
+        self.workers = workers
+        self.rate = rate
+        self.burst = burst
+        self.max_connections = max_connections
+        self.max_peers = max_peers
+        self.chain_cost = chain_cost
+        self.chain_wait = chain_wait
+        self.read_timeout = read_timeout
+        self.max_message = max_message
+        self.queue = Queue(queue_size)
+        self.chain_serves = Semaphore(max_chain_serves)
+        self.lock = Lock()
+        self.buckets = OrderedDict()
+        self.threads = []
+        self.idle = 0
+        self.connections = {}
+
+    def allow(self, peer, cost=1):
+        """
+        Takes `cost` tokens from the bucket of `peer` (a host address).
+        """
+        if self.rate is None:
+            return True
+        with self.lock:
+            bucket = self.buckets.get(peer)
+            if bucket is None:
+                bucket = self.buckets[peer] = TokenBucket(self.rate, self.burst)
+                while len(self.buckets) > self.max_peers:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(peer)
+            return bucket.take(cost)
+
+    def reject(self, client_socket, reason):
+        metrics.inc('dreamchain_admission_rejected_total', reason=reason)
+        client_socket.close()
+
+    def submit(self, client_socket, address, handler):
+        """
+        Queues a newly accepted connection for `handler(client_socket)`, or
+        closes it if the peer is over its limits or the queue is full.
+        """
+        peer = address[0]
+        if not self.allow(peer):
+            self.reject(client_socket, 'rate')
+            return False
+        with self.lock:
+            connections = self.connections.get(peer, 0)
+            if self.max_connections is not None and connections >= self.max_connections:
+                connections = None
+            else:
+                self.connections[peer] = connections + 1
+        if connections is None:
+            self.reject(client_socket, 'connections')
+            return False
+        try:
+            self.queue.put_nowait((client_socket, peer, handler))
+        except Full:
+            self._finished(peer)
+            self.reject(client_socket, 'queue')
+            return False
+        with self.lock:
+            if self.idle == 0 and len(self.threads) < self.workers:
+                thread = Thread(target=self._work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        metrics.set('dreamchain_admission_queued', self.queue.qsize())
+        return True
+
+    def start_chain_serve(self, peer):
+        """
+        Admits a whole-chain request from `peer`: charges chain_cost tokens
+        and takes a serve slot, waiting up to chain_wait seconds for one.
+        Returns False if either is refused; finish_chain_serve() must follow
+        a True.
+        """
+        if not self.allow(peer, self.chain_cost):
+            reason = 'rate'
+        elif not self.chain_serves.acquire(timeout=self.chain_wait):
+            reason = 'chain_serves'
+        else:
+            return True
+        metrics.inc('dreamchain_admission_rejected_total', reason=reason)
+        return False
+
+    def finish_chain_serve(self):
+        self.chain_serves.release()
+
+    def _work(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+            item = self.queue.get()
+            with self.lock:
+                self.idle -= 1
+            if item is None:
+                break
+            client_socket, peer, handler = item
+            try:
+                handler(client_socket)
+            except Exception as e:
+                metrics.error('admission_worker', e)
+            finally:
+                self._finished(peer)
+
+    def _finished(self, peer):
+        with self.lock:
+            connections = self.connections.pop(peer) - 1
+            if connections:
+                self.connections[peer] = connections
+
+    def stop(self):
+        """
+        Stops the worker threads once the connections queued so far are handled.
+        """
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.queue.put(None)
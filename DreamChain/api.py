@@ -0,0 +1,348 @@
+"""
+Read-only HTTP API over a DreamChain, for dashboards and services:
+
+    GET /status                             height, tip hash and pool size
+    GET /blocks?from=&to=&limit=&cursor=    blocks by height range; `from`
+                                            and `to` also take block hashes
+    GET /blocks/<height or hash>
+    GET /transactions/<id>
+    GET /transactions?sender=&recipient=&limit=&cursor=
+
+Lists are paginated: a response carries `next_cursor` until the last page,
+and passing it back as `cursor` continues from there. Every response has
+an ETag, so a poller that sends If-None-Match gets a bodyless 304 while
+nothing changed. Responses about blocks and transactions are cached
+in-process until the tip or history moves; /status, which also reports
+the pool and the peers, is built afresh on every request.
+
+    from DreamChain.api import start_api_server
+    server = start_api_server(node.blockchain, 8080)
+
+Needs Flask, which is imported only when an app is created.
+"""
+import hashlib
+import json
+from bisect import bisect_right
+from collections import OrderedDict
+from threading import Lock, Thread
+
+from .blocks import block_to_dict
+from .dreamchain import DreamChain
+from .metrics import metrics
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def _flask():
+    try:
+        import flask
+    except ImportError:
+        raise ImportError("The HTTP API needs the 'flask' package: pip install flask")
+    return flask
+
+
+class ChainIndex:
+    """
+    Block and transaction lookups for a chain, kept up to date lazily.
+
+    Each query first indexes the blocks appended since the last one. When
+    the chain was swapped (a reorg, a prune or a backfill), the blocks above
+    the fork point are dropped from the index and re-added.
+    """
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.lock = Lock()
+        self.blocks = None
+        self.history_base = 0
+        self.hashes = []
+        self.heights = {}
+        # Per height: (transaction id, sender, recipient) for each transaction
+        self.block_transactions = []
+        # Transaction id -> (height, position); address -> sorted locations
+        self.transactions = {}
+        self.senders = {}
+        self.recipients = {}
+
+    def refresh(self):
+        """
+        Brings the index up to date and returns the snapshot it reflects.
+        """
+        with self.lock:
+            snapshot = self.blockchain.snapshot()
+            if self.blockchain.history_base != self.history_base:
+                self._truncate(0)
+                self.history_base = self.blockchain.history_base
+            if snapshot._blocks is not self.blocks:
+                height = min(len(snapshot), len(self.hashes))
+                while height > 0 and (snapshot[height - 1] is None or
+                                      self.hashes[height - 1] != DreamChain.hash(snapshot[height - 1])):
+                    height -= 1
+                self._truncate(height)
+                self.blocks = snapshot._blocks
+            for height in range(len(self.hashes) + 1, len(snapshot) + 1):
+                self._add(height, snapshot[height - 1])
+            return snapshot
+
+    def _add(self, height, block):
+        if block is None:
+            self.hashes.append(None)
+            self.block_transactions.append(())
+            return
+        block_hash = DreamChain.hash(block)
+        self.hashes.append(block_hash)
+        self.heights[block_hash] = height
+        entries = []
+        for position, tx in enumerate(self.bodies(block, height)):
+            transaction_id = DreamChain.transaction_id(tx)
+            location = (height, position)
+            self.transactions[transaction_id] = location
+            self.senders.setdefault(tx['sender'], []).append(location)
+            self.recipients.setdefault(tx['recipient'], []).append(location)
+            entries.append((transaction_id, tx['sender'], tx['recipient']))
+        self.block_transactions.append(entries)
+
+    def _truncate(self, height):
+        while len(self.hashes) > height:
+            top = len(self.hashes)
+            block_hash = self.hashes.pop()
+            if self.heights.get(block_hash) == top:
+                del self.heights[block_hash]
+            for transaction_id, sender, recipient in self.block_transactions.pop():
+                if self.transactions.get(transaction_id, (0,))[0] == top:
+                    del self.transactions[transaction_id]
+                for index, address in ((self.senders, sender), (self.recipients, recipient)):
+                    locations = index.get(address)
+                    while locations and locations[-1][0] >= top:
+                        locations.pop()
+                    if not locations:
+                        index.pop(address, None)
+
+    def bodies(self, block, height):
+        """
+        The transactions of a block, from the archive if it was pruned.
+        """
+        if 'transactions' in block:
+            return block['transactions']
+        return self.blockchain.get_bodies(height, height).get(height, [])
+
+
+class ChainAPI:
+    """
+    The queries behind the HTTP endpoints, each returning (status, JSON
+    payload), plus the response cache. Cached responses are dropped as
+    soon as the tip or history changes, so only answers that depend on
+    nothing else may be cached.
+    """
+    def __init__(self, blockchain, cache_size=1024):
+        self.blockchain = blockchain
+        self.index = ChainIndex(blockchain)
+        self.cache_size = cache_size
+        self.lock = Lock()
+        self.cache = OrderedDict()
+        self.version = None
+
+    def cached(self, key, build):
+        """
+        Returns (status, body bytes, etag) for `key`, building the payload
+        with build() on a miss.
+        """
+        version = (self.blockchain.tip_version, self.blockchain.history_version)
+        with self.lock:
+            if version != self.version:
+                self.cache.clear()
+                self.version = version
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.cache.move_to_end(key)
+                metrics.inc('dreamchain_api_cache_total', result='hit')
+                return entry
+        metrics.inc('dreamchain_api_cache_total', result='miss')
+
+        entry = self.render(build)
+        with self.lock:
+            # Don't cache an answer computed while the tip moved under us
+            if self.version == version:
+                self.cache[key] = entry
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def render(build):
+        """
+        Returns (status, body bytes, etag) for the payload build() returns.
+        """
+        status, payload = build()
+        body = json.dumps(payload, default=block_to_dict).encode()
+        return status, body, hashlib.sha256(body).hexdigest()[:32]
+
+    def _block(self, snapshot, height):
+        block = snapshot[height - 1]
+        if block is None:
+            return None
+        block = dict(block_to_dict(block), hash=self.index.hashes[height - 1])
+        if 'transactions' not in block:
+            transactions = self.blockchain.get_bodies(height, height).get(height)
+            if transactions is not None:
+                block['transactions'] = [dict(tx) for tx in transactions]
+        return block
+
+    def _height(self, value):
+        # A height, or the hash of a block on the chain
+        if value is None or value == '':
+            return None
+        if value.isdigit():
+            return int(value)
+        with self.index.lock:
+            return self.index.heights.get(value)
+
+    @staticmethod
+    def _limit(value):
+        if not value:
+            return PAGE_SIZE
+        return max(1, min(int(value), MAX_PAGE_SIZE))
+
+    def status(self):
+        snapshot = self.index.refresh()
+        return 200, {
+            'height': len(snapshot),
+            'tip_hash': self.index.hashes[-1] if self.index.hashes else None,
+            'tip_version': self.blockchain.tip_version,
+            'pool_transactions': len(self.blockchain.transactions),
+            'peers': len(self.blockchain.nodes),
+            'pruned_height': self.blockchain.pruned_height,
+            'history_base': self.blockchain.history_base,
+        }
+
+    def blocks(self, start=None, end=None, limit=None, cursor=None):
+        snapshot = self.index.refresh()
+        first = self._height(start)
+        last = self._height(end)
+        if (start and first is None) or (end and last is None):
+            return 404, {'error': 'unknown block'}
+        first = max(int(cursor) if cursor else first or 1, 1)
+        last = min(last or len(snapshot), len(snapshot))
+        stop = min(last, first + self._limit(limit) - 1)
+        blocks = [self._block(snapshot, height) for height in range(first, stop + 1)]
+        return 200, {
+            'blocks': [block for block in blocks if block is not None],
+            'next_cursor': str(stop + 1) if stop < last else None,
+        }
+
+    def block(self, key):
+        snapshot = self.index.refresh()
+        height = self._height(key)
+        if height is None or not 1 <= height <= len(snapshot):
+            return 404, {'error': 'unknown block'}
+        block = self._block(snapshot, height)
+        if block is None:
+            return 404, {'error': 'block not backfilled yet'}
+        return 200, block
+
+    def _transaction(self, snapshot, location):
+        height, position = location
+        transactions = self.index.bodies(snapshot[height - 1], height)
+        if position >= len(transactions):
+            return None
+        transaction = dict(transactions[position])
+        transaction.update(id=DreamChain.transaction_id(transactions[position]), block=height,
+                           block_hash=self.index.hashes[height - 1])
+        return transaction
+
+    def transaction(self, transaction_id):
+        snapshot = self.index.refresh()
+        with self.index.lock:
+            location = self.index.transactions.get(transaction_id)
+        transaction = self._transaction(snapshot, location) if location else None
+        if transaction is None:
+            return 404, {'error': 'unknown transaction'}
+        return 200, transaction
+
+    def transactions(self, sender=None, recipient=None, limit=None, cursor=None):
+        if bool(sender) == bool(recipient):
+            return 400, {'error': 'pass exactly one of sender and recipient'}
+        snapshot = self.index.refresh()
+        index = self.index.senders if sender else self.index.recipients
+        limit = self._limit(limit)
+        with self.index.lock:
+            locations = index.get(sender or recipient, [])
+            # Cursors name the last location returned, so pages stay put as
+            # the chain grows
+            first = 0
+            if cursor:
+                first = bisect_right(locations, tuple(int(part) for part in cursor.split('.')))
+            page = locations[first:first + limit]
+            more = first + limit < len(locations)
+        transactions = [self._transaction(snapshot, location) for location in page]
+        return 200, {
+            'transactions': [tx for tx in transactions if tx is not None],
+            'next_cursor': '%d.%d' % page[-1] if more else None,
+        }
+
+
+def create_app(blockchain, cache_size=1024):
+    """
+    Builds the Flask app serving the API for `blockchain`.
+    """
+    flask = _flask()
+    app = flask.Flask('DreamChain')
+    api = ChainAPI(blockchain, cache_size)
+    app.config['CHAIN_API'] = api
+
+    def respond(endpoint, build, cache=True):
+        request = flask.request
+        try:
+            if cache:
+                status, body, etag = api.cached(request.full_path, build)
+            else:
+                status, body, etag = api.render(build)
+        except ValueError:
+            status, body, etag = 400, b'{"error": "bad parameter"}', None
+        metrics.inc('dreamchain_api_requests_total', endpoint=endpoint, status=str(status))
+        response = app.response_class(body, status=status, mimetype='application/json')
+        if etag is not None and status == 200:
+            response.set_etag(etag)
+            # Cacheable, but always revalidated: the answer changes with the tip
+            response.headers['Cache-Control'] = 'no-cache'
+            response = response.make_conditional(request)
+        return response
+
+    @app.route('/status')
+    def status():
+        # The pool and the peers change without the tip moving
+        return respond('status', api.status, cache=False)
+
+    @app.route('/blocks')
+    def blocks():
+        args = flask.request.args
+        return respond('blocks', lambda: api.blocks(args.get('from'), args.get('to'),
+                                                    args.get('limit'), args.get('cursor')))
+
+    @app.route('/blocks/<key>')
+    def block(key):
+        return respond('block', lambda: api.block(key))
+
+    @app.route('/transactions')
+    def transactions():
+        args = flask.request.args
+        return respond('transactions', lambda: api.transactions(
+            args.get('sender'), args.get('recipient'), args.get('limit'), args.get('cursor')))
+
+    @app.route('/transactions/<transaction_id>')
+    def transaction(transaction_id):
+        return respond('transaction', lambda: api.transaction(transaction_id))
+
+    return app
+
+
+def start_api_server(blockchain, port, host='127.0.0.1'):
+    """
+    Serves the API at http://host:port/ on a daemon thread. Returns the
+    server; call shutdown() on it to stop.
+    """
+    from werkzeug.serving import make_server
+
+    server = make_server(host, port, create_app(blockchain), threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,75 @@
+import os
+import pickle
+from threading import Lock
+
+from .blocks import Transaction
+
+
+class BodyArchive:
+    """
+    Cold storage for pruned block bodies.
+
+    Each prune pass writes one pickle file holding {block index: transactions}
+    for the range it pruned, named after the first and last index in it.
+    With a PayloadStore, large payloads are kept in the store and the
+    segments only hold references to them.
+    """
+    def __init__(self, directory, payloads=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.payloads = payloads
+        self.segments = sorted(self._scan())
+        self.lock = Lock()
+        self._cached = (None, None)
+
+    def _scan(self):
+        for name in os.listdir(self.directory):
+            if name.startswith('bodies-') and name.endswith('.pickle'):
+                first, last = name[len('bodies-'):-len('.pickle')].split('-')
+                yield int(first), int(last), os.path.join(self.directory, name)
+
+    def store(self, bodies):
+        """
+        Writes a {block index: transactions} mapping as a new segment.
+        """
+        if not bodies:
+            return
+        if self.payloads is not None:
+            bodies = {index: self.payloads.encode_transactions(transactions)
+                      for index, transactions in bodies.items()}
+        first, last = min(bodies), max(bodies)
+        path = os.path.join(self.directory, f'bodies-{first:010d}-{last:010d}.pickle')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(bodies, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.segments = sorted(self.segments + [(first, last, path)])
+
+    def get(self, index):
+        """
+        Returns the archived transactions of block `index`, or None.
+        """
+        for first, last, path in self.segments:
+            if first <= index <= last:
+                transactions = self._load(path).get(index)
+                if transactions is not None and self.payloads is not None:
+                    transactions = [Transaction.from_dict(tx) for tx in
+                                    self.payloads.resolve_transactions([dict(tx) for tx in transactions])]
+                return transactions
+        return None
+
+    def _load(self, path):
+        # Bodies tend to be requested in runs, so keep the last segment around
+        with self.lock:
+            cached_path, bodies = self._cached
+            if cached_path == path:
+                return bodies
+        with open(path, 'rb') as f:
+            bodies = pickle.load(f)
+        with self.lock:
+            self._cached = (path, bodies)
+        return bodies
+
+    def ranges(self):
+        return [(first, last) for first, last, path in self.segments]
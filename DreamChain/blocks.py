@@ -0,0 +1,356 @@
+import hashlib
+import json
+
+# Stores a field without dropping the cached hash, for constructors
+_set = object.__setattr__
+
+
+class Record:
+    """
+    Base for the compact chain types. Fields live in __slots__ instead of a
+    per-object dict, and the usual read-only mapping methods are provided so
+    code written against the old dict blocks (block['index'],
+    block.get('transactions', []), 'hash' in block, dict(block)) keeps
+    working.
+
+    Records cache their hash, so assigning any field, as an attribute or
+    through item syntax, drops the cached one. Like the dicts they stand
+    in for, and since they compare by content, records are unhashable: use
+    their `hash` (the chain digest) as a key instead.
+    """
+    __slots__ = ()
+    _fields = ()
+    __hash__ = None
+
+    def _keys(self):
+        return self._fields
+
+    def __getitem__(self, key):
+        if key in self._keys():
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setattr__(self, name, value):
+        _set(self, name, value)
+        if name != '_hash' and '_hash' in self.__slots__:
+            _set(self, '_hash', None)
+
+    def __setitem__(self, key, value):
+        if key not in self._keys() or key == 'hash':
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        if key in self._keys():
+            return getattr(self, key)
+        return default
+
+    def __contains__(self, key):
+        return key in self._keys()
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def keys(self):
+        return list(self._keys())
+
+    def values(self):
+        return [getattr(self, key) for key in self._keys()]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self._keys()]
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self._fields}
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return type(self) is type(other) and self.to_dict() == other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+    def __reduce__(self):
+        # Pickles as the bare field values rather than a dict of them
+        return type(self), tuple(getattr(self, key) for key in self._fields)
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def _pair(left, right):
+    return hashlib.sha256((left + right).encode()).hexdigest()
+
+
+def merkle_tree(transaction_ids):
+    """
+    The levels of the Merkle tree over `transaction_ids`, leaves first and
+    the root level last. A level with an odd number of nodes pairs its last
+    node with itself. An empty block's tree is the hash of nothing.
+    """
+    level = list(transaction_ids) or [hashlib.sha256(b'').hexdigest()]
+    levels = [level]
+    while len(level) > 1:
+        if len(level) % 2:
+            level = level + level[-1:]
+        level = [_pair(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
+
+def merkle_root(transactions):
+    """
+    The Merkle root of a block's transactions (records or dicts).
+    """
+    return merkle_tree([Transaction.from_dict(tx).hash for tx in transactions])[-1][0]
+
+
+def merkle_proof(levels, position):
+    """
+    The sibling hashes linking the leaf at `position` to the root of the
+    tree `levels` (as merkle_tree() gives it), bottom up.
+    """
+    proof = []
+    for level in levels[:-1]:
+        sibling = position ^ 1
+        proof.append(level[sibling] if sibling < len(level) else level[position])
+        position //= 2
+    return proof
+
+
+def verify_merkle_proof(transaction_id, position, proof, root):
+    """
+    True if `proof` places `transaction_id` at `position` under `root`.
+    """
+    node = transaction_id
+    for sibling in proof:
+        node = _pair(sibling, node) if position % 2 else _pair(node, sibling)
+        position //= 2
+    return position == 0 and node == root
+
+
+def header_fields(block):
+    """
+    What the hash of a block with a Merkle root covers: everything but its
+    transactions, which the root commits to. Headers alone can then be
+    checked, as light clients do.
+    """
+    return {
+        'index': block['index'],
+        'timestamp': block['timestamp'],
+        'merkle_root': block['merkle_root'],
+        'proof': block['proof'],
+        'previous_hash': block['previous_hash'],
+    }
+
+
+class Transaction(Record):
+    """
+    A transfer from `sender` to `recipient`. Signed transactions (see
+    DreamChain.signatures) use the sender's public key as `sender` and carry
+    a `signature`; unsigned ones have no signature key at all, so their
+    dict form and hash are unchanged.
+    """
+    __slots__ = ('sender', 'recipient', 'data', 'signature', '_hash')
+    _fields = ('sender', 'recipient', 'data')
+
+    def __init__(self, sender, recipient, data, signature=None):
+        _set(self, 'sender', sender)
+        _set(self, 'recipient', recipient)
+        _set(self, 'data', data)
+        _set(self, 'signature', signature)
+        _set(self, '_hash', None)
+
+    def _keys(self):
+        if self.signature is None:
+            return self._fields
+        return self._fields + ('signature',)
+
+    @property
+    def hash(self):
+        # Covers the signature too, so a transaction ID identifies exactly
+        # what was verified
+        if self._hash is None:
+            self._hash = _digest(self.to_dict())
+        return self._hash
+
+    def payload(self):
+        """
+        The bytes a signature signs: the transaction without its signature.
+        """
+        return json.dumps({'sender': self.sender, 'recipient': self.recipient, 'data': self.data},
+                          sort_keys=True).encode()
+
+    def to_dict(self):
+        transaction = {'sender': self.sender, 'recipient': self.recipient, 'data': self.data}
+        if self.signature is not None:
+            transaction['signature'] = self.signature
+        return transaction
+
+    def __reduce__(self):
+        return Transaction, (self.sender, self.recipient, self.data, self.signature)
+
+    @classmethod
+    def from_dict(cls, transaction):
+        if isinstance(transaction, cls):
+            return transaction
+        return cls(transaction['sender'], transaction['recipient'], transaction['data'],
+                   transaction.get('signature'))
+
+
+class Block(Record):
+    """
+    A block. Blocks made since Merkle roots were introduced carry the root
+    of their transactions, and their hash covers only header_fields();
+    older blocks have no `merkle_root` key at all and keep hashing their
+    whole dict form, so existing chains stay valid.
+    """
+    __slots__ = ('index', 'timestamp', 'transactions', 'proof', 'previous_hash', 'merkle_root',
+                 '_hash')
+    _fields = ('index', 'timestamp', 'transactions', 'proof', 'previous_hash')
+
+    def __init__(self, index, timestamp, transactions, proof, previous_hash, merkle_root=None):
+        _set(self, 'index', index)
+        _set(self, 'timestamp', timestamp)
+        _set(self, 'transactions', transactions)
+        _set(self, 'proof', proof)
+        _set(self, 'previous_hash', previous_hash)
+        _set(self, 'merkle_root', merkle_root)
+        _set(self, '_hash', None)
+
+    def _keys(self):
+        if self.merkle_root is None:
+            return self._fields
+        return self._fields + ('merkle_root',)
+
+    @property
+    def hash(self):
+        # Same digest as hashing the dict form, so records and dicts interoperate
+        if self._hash is None:
+            if self.merkle_root is None:
+                self._hash = _digest(self.to_dict())
+            else:
+                self._hash = _digest(header_fields(self))
+        return self._hash
+
+    def valid_merkle_root(self):
+        """
+        False if the block's Merkle root doesn't match its transactions.
+        """
+        return self.merkle_root is None or self.merkle_root == merkle_root(self.transactions)
+
+    def to_dict(self):
+        block = {
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'transactions': [tx.to_dict() if tx.__class__ is Transaction else tx
+                             for tx in self.transactions],
+            'proof': self.proof,
+            'previous_hash': self.previous_hash,
+        }
+        if self.merkle_root is not None:
+            block['merkle_root'] = self.merkle_root
+        return block
+
+    def __reduce__(self):
+        return Block, (self.index, self.timestamp, self.transactions, self.proof,
+                       self.previous_hash, self.merkle_root)
+
+    def __eq__(self, other):
+        # Full blocks and their pruned headers share a hash
+        if isinstance(other, (Block, BlockHeader)):
+            return self.hash == other.hash
+        return super().__eq__(other)
+
+    def header(self):
+        return BlockHeader(self.index, self.timestamp, self.proof, self.previous_hash, self.hash,
+                           self.merkle_root)
+
+    @classmethod
+    def from_dict(cls, block):
+        if isinstance(block, cls):
+            return block
+        return cls(block['index'], block['timestamp'],
+                   [tx if tx.__class__ is Transaction else
+                    Transaction(tx['sender'], tx['recipient'], tx['data'], tx.get('signature'))
+                    for tx in block['transactions']],
+                   block['proof'], block['previous_hash'], block.get('merkle_root'))
+
+
+class BlockHeader(Record):
+    """
+    A pruned block: everything but its transactions, plus the hash of the
+    full block so the chain still links up.
+    """
+    __slots__ = ('index', 'timestamp', 'proof', 'previous_hash', 'hash', 'merkle_root')
+    _fields = ('index', 'timestamp', 'proof', 'previous_hash', 'hash')
+
+    def __init__(self, index, timestamp, proof, previous_hash, hash, merkle_root=None):
+        self.index = index
+        self.timestamp = timestamp
+        self.proof = proof
+        self.previous_hash = previous_hash
+        self.hash = hash
+        self.merkle_root = merkle_root
+
+    def _keys(self):
+        if self.merkle_root is None:
+            return self._fields
+        return self._fields + ('merkle_root',)
+
+    def valid_hash(self):
+        """
+        True if the header hashes to its `hash`. Only headers with a Merkle
+        root can be checked; older ones are taken as they are.
+        """
+        return self.merkle_root is None or _digest(header_fields(self)) == self.hash
+
+    def to_dict(self):
+        header = {key: getattr(self, key) for key in self._fields}
+        if self.merkle_root is not None:
+            header['merkle_root'] = self.merkle_root
+        return header
+
+    def __reduce__(self):
+        return BlockHeader, (self.index, self.timestamp, self.proof, self.previous_hash,
+                             self.hash, self.merkle_root)
+
+    def __eq__(self, other):
+        if isinstance(other, (Block, BlockHeader)):
+            return self.hash == other.hash
+        return super().__eq__(other)
+
+    @classmethod
+    def from_dict(cls, header):
+        if isinstance(header, cls):
+            return header
+        return cls(header['index'], header['timestamp'], header['proof'],
+                   header['previous_hash'], header['hash'], header.get('merkle_root'))
+
+
+def block_from_dict(block):
+    """
+    Converts a block received in the dict wire format (a full block, a pruned
+    header or None for missing history) into its record form.
+    """
+    if block is None or isinstance(block, Record):
+        return block
+    if 'transactions' in block:
+        return Block.from_dict(block)
+    return BlockHeader.from_dict(block)
+
+
+def block_to_dict(block):
+    """
+    The dict wire format of a block record (None stays None).
+    """
+    if block is None or isinstance(block, dict):
+        return block
+    return block.to_dict()
@@ -0,0 +1,187 @@
+import hmac
+import hashlib
+from threading import Event, Thread
+
+from .blocks import Block, block_from_dict, block_to_dict
+from .metrics import metrics
+
+SNAPSHOT_VERSION = 1
+
+
+class Checkpoint:
+    """
+    A (height, block hash) pair that nodes agree is final.
+
+    A checkpoint is trusted either because its hash is pinned in the node's
+    configuration, or because it carries an HMAC signature made with the
+    consortium's shared checkpoint key.
+    """
+    def __init__(self, height, block_hash, signature=None):
+        self.height = height
+        self.block_hash = block_hash
+        self.signature = signature
+
+    def _message(self):
+        return f'{self.height}:{self.block_hash}'.encode()
+
+    def sign(self, key):
+        self.signature = hmac.new(key, self._message(), hashlib.sha256).hexdigest()
+        return self
+
+    def verify(self, key):
+        if not key or not self.signature:
+            return False
+        expected = hmac.new(key, self._message(), hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, self.signature)
+
+    def to_dict(self):
+        return {'height': self.height, 'hash': self.block_hash, 'signature': self.signature}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['height'], data['hash'], data.get('signature'))
+
+
+def checkpoint_height(length, interval, depth):
+    """
+    Returns the most recent checkpoint height for a chain of `length` blocks:
+    a multiple of `interval` at least `depth` blocks below the tip.
+    """
+    return (length - depth) // interval * interval
+
+
+def checkpoints_for(blockchain):
+    """
+    Lists every checkpoint of a fully validated chain as {height: hash},
+    suitable for pinning in other nodes' configuration.
+    """
+    chain = blockchain.snapshot()
+    last = checkpoint_height(len(chain), blockchain.checkpoint_interval,
+                             blockchain.checkpoint_depth)
+    return {height: blockchain.hash(chain[height - 1])
+            for height in range(blockchain.checkpoint_interval, last + 1,
+                                blockchain.checkpoint_interval)}
+
+
+def make_snapshot(blockchain, key=None):
+    """
+    Builds a bootstrap snapshot: the latest checkpoint block and every block
+    after it. Pruned blocks among them get their bodies back from the
+    archive. Returns None if the chain is too short to have a checkpoint,
+    its own history is still being backfilled, or some of those bodies are
+    gone.
+    """
+    chain = blockchain.snapshot()
+    height = checkpoint_height(len(chain), blockchain.checkpoint_interval,
+                               blockchain.checkpoint_depth)
+    if height < 1 or chain[0] is None:
+        return None
+
+    blocks = list(chain[height - 1:])
+    for i, block in enumerate(blocks):
+        if 'transactions' in block:
+            continue
+        transactions = blockchain.archive.get(block['index']) \
+            if blockchain.archive is not None else None
+        if transactions is None:
+            # Peers would reject a snapshot holding bare headers
+            return None
+        blocks[i] = Block(block['index'], block['timestamp'], transactions, block['proof'],
+                          block['previous_hash'], block.get('merkle_root'))
+
+    checkpoint = Checkpoint(height, blockchain.hash(chain[height - 1]))
+    if key:
+        checkpoint.sign(key)
+    return {
+        'version': SNAPSHOT_VERSION,
+        'checkpoint': checkpoint.to_dict(),
+        'blocks': [block_to_dict(block) for block in blocks],
+    }
+
+
+def load_snapshot(blockchain, snapshot, key=None):
+    """
+    Replaces the chain with the one described by `snapshot` if its
+    checkpoint is trusted and the blocks after it are valid. History below
+    the checkpoint is left as None until backfilled. Malformed snapshots
+    are refused like untrusted ones.
+    """
+    if not _well_formed(snapshot):
+        return False
+
+    checkpoint = Checkpoint.from_dict(snapshot['checkpoint'])
+    try:
+        blocks = [block_from_dict(block) for block in snapshot['blocks']]
+    except (KeyError, TypeError, ValueError):
+        return False
+    pinned = blockchain.checkpoints.get(checkpoint.height)
+    if pinned is None and not checkpoint.verify(key):
+        return False
+    if pinned is not None and pinned != checkpoint.block_hash:
+        return False
+
+    # Only the blocks after the checkpoint are validated; the checkpoint
+    # block itself is vouched for by its hash.
+    if blockchain.hash(blocks[0]) != checkpoint.block_hash:
+        return False
+    if not blockchain.valid_chain(blocks, use_checkpoints=False):
+        return False
+
+    chain = [None] * (checkpoint.height - 1) + list(blocks)
+    return blockchain.adopt_chain(chain, checkpoint)
+
+
+def _well_formed(snapshot):
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        return False
+    checkpoint, blocks = snapshot.get('checkpoint'), snapshot.get('blocks')
+    if not isinstance(checkpoint, dict) or not isinstance(blocks, list) or not blocks:
+        return False
+    height = checkpoint.get('height')
+    return isinstance(height, int) and height >= 1 and isinstance(checkpoint.get('hash'), str) \
+        and all(isinstance(block, dict) for block in blocks)
+
+
+def backfill(blockchain, peers=None):
+    """
+    Downloads and fully validates the history below the node's checkpoint,
+    then splices it in under the current tip. Returns True once complete.
+    """
+    base = blockchain.history_base
+    if base == 0:
+        return True
+
+    for node in list(peers or blockchain.nodes):
+        length, chain = blockchain.get_chain_from_peer(node)
+        if not chain or len(chain) <= base:
+            continue
+        history = chain[:base + 1]
+        if blockchain.hash(history[base]) != blockchain.hash(blockchain.chain[base]):
+            continue
+        if not blockchain.valid_chain(history, use_checkpoints=False):
+            continue
+        if blockchain.fill_history(history[:base]):
+            return True
+    return False
+
+
+def _backfill_until_done(blockchain, peers, retry_interval, stopped):
+    while not stopped.is_set():
+        try:
+            if backfill(blockchain, peers):
+                return
+        except Exception as e:
+            metrics.error('backfill', e)
+        stopped.wait(retry_interval)
+
+
+def start_backfill(blockchain, peers=None, retry_interval=5, stopped=None):
+    """
+    Runs backfill() on a daemon thread, retrying until the history is
+    complete or the `stopped` Event is set.
+    """
+    stopped = stopped or Event()
+    thread = Thread(target=_backfill_until_done,
+                    args=(blockchain, peers, retry_interval, stopped), daemon=True)
+    thread.start()
+    return thread
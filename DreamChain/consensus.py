@@ -0,0 +1,160 @@
+"""
+Consensus rules: who may add the next block, and how a block proves it.
+
+A consensus is asked for the proof of a new block (prepare), finishes the
+block once its contents are fixed (seal), and judges blocks received from
+peers against their parent (valid_block). DreamChain uses proof of work
+unless given another:
+
+    authorities = [public_key(key) for key in consortium_keys]
+    blockchain = DreamChain(port, consensus=ProofOfAuthority(authorities, key=my_key,
+                                                             interval_ms=500))
+
+Whatever the consensus, the longest valid chain still wins.
+"""
+import hashlib
+import json
+from threading import Event
+from time import time
+
+from .blocks import block_to_dict, header_fields
+from .signatures import _ed25519, public_key
+
+
+def valid_proof(last_proof, proof):
+    """
+    The proof-of-work puzzle: sha256 of both proofs starts with four zeros.
+    """
+    guess = f'{last_proof}{proof}'.encode()
+    guess_hash = hashlib.sha256(guess).hexdigest()
+    return guess_hash[:4] == "0000"
+
+
+class ProofOfWork:
+    """
+    The original rules: a block's proof solves valid_proof() against its
+    parent's proof.
+    """
+    name = 'pow'
+
+    def prepare(self, blockchain, parent, abort=None, tip_version=None):
+        """
+        Returns the proof for a block on `parent`, or None if `abort` was set
+        or the tip moved past `tip_version` first.
+        """
+        return blockchain.proof_of_work(parent['proof'], abort=abort, tip_version=tip_version)
+
+    def seal(self, block):
+        return block
+
+    def valid_block(self, parent, block):
+        return valid_proof(parent['proof'], block['proof'])
+
+
+class ProofOfAuthority:
+    """
+    Blocks signed by a fixed set of authorities taking turns.
+
+    Time is cut into slots of `interval_ms` milliseconds, and each slot
+    belongs to one authority, round-robin over `authorities` (hex Ed25519
+    public keys, as signatures.public_key() gives them). A block's proof is
+    {'slot', 'signer', 'signature'}: the slot it was made in, which must be
+    later than its parent's and not start more than `max_drift` seconds in
+    the future, and the slot owner's signature over the block. An authority
+    that is down only costs its own slots; the next one builds on the last
+    block it saw.
+
+    Nodes that only validate need no `key`. Needs the `cryptography`
+    package, like signed transactions.
+    """
+    name = 'poa'
+
+    def __init__(self, authorities, key=None, interval_ms=1000, max_drift=1.0):
+        if not authorities:
+            raise ValueError('Proof of authority needs at least one authority')
+        self.authorities = list(authorities)
+        self.key = key
+        self.address = public_key(key) if key is not None else None
+        self.interval = interval_ms / 1000
+        self.max_drift = max_drift
+        self._public_keys = {}
+
+    def slot(self, timestamp):
+        return int(timestamp // self.interval)
+
+    def owner(self, slot):
+        return self.authorities[slot % len(self.authorities)]
+
+    @staticmethod
+    def _slot_of(block):
+        # The genesis block has a plain proof; every sealed block comes after it
+        proof = block['proof']
+        return proof['slot'] if isinstance(proof, dict) else -1
+
+    def next_slot(self, parent, now=None):
+        """
+        The first slot of ours that can follow `parent`, not before the
+        current one.
+        """
+        if self.address not in self.authorities:
+            raise ValueError('This node holds no authority key, so it cannot seal blocks')
+        slot = max(self.slot(now if now is not None else time()), self._slot_of(parent) + 1)
+        while self.owner(slot) != self.address:
+            slot += 1
+        return slot
+
+    def prepare(self, blockchain, parent, abort=None, tip_version=None):
+        """
+        Waits for our next slot and returns it as the block's provisional
+        proof. Gives up with None if `abort` is set or the tip moves past
+        `tip_version` meanwhile, e.g. because another authority's block
+        arrived.
+        """
+        slot = self.next_slot(parent)
+        start = slot * self.interval
+        waiter = abort if abort is not None else Event()
+        while True:
+            remaining = start - time()
+            if remaining <= 0:
+                return slot
+            if waiter.wait(min(remaining, 0.01)) or \
+                    (tip_version is not None and blockchain.tip_version != tip_version):
+                return None
+
+    def _signed(self, block, slot, signer):
+        # Blocks with a Merkle root are signed by their header, so light
+        # clients holding only headers can check the signature too
+        if block.get('merkle_root') is not None:
+            block = header_fields(block)
+        else:
+            block = block_to_dict(block)
+        block['proof'] = {'slot': slot, 'signer': signer}
+        return json.dumps(block, sort_keys=True).encode()
+
+    def seal(self, block):
+        """
+        Replaces the provisional proof (a slot number) with the signed one.
+        """
+        slot = block.proof
+        signature = self.key.sign(self._signed(block, slot, self.address)).hex()
+        block.proof = {'slot': slot, 'signer': self.address, 'signature': signature}
+        return block
+
+    def valid_block(self, parent, block):
+        proof = block['proof']
+        if not isinstance(proof, dict) or not isinstance(proof.get('slot'), int):
+            return False
+        slot, signer = proof['slot'], proof.get('signer')
+        if slot <= self._slot_of(parent) or signer != self.owner(slot):
+            return False
+        if slot * self.interval > time() + self.max_drift:
+            return False
+        key = self._public_keys.get(signer)
+        if key is None:
+            key = self._public_keys[signer] = \
+                _ed25519().Ed25519PublicKey.from_public_bytes(bytes.fromhex(signer))
+        try:
+            key.verify(bytes.fromhex(proof['signature']), self._signed(block, slot, signer))
+        except Exception:
+            return False
+        return True
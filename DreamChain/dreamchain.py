@@ -1,7 +1,28 @@
 import socket
 import pickle
-from threading import Thread
-from time import time
+from threading import Thread, Lock, RLock, Event
+from .miner import Miner
+from .checkpoint import make_snapshot, load_snapshot, start_backfill
+from .archive import BodyArchive
+from .blocks import (Record, Block, Transaction, block_from_dict, block_to_dict, header_fields,
+                     merkle_root)
+from .validation import default_validator, validate_batch
+from .consensus import ProofOfWork, valid_proof
+from .signatures import default_verifier
+from .payloads import PayloadStore
+from .admission import (AdmissionControl, CHAIN_SERVES, NAMESPACE_NAME, REQUEST_PREFIXES,
+                        load_untrusted, loads_untrusted, namespaced, read_message,
+                        split_namespace)
+from .subscriptions import SubscriptionHub
+from .relay import (FEATURE_COMPACT, FEATURE_TRANSACTIONS, TransactionRelay, assemble,
+                    compact_block, rebuild)
+from .lightclient import BloomFilter, filtered_blocks
+from .wal import TransactionLog
+from .pipeline import Abort, Pipeline
+from .metrics import metrics, SIZE_BUCKETS
+from .profiling import profiler, ProfiledLock
+from time import time, perf_counter, monotonic
+from itertools import islice
 import hashlib
 import json
 from uuid import uuid4
@@ -21,72 +42,581 @@ def get_ip():
         s.close()
     return ip
 
+class ChainSnapshot:
+    """
+    Read-only, point-in-time view of a chain.
+
+    The chain list is only ever appended to or swapped out wholesale, so the
+    first `length` entries of a list never change once they are visible. A
+    (list, length) pair can therefore be read without holding any lock.
+    """
+    __slots__ = ('_blocks', '_length')
+
+    def __init__(self, blocks, length):
+        self._blocks = blocks
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return islice(self._blocks, self._length)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._blocks[slice(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('chain index out of range')
+        return self._blocks[index]
+
+    def __repr__(self):
+        return f'ChainSnapshot(length={self._length})'
+
 class DreamChain:
-    def __init__(self, port):
+    def __init__(self, port, checkpoints=None, checkpoint_key=None, prune_depth=None,
+                 archive_dir=None, payload_dir=None, wal=None, consensus=None, namespace=None,
+                 merkle_roots=False):
         self.chain = []
         self.transactions = []
         self.nodes = set()
         self.node_identifier = str(uuid4()).replace('-', '')
         self.port = port
 
+        # Name of this chain when it is one of several hosted by a node (see
+        # Node.add_chain); our messages to peers are addressed to it
+        self.namespace = namespace
+
+        # Pinned {height: block hash} checkpoints. Chains must match them, and
+        # validation starts from the highest one a chain reaches. Snapshots
+        # offered to peers are signed with checkpoint_key when one is set.
+        self.checkpoints = dict(checkpoints or {})
+        self.checkpoint_key = checkpoint_key
+        self.checkpoint_interval = 1000
+        self.checkpoint_depth = 100
+
+        # Number of leading blocks not held yet (None in the chain) after
+        # bootstrapping from a snapshot; 0 once history is backfilled.
+        self.history_base = 0
+
+        # Pruning mode: blocks more than prune_depth below the tip keep only
+        # their header and hash. Their bodies are dropped, or moved to
+        # archive_dir if one is given. pruned_height counts the leading
+        # blocks that no longer carry a body in memory.
+        # Snapshots start at the latest checkpoint, which can be up to
+        # checkpoint_depth + checkpoint_interval blocks below the tip; pruning
+        # higher than that leaves them without bodies unless archived.
+        if prune_depth is not None:
+            least = 1 if archive_dir else self.checkpoint_depth + self.checkpoint_interval
+            if prune_depth < least:
+                raise ValueError(f'prune_depth must be at least {least}'
+                                 f'{"" if archive_dir else " without an archive_dir"}')
+        self.prune_depth = prune_depth
+        self.prune_batch = 100
+        self.pruned_height = 0
+
+        # Large transaction payloads, stored once by content hash (on disk
+        # under payload_dir if given, with only recently used ones kept in
+        # memory). Peers that ask for it get
+        # references instead of repeated payloads and fetch what they lack.
+        self.payloads = PayloadStore(payload_dir)
+        self.archive = BodyArchive(archive_dir, self.payloads) if archive_dir else None
+
+        # Long chains are validated across a process pool shared by every
+        # chain in the process, while it has no other threads to fork (see
+        # ParallelValidator); ParallelValidator(processes=1) turns that off
+        self.validator = default_validator()
+
+        # Streamed chains go through a pipeline (see pipeline.py): batches
+        # are received, decoded, verified by sync_workers threads and linked
+        # at the same time, with at most sync_queue_size batches between
+        # stages. Verifying is mostly pure Python, so more workers only pay
+        # off where it isn't (signature checks, hashing large payloads).
+        self.sync_workers = 1
+        self.sync_queue_size = 4
+
+        # Signed transactions are always verified; with require_signatures
+        # unsigned ones are refused too. Verified transaction IDs are cached
+        # process-wide, so pool transactions aren't checked again in blocks.
+        self.verifier = default_verifier()
+        self.require_signatures = False
+
+        # Optional network conditions consulted before every outbound
+        # connection (see simulator.NetworkConditions)
+        self.network = None
+
+        # Transaction gossip (a TransactionRelay, started by Node). While it
+        # runs, peers hold most pool transactions and blocks are announced
+        # in compact form unless compact_blocks is turned off.
+        self.relay = None
+        self.compact_blocks = True
+
+        # Optional messages (FEATURES) each peer understands, learned from
+        # its GET_INFO the first time we push to it. Peers running
+        # dreamchain_master.py don't answer GET_INFO and only get full blocks.
+        self.peer_features = {}
+
+        # When a compact block we couldn't rebuild last made us resync;
+        # anyone can announce one, so that resync is rate-limited
+        self.compact_resynced = None
+
+        # Writers take `lock` to move the tip; readers use snapshot() instead.
+        # The pool and the peer set have their own locks so that accepting
+        # transactions or peers never waits behind a chain update. While the
+        # profiler runs, time spent waiting on each of them is recorded.
+        self.lock = ProfiledLock(RLock(), 'chain')
+        self.tx_lock = ProfiledLock(Lock(), 'pool')
+        self.nodes_lock = ProfiledLock(Lock(), 'peers')
+
+        # Bumped under `lock` whenever the tip changes, so proof searches can
+        # notice a new tip with a single integer comparison.
+        self.tip_version = 0
+
+        # Bumped under `lock` whenever blocks below the tip change form while
+        # the tip stays put: pruning strips their bodies, fill_history
+        # splices in the history below a checkpoint. Caches of served blocks
+        # key on both versions.
+        self.history_version = 0
+
+        # Proof-of-work time, split by outcome. 'stale' is work that ran to
+        # completion on a tip that had already moved, 'abandoned' is work cut
+        # short as soon as the move was noticed; both are wasted. Set
+        # cancellable_mining to False to measure the uncancelled baseline.
+        self.cancellable_mining = True
+        self.stats_lock = Lock()
+        self._mining_stats = {
+            'mined': 0, 'mined_seconds': 0.0,
+            'stale': 0, 'stale_seconds': 0.0,
+            'abandoned': 0, 'abandoned_seconds': 0.0,
+        }
+
+        # Callbacks of the form listener(event, payload), called outside the
+        # locks for 'transaction', 'block' and 'reorg' events.
+        self.listeners = []
+
+        # Subscribers to those events, in-process or over SUBSCRIBE
+        # connections to the node server
+        self.subscriptions = SubscriptionHub(self)
+
+        # Who may add blocks and how they prove it: proof of work unless a
+        # consortium passes ProofOfAuthority (see consensus.py)
+        self.consensus = consensus or ProofOfWork()
+
+        # Write-ahead log of the pool (a TransactionLog, or the path of one
+        # with group commit), replayed below so a restart keeps pending
+        # transactions
+        if isinstance(wal, str):
+            wal = TransactionLog(wal)
+        self.wal = wal
+
+        # Blocks we make carry a Merkle root and hash by their header, so
+        # light clients can check them (see lightclient.py). Off by default:
+        # nodes still running dreamchain_master.py hash whole blocks and
+        # would reject our chain. Blocks from peers are accepted either way.
+        self.merkle_roots = merkle_roots
+
         # Create the genesis block
         self.new_block(previous_hash='1', proof=100)
 
-    def new_block(self, proof, previous_hash=None):
-        block = {
-            'index': len(self.chain) + 1,
-            'timestamp': time(),
-            'transactions': self.transactions,
-            'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1]),
-        }
+        if wal is not None:
+            self.transactions = [Transaction(tx.sender, tx.recipient, self.payloads.intern(tx.data),
+                                             tx.signature) for tx in wal.replay()]
 
-        self.transactions = []
-        self.chain.append(block)
+    def new_block(self, proof, previous_hash=None, parent=None):
+        """
+        Appends a new block holding the pending transactions. If `parent` is
+        given, the block is only created while that block is still the tip;
+        otherwise nothing happens and None is returned.
+        """
+        with self.lock:
+            if parent is not None and self.chain[-1] is not parent:
+                return None
+            with self.tx_lock:
+                transactions, self.transactions = self.transactions, []
+                if self.wal is not None:
+                    self.wal.remove(transactions)
+            block = Block(
+                index=len(self.chain) + 1,
+                timestamp=time(),
+                transactions=transactions,
+                proof=proof,
+                previous_hash=previous_hash or self.hash(self.chain[-1]),
+                merkle_root=merkle_root(transactions) if self.merkle_roots else None,
+            )
+            if self.chain:
+                block = self.consensus.seal(block)
+            self.chain.append(block)
+            self.tip_version += 1
+        self._notify('block', block)
+        self.prune()
         return block
 
-    def new_transaction(self, sender, recipient, data):
-        self.transactions.append({
-            'sender': sender,
-            'recipient': recipient,
-            'data': data,
-        })
+    def new_transaction(self, sender, recipient, data, signature=None):
+        transaction = Transaction(sender, recipient, self.payloads.intern(data), signature)
+        if not self.verifier.verify([transaction], self.require_signatures):
+            raise ValueError('Invalid or missing transaction signature')
+        if self.wal is not None:
+            # Durable before it is accepted; concurrent calls share an fsync
+            self.wal.append(transaction)
+        with self.tx_lock:
+            self.transactions.append(transaction)
+        self._notify('transaction', transaction)
         return self.last_block['index'] + 1
 
+    def add_block(self, block):
+        """
+        Appends a block received from a peer if it extends our current tip.
+        Returns False (and leaves the chain untouched) otherwise.
+        """
+        block = block_from_dict(block)
+        # The Merkle root and signatures are checked before taking the lock,
+        # since they are slow
+        if not block.valid_merkle_root():
+            return False
+        if not self.verifier.verify_blocks([block], self.require_signatures):
+            return False
+        # Share large payloads with equal ones already in the pool or chain
+        for transaction in block.get('transactions', ()):
+            # An equal payload, so the hash computed above still holds
+            transaction_hash = transaction._hash
+            transaction.data = self.payloads.intern(transaction.data)
+            transaction._hash = transaction_hash
+        with self.lock:
+            last_block = self.chain[-1]
+            if block.previous_hash != self.hash(last_block):
+                return False
+            if not self.consensus.valid_block(last_block, block):
+                return False
+            self.chain.append(block)
+            self.tip_version += 1
+        self._drop_confirmed([block])
+        self._notify('block', block)
+        self.prune()
+        return True
+
+    def snapshot(self):
+        """
+        Returns an immutable view of the chain as it is right now.
+        """
+        with self.lock:
+            return ChainSnapshot(self.chain, len(self.chain))
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def _notify(self, event, payload):
+        for listener in list(self.listeners):
+            try:
+                listener(event, payload)
+            except Exception as e:
+                metrics.error('listener', e)
+                # print(f"Error in {event} listener: {e}")
+
+    def _drop_confirmed(self, blocks):
+        """
+        Removes pool transactions that the given blocks have already confirmed.
+        """
+        # Hashing every confirmed transaction is only worth it if the pool
+        # has something to drop, which after a long sync it usually doesn't
+        if not self.transactions:
+            return
+        pending = {self.transaction_id(tx) for tx in self.transactions}
+        confirmed = {transaction_id for block in blocks
+                     for transaction_id in map(self.transaction_id, block.get('transactions', []))
+                     if transaction_id in pending}
+        if not confirmed:
+            return
+        with self.tx_lock:
+            if self.wal is not None:
+                self.wal.remove([tx for tx in self.transactions
+                                 if self.transaction_id(tx) in confirmed])
+            self.transactions = [tx for tx in self.transactions
+                                 if self.transaction_id(tx) not in confirmed]
+
+    def _requeue_orphaned(self, orphaned, adopted):
+        """
+        Puts transactions from blocks dropped by a reorg back into the pool,
+        unless the adopted chain already contains them.
+        """
+        orphaned = [tx for block in orphaned if block is not None
+                    for tx in block.get('transactions', [])]
+        if not orphaned:
+            return
+        kept = {self.transaction_id(tx) for block in adopted
+                for tx in block.get('transactions', [])}
+        requeue = [tx for tx in orphaned if self.transaction_id(tx) not in kept]
+        if requeue:
+            with self.tx_lock:
+                if self.wal is not None:
+                    for transaction in requeue:
+                        self.wal.append(Transaction.from_dict(transaction), wait=False)
+                self.transactions = requeue + self.transactions
+
+    @staticmethod
+    def fork_point(old_chain, new_chain):
+        """
+        Returns the number of leading blocks the two chains have in common.
+        """
+        i = min(len(old_chain), len(new_chain))
+        while i > 0 and old_chain[i - 1] != new_chain[i - 1]:
+            i -= 1
+        return i
+
+    @staticmethod
+    def transaction_id(transaction):
+        return DreamChain.hash(transaction)
+
+    @staticmethod
+    def header(block):
+        """
+        Returns the pruned form of a block: everything but its transactions,
+        plus the hash of the full block so the chain still links up.
+        """
+        if 'transactions' not in block:
+            return block
+        return Block.from_dict(block).header()
+
+    def with_body(self, block):
+        """
+        The inverse of header(): a pruned block with its body restored from
+        the archive, as peers asking for the chain expect it. Other blocks,
+        and pruned ones whose body isn't archived, are returned as they are.
+        """
+        if block is None or 'transactions' in block or self.archive is None:
+            return block
+        transactions = self.archive.get(block['index'])
+        if transactions is None:
+            return block
+        return Block(block['index'], block['timestamp'], transactions, block['proof'],
+                     block['previous_hash'], block.get('merkle_root'))
+
+    def prune(self):
+        """
+        Strips the bodies of blocks more than prune_depth below the tip,
+        archiving them first if an archive is configured. Works in batches of
+        prune_batch blocks and returns the number of blocks pruned.
+        """
+        if self.prune_depth is None:
+            return 0
+        with self.lock:
+            chain = self.chain
+            start, end = self.pruned_height, len(chain) - self.prune_depth
+            if end - start < self.prune_batch:
+                return 0
+
+        bodies = {block['index']: block['transactions'] for block in chain[start:end]
+                  if block is not None and 'transactions' in block}
+        if self.archive is not None:
+            self.archive.store(bodies)
+
+        with self.lock:
+            # A reorg swapped the chain while we archived; retry next time
+            if self.chain is not chain:
+                return 0
+            pruned = list(chain)
+            for i in range(start, end):
+                if pruned[i] is not None:
+                    pruned[i] = self.header(pruned[i])
+            self.chain = pruned
+            self.pruned_height = end
+            self.history_version += 1
+        return end - start
+
+    def get_bodies(self, first, last):
+        """
+        Returns {block index: transactions} for the blocks in [first, last]
+        whose bodies we still hold, in memory or in the archive.
+        """
+        chain = self.snapshot()
+        bodies = {}
+        for index in range(max(first, 1), min(last, len(chain)) + 1):
+            block = chain[index - 1]
+            if block is not None and 'transactions' in block:
+                bodies[index] = block['transactions']
+            elif self.archive is not None:
+                transactions = self.archive.get(index)
+                if transactions is not None:
+                    bodies[index] = transactions
+        return bodies
+
+    def info(self):
+        """
+        Describes what this node holds, so peers can tell full nodes from
+        pruned ones: block ranges with bodies as (first, last) pairs.
+        """
+        chain = self.snapshot()
+        bodies = list(self.archive.ranges()) if self.archive is not None else []
+        first = max(self.pruned_height, self.history_base) + 1
+        if first <= len(chain):
+            bodies.append((first, len(chain)))
+        return {
+            'height': len(chain),
+            'pruned': self.pruned_height > 0,
+            'history_base': self.history_base,
+            'bodies': bodies,
+            'features': [FEATURE_COMPACT] + ([FEATURE_TRANSACTIONS] if self.relay else []),
+        }
+
     @staticmethod
     def hash(block):
-        block_string = json.dumps(block, sort_keys=True).encode()
+        # Records cache their hash; pruned headers carry the hash of the full
+        # block they came from
+        if isinstance(block, Record):
+            return block.hash
+        if 'transactions' not in block and 'hash' in block:
+            return block['hash']
+        if 'merkle_root' in block:
+            block = header_fields(block)
+        block_string = json.dumps(block, sort_keys=True, default=block_to_dict).encode()
         return hashlib.sha256(block_string).hexdigest()
 
     @property
     def last_block(self):
         return self.chain[-1]
 
-    def proof_of_work(self, last_proof):
+    def proof_of_work(self, last_proof, abort=None, tip_version=None):
+        """
+        Searches for a proof for `last_proof`. Every 1024 attempts it checks
+        whether `abort` (a threading.Event) is set or the tip has moved past
+        `tip_version`, and gives up by returning None if so.
+        """
         proof = 0
         while self.valid_proof(last_proof, proof) is False:
             proof += 1
+            if not proof & 1023:
+                if (abort is not None and abort.is_set()) or \
+                        (tip_version is not None and self.tip_version != tip_version):
+                    metrics.inc('dreamchain_pow_hashes_total', proof)
+                    return None
+        metrics.inc('dreamchain_pow_hashes_total', proof + 1)
         return proof
 
-    @staticmethod
-    def valid_proof(last_proof, proof):
-        guess = f'{last_proof}{proof}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
-
-    def valid_chain(self, chain):
-        last_block = chain[0]
-        current_index = 1
-
-        while current_index < len(chain):
-            block = chain[current_index]
-            if block['previous_hash'] != self.hash(last_block):
+    def mine(self, abort=None):
+        """
+        Makes one attempt at mining a block on the current tip. Returns the
+        new block, or None if the tip moved (or `abort` was set) first.
+        """
+        with self.lock:
+            tip_version, parent = self.tip_version, self.chain[-1]
+
+        started = perf_counter()
+        with profiler.label('mine'):
+            proof = self.consensus.prepare(
+                self,
+                parent,
+                abort=abort,
+                tip_version=tip_version if self.cancellable_mining else None,
+            )
+        elapsed = perf_counter() - started
+
+        if proof is None:
+            self._record_mining('abandoned', elapsed)
+            return None
+        block = self.new_block(proof, parent=parent)
+        self._record_mining('stale' if block is None else 'mined', elapsed)
+        return block
+
+    def _record_mining(self, outcome, seconds):
+        with self.stats_lock:
+            self._mining_stats[outcome] += 1
+            self._mining_stats[f'{outcome}_seconds'] += seconds
+        metrics.observe('dreamchain_pow_seconds', seconds, outcome=outcome)
+
+    def mining_stats(self):
+        """
+        Returns a copy of the proof-of-work counters, plus `wasted_seconds`:
+        time spent on proofs that never made it onto the chain.
+        """
+        with self.stats_lock:
+            stats = dict(self._mining_stats)
+        stats['wasted_seconds'] = stats['stale_seconds'] + stats['abandoned_seconds']
+        return stats
+
+    def stats_gauges(self):
+        """
+        Point-in-time state of this chain, in the form Metrics.render() takes.
+        """
+        labels = (('port', str(self.port)),)
+        return {
+            ('dreamchain_chain_height', labels): len(self.chain),
+            ('dreamchain_tip_version', labels): self.tip_version,
+            ('dreamchain_pool_transactions', labels): len(self.transactions),
+            ('dreamchain_peers', labels): len(self.nodes),
+            ('dreamchain_pruned_height', labels): self.pruned_height,
+            ('dreamchain_history_base', labels): self.history_base,
+        }
+
+    def adopt_chain(self, chain, checkpoint):
+        """
+        Switches to a chain bootstrapped from a trusted checkpoint, whose
+        history below the checkpoint is still missing.
+        """
+        with self.lock:
+            if len(chain) <= len(self.chain):
                 return False
-            if not self.valid_proof(last_block['proof'], block['proof']):
+            old_chain, self.chain = self.chain, chain
+            self.history_base = checkpoint.height - 1
+            self.checkpoints[checkpoint.height] = checkpoint.block_hash
+            self.tip_version += 1
+
+        self._requeue_orphaned(old_chain, [])
+        self._notify('reorg', (self.history_base, chain[self.history_base:]))
+        return True
+
+    def fill_history(self, history):
+        """
+        Splices validated history in below the checkpoint we started from.
+        """
+        with self.lock:
+            if len(history) != self.history_base:
                 return False
-            last_block = block
-            current_index += 1
+            self.chain = history + self.chain[self.history_base:]
+            self.history_base = 0
+            self.pruned_height = 0
+            self.history_version += 1
+        return True
+
+    valid_proof = staticmethod(valid_proof)
 
+    def valid_chain(self, chain, use_checkpoints=True):
+        """
+        Checks the links of `chain` and its blocks under our consensus. With
+        `use_checkpoints`, the chain must match every pinned checkpoint it
+        reaches and its blocks are only checked from the highest of them
+        onwards; below it, every block must still be there and link to the
+        one before. (Our own chain while backfilling is never checked here.)
+        """
+        start = 0
+        if use_checkpoints:
+            for height, block_hash in self.checkpoints.items():
+                if height > len(chain):
+                    continue
+                if chain[height - 1] is None or self.hash(chain[height - 1]) != block_hash:
+                    return False
+                start = max(start, height - 1)
+        if not self._linked(chain[:start + 1]):
+            return False
+
+        # Pruned headers can't be re-hashed, so they are only acceptable
+        # below a pinned checkpoint; the validator rejects them
+        if not self.validator.validate(chain, start, self.consensus):
+            return False
+        return self.verifier.verify_blocks(chain[start + 1:], self.require_signatures)
+
+    def _linked(self, blocks):
+        """
+        True if none of `blocks` is missing and each links to the one before.
+        """
+        previous = None
+        for block in blocks:
+            if block is None or previous is not None and \
+                    block['previous_hash'] != self.hash(previous):
+                return False
+            previous = block
         return True
 
     def resolve_conflicts(self):
@@ -97,15 +627,34 @@ class DreamChain:
         new_chain = None
         max_length = len(self.chain)
 
+        # Peers are fetched and validated without holding the chain lock, so
+        # mining and GET_CHAIN serving carry on while we sync. Chains are
+        # streamed and validated as they arrive, and only downloaded at all
+        # if they are longer than the best one so far.
         for node in self.nodes:
-            length, chain = self.get_chain_from_peer(node)
-            if chain and length > max_length and self.valid_chain(chain):
-                max_length = length
+            with metrics.span('dreamchain_sync', phase='stream'):
+                chain = self.stream_chain_from_peer(node, max_length)
+            if chain is not None:
+                max_length = len(chain)
                 new_chain = chain
 
         # If we discovered a new, valid chain longer than our current one, replace it
         if new_chain:
-            self.chain = new_chain
+            with self.lock:
+                # The tip may have moved while we were downloading
+                if len(new_chain) <= len(self.chain):
+                    return False
+                old_chain, self.chain = self.chain, new_chain
+                self.history_base = 0
+                self.pruned_height = 0
+                self.tip_version += 1
+
+            fork = self.fork_point(old_chain, new_chain)
+            self._requeue_orphaned(old_chain[fork:], new_chain[fork:])
+            self._drop_confirmed(new_chain[fork:])
+            self._notify('reorg', (fork, new_chain[fork:]))
+            metrics.inc('dreamchain_reorgs_total')
+            metrics.observe('dreamchain_reorg_depth', len(old_chain) - fork, SIZE_BUCKETS)
             # print("Chain replaced with the longest one from peer.")
             return True
         return False
@@ -115,122 +664,754 @@ class DreamChain:
         Retrieve the blockchain from a peer node, fetching the data in chunks.
         """
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(node)
-            s.send(b"GET_CHAIN")
-
-            # Use a loop to fetch the entire chain
-            data = b""
-            while True:
-                part = s.recv(4096)
-                if not part:
-                    break
-                data += part
-            
-            s.close()
-
-            length, chain = pickle.loads(data)
-            return length, chain
+            length, chain = self.request_from_peer(node, b"GET_CHAIN")
+            return length, [block_from_dict(block) for block in chain]
         except Exception as e:
+            metrics.error('get_chain', e)
             # print(f"Error fetching chain from peer {node}: {e}")
             return None, None
 
+    def stream_chain_from_peer(self, node, longer_than=0):
+        """
+        Downloads a peer's chain in batches, validating each batch as it
+        arrives. Returns the chain if it is valid and longer than
+        `longer_than`, otherwise None. The download stops as soon as the
+        chain is known to be too short or invalid. Peers that can't stream
+        are asked for the whole chain instead.
+        """
+        try:
+            s = self.connect(node)
+        except Exception as e:
+            metrics.error('stream_chain', e)
+            return None
+        try:
+            with profiler.label('request GET_CHAIN_STREAM'):
+                s.sendall(namespaced(b"GET_CHAIN_STREAM refs", self.namespace))
+                return self._read_chain_stream(s.makefile('rb'), node, longer_than)
+        except Exception as e:
+            metrics.error('stream_chain', e)
+            # print(f"Error streaming chain from peer {node}: {e}")
+            return None
+        finally:
+            s.close()
+
+    def _read_chain_stream(self, stream, node, longer_than):
+        try:
+            length = load_untrusted(stream)
+        except EOFError:
+            # Older nodes close the connection on requests they don't know
+            length, chain = self.get_chain_from_peer(node)
+            if not chain or len(chain) <= longer_than:
+                return None
+            if not self.valid_chain(chain):
+                metrics.inc('dreamchain_invalid_chains_total')
+                return None
+            metrics.inc('dreamchain_blocks_validated_total', len(chain))
+            return chain
+        if length <= longer_than:
+            return None
+
+        # Same rules as valid_chain: pinned checkpoints must match, and
+        # validation starts from the highest one the chain reaches, with only
+        # the links checked below it
+        pinned = {height - 1: block_hash for height, block_hash in self.checkpoints.items()
+                  if height <= length}
+        start = max(pinned, default=0)
+        chain = []
+        last_block = [None]
+
+        def receive():
+            received = 0
+            while received < length:
+                batch = load_untrusted(stream)
+                if not batch:
+                    raise Abort()
+                yield received, batch
+                received += len(batch)
+
+        def decode(item):
+            # Fetches the payloads the batch refers to, and pairs it with the
+            # block before it, which the first block is checked against
+            first, batch = item
+            missing = self.payloads.missing(batch)
+            if missing:
+                self.get_payloads_from_peer(node, missing)
+            blocks = [block_from_dict(self.payloads.resolve_block(block)) for block in batch]
+            for index, block_hash in pinned.items():
+                if first <= index < first + len(blocks) and (
+                        blocks[index - first] is None or
+                        self.hash(blocks[index - first]) != block_hash):
+                    metrics.inc('dreamchain_invalid_chains_total')
+                    raise Abort()
+            before, last_block[0] = last_block[0], blocks[-1]
+            return first, blocks, before
+
+        def verify(item):
+            first, blocks, before = item
+            skip = max(start + 1 - first, 0)
+            if skip and not self._linked(blocks[:skip]):
+                metrics.inc('dreamchain_invalid_chains_total')
+                raise Abort()
+            fresh = blocks[skip:]
+            if fresh:
+                parent = blocks[skip - 1] if skip else before
+                if not validate_batch(self.consensus, parent, fresh) or \
+                        not self.verifier.verify_blocks(fresh, self.require_signatures):
+                    metrics.inc('dreamchain_invalid_chains_total')
+                    raise Abort()
+            return first + skip, blocks
+
+        def link(item):
+            # Batches arrive in order, so the chain so far ends where this one starts
+            position, blocks = item
+            first = len(chain)
+            chain.extend(blocks)
+            for index in {first, position}:
+                if 0 < index < len(chain) and \
+                        chain[index]['previous_hash'] != self.hash(chain[index - 1]):
+                    metrics.inc('dreamchain_invalid_chains_total')
+                    raise Abort()
+            metrics.inc('dreamchain_blocks_validated_total', max(len(chain) - position, 0))
+
+        pipeline = Pipeline('sync', [('decode', decode, 1), ('verify', verify, self.sync_workers),
+                                     ('link', link, 1)], self.sync_queue_size)
+        if pipeline.run(receive(), source_name='receive') is None:
+            return None
+        return chain
+
+    def get_snapshot_from_peer(self, node):
+        """
+        Retrieve a checkpoint snapshot from a peer node, or None if it has none.
+        """
+        try:
+            return self.request_from_peer(node, b"GET_SNAPSHOT")
+        except Exception as e:
+            metrics.error('get_snapshot', e)
+            # print(f"Error fetching snapshot from peer {node}: {e}")
+            return None
+
+    def get_bodies_from_peer(self, node, first, last):
+        """
+        Retrieve {block index: transactions} for a range of blocks from a peer.
+        """
+        try:
+            bodies = self.request_from_peer(node, f"GET_BODIES {first} {last}".encode())
+            return {index: [Transaction.from_dict(tx) for tx in transactions]
+                    for index, transactions in bodies.items()}
+        except Exception as e:
+            metrics.error('get_bodies', e)
+            # print(f"Error fetching bodies from peer {node}: {e}")
+            return {}
+
+    def get_payloads_from_peer(self, node, hashes):
+        """
+        Fetches payloads we don't hold by hash; returns how many were stored.
+        """
+        hashes = sorted(hashes)
+        stored = 0
+        for first in range(0, len(hashes), MAX_PAYLOADS):
+            message = f"GET_PAYLOADS {self.payloads.zdict_id} " + \
+                ' '.join(hashes[first:first + MAX_PAYLOADS])
+            try:
+                stored += self.payloads.load(self.request_from_peer(node, message.encode()))
+            except Exception as e:
+                metrics.error('get_payloads', e)
+                # print(f"Error fetching payloads from peer {node}: {e}")
+        return stored
+
+    def get_info_from_peer(self, node):
+        """
+        Ask a peer which block bodies it can serve.
+        """
+        try:
+            return self.request_from_peer(node, b"GET_INFO")
+        except Exception as e:
+            metrics.error('get_info', e)
+            # print(f"Error fetching info from peer {node}: {e}")
+            return None
+
+    def connect(self, node):
+        """
+        Opens a connection to a peer. If network conditions are set they
+        may delay or refuse it, to emulate latency, loss and partitions.
+        """
+        if self.network is not None:
+            self.network.before_connect(self.port, node)
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect(node)
+        except Exception:
+            s.close()
+            raise
+        return s
+
+    def request_from_peer(self, node, message):
+        """
+        Sends `message` to a peer and unpickles everything it sends back.
+        """
+        message_type = _message_type(message)
+        with profiler.label(f'request {message_type}'):
+            with metrics.span('dreamchain_peer_request', message=message_type):
+                s = self.connect(node)
+                try:
+                    s.sendall(namespaced(message, self.namespace))
+                    # Marks the end of requests read to the end (LONG_REQUESTS)
+                    s.shutdown(socket.SHUT_WR)
+
+                    # Use a loop to fetch the entire response
+                    data = b""
+                    while True:
+                        part = s.recv(4096)
+                        if not part:
+                            break
+                        data += part
+                finally:
+                    s.close()
+
+            metrics.observe('dreamchain_message_bytes', len(data), SIZE_BUCKETS,
+                            direction='in', message=message_type)
+            return loads_untrusted(data)
+
     def register_node(self, address):
-        self.nodes.add(address)
+        # Copy-on-write so that threads iterating over the old set are unaffected
+        with self.nodes_lock:
+            self.nodes = self.nodes | {address}
+
+    def announce(self, node, address):
+        """
+        Registers `address` (ours) with a peer, for this chain.
+        """
+        s = self.connect(node)
+        try:
+            s.sendall(namespaced(pickle.dumps(address), self.namespace))
+        finally:
+            s.close()
+
+    def features_of_peer(self, node):
+        """
+        The FEATURES a peer advertises, asked once and then cached. A peer
+        that answers GET_INFO with nothing we can read has none; one we
+        can't reach is asked again next time.
+        """
+        features = self.peer_features.get(node)
+        if features is not None:
+            return features
+        try:
+            info = self.request_from_peer(node, b"GET_INFO")
+            features = frozenset(info.get('features', ())) if isinstance(info, dict) \
+                else frozenset()
+        except OSError as e:
+            metrics.error('get_features', e)
+            return frozenset()
+        except Exception:
+            # Old nodes close the connection without a reply
+            features = frozenset()
+        self.peer_features[node] = features
+        return features
 
     def broadcast_block(self, block):
+        if self.relay is None or not self.compact_blocks:
+            for node in self.nodes:
+                self.send_block_to_peer(node, block)
+            return
+        compact = compact_block(block_from_dict(block), (get_ip(), self.port), self.relay.shared)
+        data = COMPACT_BLOCK + pickle.dumps(compact)
         for node in self.nodes:
-            self.send_block_to_peer(node, block)
+            if FEATURE_COMPACT in self.features_of_peer(node):
+                self._push(node, data, 'CMPCT')
+            else:
+                self.send_block_to_peer(node, block)
 
     def send_block_to_peer(self, node, block):
+        self._push(node, pickle.dumps(block_to_dict(block)), 'block')
+
+    def send_transactions_to_peer(self, node, transactions):
+        data = TRANSACTIONS + pickle.dumps([Transaction.from_dict(tx).to_dict()
+                                            for tx in transactions])
+        self._push(node, data, 'TXS')
+
+    def _push(self, node, data, message_type):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(node)
-            data = pickle.dumps(block)
-            s.send(data)
+            s = self.connect(node)
+            data = namespaced(data, self.namespace)
+            s.sendall(data)
             s.close()
+            metrics.observe('dreamchain_message_bytes', len(data), SIZE_BUCKETS,
+                            direction='out', message=message_type)
         except Exception as e:
-            pass
-            # print(f"Error sending block to peer {node}: {e}")
+            metrics.error(f'send_{message_type}', e)
+            # print(f"Error sending {message_type} to peer {node}: {e}")
 
+    def receive_block(self, block):
+        """
+        Handles a block pushed by a peer. If it doesn't extend our tip but
+        is ahead of it, we are behind the sender: resync.
+        """
+        if self.add_block(block):
+            metrics.inc('dreamchain_blocks_received_total', result='accepted')
+            return True
+        if block['index'] > len(self.chain):
+            metrics.inc('dreamchain_blocks_received_total', result='ahead')
+            self.resolve_conflicts()
+        else:
+            metrics.inc('dreamchain_blocks_received_total', result='rejected')
+        return False
 
-def handle_client(client_socket, blockchain):
-    request = client_socket.recv(4096)
-    
+    def receive_compact_block(self, compact):
+        """
+        Rebuilds a block announced in compact form from our pool, fetching
+        the transactions we lack from the announcer if it is one of our
+        peers, and handles it like a pushed block. A block we can't rebuild
+        makes us resync from our peers, at most every COMPACT_RESYNC_INTERVAL
+        seconds.
+        """
+        if compact['index'] <= len(self.chain):
+            metrics.inc('dreamchain_blocks_received_total', result='rejected')
+            return False
+        transactions, missing = rebuild(compact, list(self.transactions))
+        metrics.inc('dreamchain_compact_blocks_total', result='partial' if missing else 'complete')
+        metrics.observe('dreamchain_compact_missing', len(missing), SIZE_BUCKETS)
+        # The origin is whatever the sender wrote; never connect anywhere
+        # on its say-so that isn't a peer already
+        try:
+            origin = tuple(compact['origin'])
+            known = origin in self.nodes
+        except TypeError:
+            known = False
+        if not known:
+            metrics.inc('dreamchain_compact_blocks_total', result='unknown_origin')
+            origin = None
+        if missing:
+            fetched = None
+            if origin is not None:
+                fetched = self.get_block_transactions_from_peer(origin, compact, missing)
+            if fetched is None or len(fetched) != len(missing):
+                transactions = None
+            else:
+                for position, tx in zip(missing, fetched):
+                    transactions[position] = tx
+        block = assemble(compact, transactions) if transactions is not None else None
+        if block is None:
+            # A short ID collision or a failed fetch: get every transaction
+            metrics.inc('dreamchain_compact_blocks_total', result='fallback')
+            transactions = None
+            if origin is not None:
+                transactions = self.get_block_transactions_from_peer(origin, compact)
+            if transactions is not None:
+                block = assemble(compact, transactions)
+        if block is None:
+            metrics.inc('dreamchain_compact_blocks_total', result='failed')
+            now = monotonic()
+            with self.stats_lock:
+                resync = self.compact_resynced is None or \
+                    now - self.compact_resynced >= COMPACT_RESYNC_INTERVAL
+                if resync:
+                    self.compact_resynced = now
+            if resync:
+                self.resolve_conflicts()
+            return False
+        return self.receive_block(block)
+
+    def receive_transactions(self, transactions):
+        """
+        Handles transactions gossiped by a peer. Nodes that don't relay
+        transactions ignore them.
+        """
+        if self.relay is None:
+            return 0
+        return self.relay.receive(transactions)
+
+    def block_transactions(self, block_hash, positions=None):
+        """
+        The transactions (as dicts) of one of our last COMPACT_DEPTH blocks,
+        all of them or those at `positions`; None for a block we don't know.
+        """
+        chain = self.snapshot()
+        for block in reversed(chain[max(len(chain) - COMPACT_DEPTH, 0):]):
+            if block is not None and 'transactions' in block and self.hash(block) == block_hash:
+                transactions = block['transactions']
+                if positions is not None:
+                    transactions = [transactions[position] for position in positions
+                                    if 0 <= position < len(transactions)]
+                return [Transaction.from_dict(tx).to_dict() for tx in transactions]
+        return None
+
+    def get_block_transactions_from_peer(self, node, compact, positions=None):
+        """
+        Fetches transactions of a compact block from `node`, those at
+        `positions` or all of them. Returns None on failure.
+        """
+        wanted = 'all' if positions is None else ','.join(map(str, positions))
+        message = f"GET_BLOCK_TXS {compact['hash']} {wanted}".encode()
+        try:
+            transactions = self.request_from_peer(node, message)
+        except Exception as e:
+            metrics.error('get_block_transactions', e)
+            # print(f"Error fetching block transactions from peer: {e}")
+            return None
+        return transactions
+
+
+MAX_BODIES = 1000
+STREAM_BATCH = 500
+# How far below the tip GET_BLOCK_TXS looks for the block asked about
+COMPACT_DEPTH = 16
+# Seconds between resyncs caused by compact blocks we couldn't rebuild
+COMPACT_RESYNC_INTERVAL = 5.0
+# Pushes that carry a command word, unlike bare pickled blocks: compact
+# block announcements and gossiped transactions
+COMPACT_BLOCK = b"CMPCT "
+TRANSACTIONS = b"TXS "
+# Payload hashes per GET_PAYLOADS request, which bounds the response size
+MAX_PAYLOADS = 50
+
+def _message_type(request):
+    """
+    Label for a wire message: the command word of GET_* and SUBSCRIBE
+    requests and of CMPCT and TXS pushes, 'push' for pickled blocks and
+    node registrations.
+    """
+    request = split_namespace(request)[1]
+    if request.startswith(REQUEST_PREFIXES + (COMPACT_BLOCK, TRANSACTIONS)):
+        return request.split(b" ", 1)[0].decode()
+    return 'push'
+
+
+def stream_chain(blockchain, refs=False):
+    """
+    Yields the GET_CHAIN_STREAM response: the pickled chain length, then
+    the chain as pickled batches of STREAM_BATCH blocks, so neither end
+    ever holds the whole chain in serialized form. With `refs`, large
+    payloads are sent as references for the peer to fetch if it lacks them.
+    """
+    chain = blockchain.snapshot()
+    if blockchain.history_base:
+        chain = []
+    yield pickle.dumps(len(chain))
+    for first in range(0, len(chain), STREAM_BATCH):
+        blocks = [block_to_dict(blockchain.with_body(block))
+                  for block in chain[first:first + STREAM_BATCH]]
+        if refs:
+            for block in blocks:
+                blockchain.payloads.encode_block(block)
+        yield pickle.dumps(blocks)
+
+
+def handle_client(client_socket, blockchain, admission=None, chains=None):
+    """
+    Serves one connection. Messages prefixed with a chain name go to that
+    chain in `chains` ({name: DreamChain}), the rest to `blockchain`;
+    messages for a chain we don't host are dropped.
+    """
+    try:
+        if admission is not None:
+            client_socket.settimeout(admission.read_timeout)
+            request = read_message(client_socket, admission.max_message)
+        else:
+            request = read_message(client_socket)
+        namespace, request = split_namespace(request)
+        if namespace is not None:
+            blockchain = (chains or {}).get(namespace)
+            if blockchain is None:
+                metrics.inc('dreamchain_admission_rejected_total', reason='namespace')
+                return
+        message_type = _message_type(request)
+        metrics.inc('dreamchain_server_requests_total', message=message_type)
+        metrics.observe('dreamchain_message_bytes', len(request), SIZE_BUCKETS,
+                        direction='in', message=message_type)
+
+        if message_type == 'SUBSCRIBE':
+            # The subscription keeps the connection open and closes it itself
+            if blockchain.subscriptions.attach(client_socket, request):
+                client_socket = None
+            return
+
+        # Whole-chain serves are expensive; only a few run at once
+        limited = admission is not None and message_type in CHAIN_SERVES
+        if limited and not admission.start_chain_serve(client_socket.getpeername()[0]):
+            return
+        try:
+            _serve(client_socket, request, message_type, blockchain)
+        finally:
+            if limited:
+                admission.finish_chain_serve()
+    except Exception as e:
+        metrics.error('handle_client', e)
+    finally:
+        if client_socket is not None:
+            client_socket.close()
+
+
+def _serve(client_socket, request, message_type, blockchain):
+    with profiler.label(f'serve {message_type}'):
+        with metrics.span('dreamchain_server_request', message=message_type):
+            response = handle_request(request, blockchain)
+
+        if isinstance(response, bytes):
+            client_socket.sendall(response)
+            metrics.observe('dreamchain_message_bytes', len(response), SIZE_BUCKETS,
+                            direction='out', message=message_type)
+        elif response is not None:
+            # Streamed responses are sent part by part as they are built
+            sent = 0
+            for part in response:
+                client_socket.sendall(part)
+                sent += len(part)
+            metrics.observe('dreamchain_message_bytes', sent, SIZE_BUCKETS,
+                            direction='out', message=message_type)
+
+
+def handle_request(request, blockchain):
+    """
+    Handles one request and returns the response bytes, an iterable of
+    byte strings for streamed responses, or None if the message doesn't
+    expect a reply.
+    """
     if request == b"GET_CHAIN":
-        # Return the current length and chain to the requesting peer
-        response = pickle.dumps((len(blockchain.chain), blockchain.chain))
-        client_socket.send(response)
+        # Return the current length and chain to the requesting peer. A node
+        # still backfilling history has no complete chain to offer yet.
+        chain = blockchain.snapshot()
+        if blockchain.history_base:
+            chain = []
+        return pickle.dumps((len(chain), [block_to_dict(blockchain.with_body(block))
+                                          for block in chain]))
+    elif request in (b"GET_CHAIN_STREAM", b"GET_CHAIN_STREAM refs"):
+        # Stream the chain in batches instead of one large pickle
+        return stream_chain(blockchain, refs=request.endswith(b" refs"))
+    elif request.startswith(b"GET_PAYLOADS "):
+        # Return the requested payloads, compressed with the requester's
+        # preset dictionary if we share it
+        parts = request.decode().split()
+        return pickle.dumps(blockchain.payloads.export(parts[2:2 + MAX_PAYLOADS], parts[1]))
+    elif request == b"GET_SNAPSHOT":
+        # Return the latest checkpoint and the blocks after it
+        return pickle.dumps(make_snapshot(blockchain, blockchain.checkpoint_key))
+    elif request == b"GET_INFO":
+        # Advertise our height and which block bodies we can serve
+        return pickle.dumps(blockchain.info())
+    elif request.startswith(b"GET_BODIES "):
+        # Return the bodies we hold for a range of blocks, MAX_BODIES at a time
+        first, last = (int(value) for value in request.split()[1:3])
+        last = min(last, first + MAX_BODIES - 1)
+        bodies = blockchain.get_bodies(first, last)
+        return pickle.dumps({index: [dict(tx) for tx in transactions]
+                             for index, transactions in bodies.items()})
+    elif request.startswith(b"GET_BLOCK_TXS "):
+        # Return transactions of a recent block, for a peer rebuilding it
+        # from a compact announcement
+        _, block_hash, wanted = request.decode().split()[:3]
+        positions = None if wanted == 'all' else [int(value) for value in wanted.split(',')]
+        return pickle.dumps(blockchain.block_transactions(block_hash, positions))
+    elif request.startswith(b"GET_FILTERED "):
+        # Return headers from a height on, with the transactions matching a
+        # light client's Bloom filter and their Merkle proofs
+        _, first, bloom = request.split(b" ", 2)
+        return pickle.dumps(filtered_blocks(blockchain, BloomFilter.from_wire(bloom.strip()),
+                                            int(first)))
+    elif request.startswith(COMPACT_BLOCK):
+        try:
+            blockchain.receive_compact_block(loads_untrusted(request[len(COMPACT_BLOCK):]))
+        except Exception as e:
+            metrics.error('handle_compact_block', e)
+    elif request.startswith(TRANSACTIONS):
+        try:
+            blockchain.receive_transactions(loads_untrusted(request[len(TRANSACTIONS):]))
+        except Exception as e:
+            metrics.error('handle_transactions', e)
     elif request == b"GET_NODES":
         # Return the list of known nodes
-        response = pickle.dumps(list(blockchain.nodes))
-        client_socket.send(response)
+        return pickle.dumps(list(blockchain.nodes))
+    elif request == b"GET_STATS":
+        # Return process metrics and this node's state as Prometheus text
+        return metrics.render(blockchain.stats_gauges()).encode()
+    elif request == b"GET_PROFILE":
+        # Return the profiler's report (empty unless profiling was started)
+        return pickle.dumps(profiler.report())
     else:
         # Assume it's a new node sending its address or a block
         try:
-            data = pickle.loads(request)
+            data = loads_untrusted(request)
             if isinstance(data, tuple) and len(data) == 2:
                 # New node registering itself (expecting an address tuple like ('ip', port))
                 # print(f"Received new node: {data}")
                 blockchain.register_node(data)
             else:
                 # Assume it's a block being sent
-                blockchain.chain.append(data)
+                blockchain.receive_block(Block.from_dict(data))
                 # print(f"Received block {data['index']} from peer and added to the chain.")
         except Exception as e:
+            metrics.error('handle_push', e)
             # print(f"Error handling request: {e}")
-            pass
-    
-    client_socket.close()
+    return None
 
 
-def start_server(blockchain):
+def create_server(port, host='0.0.0.0', reuse_port=False):
+    """
+    Binds the listening socket. With `reuse_port`, other processes can bind
+    the same port (SO_REUSEPORT) and the kernel balances connections
+    between them.
+    """
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(('0.0.0.0', blockchain.port))
-    server.listen(5)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            server.close()
+            raise OSError('SO_REUSEPORT is not supported on this platform')
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind((host, port))
+    server.listen(128)
+    return server
+
+
+def start_server(blockchain, server=None, admission=None, chains=None):
+    """
+    Accepts peer connections and hands them to `admission`, which rate
+    limits peers and serves them from a bounded pool of worker threads.
+    `chains` is the {name: DreamChain} mapping of the named chains hosted
+    alongside `blockchain`, and may gain chains while serving.
+    """
+    if server is None:
+        server = create_server(blockchain.port)
+    if admission is None:
+        admission = AdmissionControl()
+
+    def handle(client):
+        handle_client(client, blockchain, admission, chains)
 
     while True:
-        client, addr = server.accept()
-        client_handler = Thread(target=handle_client, args=(client, blockchain))
-        client_handler.start()
+        try:
+            client, addr = server.accept()
+        except OSError:
+            # The listening socket was shut down by Node.stop()
+            break
+        admission.submit(client, addr, handle)
 
 class Node:
-    def __init__(self, port, master_node=None):
-        self.blockchain = DreamChain(port)
+    def __init__(self, port, master_node=None, checkpoints=None, checkpoint_key=None,
+                 prune_depth=None, archive_dir=None, payload_dir=None, admission=None,
+                 max_staleness=10.0, wal=None, read_workers=0, view_dir=None, read_limits=None,
+                 consensus=None, relay=True, merkle_roots=False):
+        """
+        `admission` (an AdmissionControl) sets the peer server's rate
+        limits, worker pool and message caps; the defaults suit one node
+        per host. get_chain() serves reads from local state that has been
+        synced with peers within the last `max_staleness` seconds. `wal`
+        makes the transaction pool durable (see DreamChain), and
+        `consensus` picks proof of work (the default) or proof of authority.
+        With `relay`, pool transactions are gossiped to peers and our
+        blocks announced in compact form (see relay.py). `merkle_roots`
+        makes our blocks provable to light clients (see DreamChain).
+
+        With `read_workers`, that many processes serve the port instead,
+        answering chain reads from a view published to `view_dir` and
+        forwarding everything else here (see readers.py); `read_limits`
+        are their AdmissionControl arguments. This process then only
+        serves the forwarded requests, from loopback, so `admission`
+        defaults to no per-peer limits.
+        """
+        self.blockchain = DreamChain(port, checkpoints, checkpoint_key, prune_depth, archive_dir,
+                                     payload_dir, wal, consensus, merkle_roots=merkle_roots)
         self.port = port
         self.master_node = master_node
-
-        # Start the server to accept incoming requests for this node
-        server_thread = Thread(target=start_server, args=(self.blockchain,))
+        self.miner = None
+        self.relay = relay
+        if relay:
+            self.blockchain.relay = TransactionRelay(self.blockchain)
+
+        # Named chains hosted next to the default one (add_chain), each with
+        # its own pool, storage, consensus, peers and miner
+        self.chains = {}
+        self.miners = {}
+        self.chains_lock = Lock()
+
+        # Bounded-staleness reads: when the last sync with peers started,
+        # the background sync thread, and the dict form of the chain as of
+        # the last read
+        self.max_staleness = max_staleness
+        self.last_synced = None
+        self.sync_lock = Lock()
+        self._sync_start_lock = Lock()
+        self._sync_thread = None
+        self._sync_stopped = Event()
+        self._chain_cache = (None, [])
+
+        # History backfill after starting from a snapshot, stopped with us
+        self._backfill = None
+        self._backfill_stopped = Event()
+
+        # Start the server to accept incoming requests for this node. The
+        # socket is bound here so peers can reach us as soon as we register.
+        self.readers = None
+        if read_workers:
+            from .readers import ReadWorkers
+
+            self.readers = ReadWorkers(self.blockchain, port, read_workers, view_dir,
+                                       limits=read_limits)
+            self.admission = admission or AdmissionControl(rate=None, max_connections=None)
+            self.server = self.readers.server
+        else:
+            self.admission = admission or AdmissionControl()
+            self.server = create_server(port)
+        server_thread = Thread(target=start_server,
+                               args=(self.blockchain, self.server, self.admission, self.chains))
         server_thread.start()
 
         if master_node:
             self.auto_register_with_master(master_node)
 
+    def stop(self):
+        """
+        Stops the background miner, the background sync and backfill, the
+        server thread and any read workers, then flushes and closes the transaction logs.
+        """
+        if self.miner is not None:
+            self.miner.stop()
+            self.miner = None
+        with self.chains_lock:
+            miners, self.miners = self.miners, {}
+        for miner in miners.values():
+            miner.stop()
+        for blockchain in [self.blockchain] + list(self.chains.values()):
+            if blockchain.relay is not None:
+                blockchain.relay.stop()
+                blockchain.relay = None
+        self.stop_sync()
+        self._backfill_stopped.set()
+        if self._backfill is not None:
+            self._backfill.join()
+            self._backfill = None
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+        self.admission.stop()
+        if self.readers is not None:
+            self.readers.stop()
+        for blockchain in [self.blockchain] + list(self.chains.values()):
+            if blockchain.wal is not None:
+                try:
+                    blockchain.wal.close()
+                except OSError as e:
+                    metrics.error('wal_close', e)
+
     def auto_register_with_master(self, master_node):
         """
         Connect to the master node, get a list of other nodes, and register with them.
         """
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(master_node)
-            s.send(b"GET_NODES")
-            response = s.recv(4096)
-            s.close()
-            nodes = pickle.loads(response)
+            nodes = self.blockchain.request_from_peer(master_node, b"GET_NODES")
             # print(f"Received nodes from master: {nodes}")
         except Exception as e:
+            metrics.error('get_nodes', e)
             # print(f"Error connecting to master node: {e}")
             return
 
-        # Register this node with the master
+        # Register this node with the master, with our actual IP address
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(master_node)
-            # Send this node's actual IP address to the master node for registration
-            s.send(pickle.dumps((get_ip(), self.port)))  # Now uses the actual IP address
-            s.close()
+            self.blockchain.announce(master_node, (get_ip(), self.port))
         except Exception as e:
+            metrics.error('register_with_master', e)
             # print(f"Error registering with master node: {e}")
             return
 
@@ -242,8 +1423,69 @@ class Node:
         # Finally, register with master node itself
         self.register_node(master_node)
 
-        # Step 3: Resolve conflicts and sync with the latest chain
-        self.resolve_conflicts()
+        # Step 3: Start from a trusted checkpoint snapshot if the master offers
+        # one, filling in older history in the background. Otherwise resolve
+        # conflicts and sync the full chain.
+        if self.bootstrap_from_snapshot(master_node):
+            self._backfill = start_backfill(self.blockchain, stopped=self._backfill_stopped)
+        else:
+            self.resolve_conflicts()
+
+    def bootstrap_from_snapshot(self, node):
+        """
+        Loads a checkpoint snapshot from `node` if it is pinned in our
+        checkpoints or signed with our checkpoint key. Returns False, so
+        that we sync the full chain instead, if it can't.
+        """
+        if not self.blockchain.checkpoints and not self.blockchain.checkpoint_key:
+            return False
+        snapshot = self.blockchain.get_snapshot_from_peer(node)
+        try:
+            return load_snapshot(self.blockchain, snapshot, self.blockchain.checkpoint_key)
+        except Exception as e:
+            metrics.error('load_snapshot', e)
+            return False
+
+    def add_chain(self, name, checkpoints=None, checkpoint_key=None, prune_depth=None,
+                  archive_dir=None, payload_dir=None, wal=None, consensus=None, merkle_roots=False):
+        """
+        Hosts a new, independent chain called `name` on this node's server.
+        Peers reach it by name, and only peers that joined it (join_chain)
+        sync with it or receive its blocks. Give each chain its own
+        directories. Returns the chain.
+        """
+        if not NAMESPACE_NAME.match(name):
+            raise ValueError(f'Invalid chain name {name!r}')
+        with self.chains_lock:
+            if name in self.chains:
+                raise ValueError(f'Chain {name!r} already exists')
+            blockchain = DreamChain(self.port, checkpoints, checkpoint_key, prune_depth,
+                                    archive_dir, payload_dir, wal, consensus, namespace=name,
+                                    merkle_roots=merkle_roots)
+            blockchain.network = self.blockchain.network
+            if self.relay:
+                blockchain.relay = TransactionRelay(blockchain)
+            self.chains[name] = blockchain
+        return blockchain
+
+    def chain(self, name=None):
+        """
+        The chain called `name`, or the default chain. Raises KeyError for a
+        chain we don't host.
+        """
+        if name is None:
+            return self.blockchain
+        return self.chains[name]
+
+    def join_chain(self, name, node):
+        """
+        Joins the chain `name` on peer `node`: each side registers the other
+        for that chain only, and we sync it from the peer.
+        """
+        blockchain = self.chain(name)
+        blockchain.announce(node, (get_ip(), self.port))
+        blockchain.register_node(node)
+        return blockchain.resolve_conflicts()
 
     def register_node(self, node_address):
         """
@@ -253,20 +1495,47 @@ class Node:
         # print(f"Registered with node {node_address}")
         # print(f"Current registered nodes: {self.blockchain.nodes}")
 
-    def add_transaction(self, sender, recipient, data):
+    def add_transaction(self, sender, recipient, data, signature=None):
         """
         Adds a transaction to the blockchain.
         """
-        self.blockchain.new_transaction(sender, recipient, data)
+        self.blockchain.new_transaction(sender, recipient, data, signature)
+
+    def start_miner(self, name=None):
+        """
+        Starts mining in the background whenever the pool has transactions,
+        on the chain `name` (the default chain if None).
+        """
+        if name is not None:
+            with self.chains_lock:
+                miner = self.miners.get(name)
+                if miner is None:
+                    miner = self.miners[name] = Miner(self.chain(name))
+                    miner.start()
+            return miner
+        if self.miner is None:
+            self.miner = Miner(self.blockchain)
+            self.miner.start()
+        return self.miner
+
+    def submit_transaction(self, sender, recipient, data, signature=None, name=None):
+        """
+        Adds a transaction to the chain `name` (the default chain if None)
+        and returns a Future resolved with the block that confirms it.
+        Starts that chain's background miner if it isn't running yet.
+        """
+        return self.start_miner(name).submit(sender, recipient, data, signature)
 
     def mine_block(self):
         """
-        Mines a block using proof of work and broadcasts the block to peers.
+        Mines a block (under proof of authority: waits for our slot and
+        signs one) and broadcasts the block to peers.
         """
-        last_proof = self.blockchain.last_block['proof']
-        proof = self.blockchain.proof_of_work(last_proof)
-        block = self.blockchain.new_block(proof)
-        
+        # Restart on the new tip whenever a peer's block beats us to it
+        block = None
+        while block is None:
+            block = self.blockchain.mine()
+
         # Broadcast the new block to all registered nodes
         # print(f"Broadcasting block {block['index']} to peers...")
         self.blockchain.broadcast_block(block)
@@ -275,22 +1544,93 @@ class Node:
         # Resolve conflicts to ensure the node's chain is up-to-date after mining
         self.resolve_conflicts()
 
-    def get_chain(self):
+    def get_chain(self, max_staleness=None, sync=False):
+        """
+        Returns the chain as plain dicts, from local state.
+
+        The chain is synced with peers first only if `sync` is set or the
+        last sync started more than `max_staleness` seconds ago (the node's
+        max_staleness by default). The first call also starts a background
+        sync that keeps reads within that bound without waiting on peers.
+        The dicts are shared between calls and must not be modified.
         """
-        Fetches the blockchain and ensures conflicts are resolved by syncing with peers.
+        if max_staleness is None:
+            max_staleness = self.max_staleness
+        self.start_sync()
+        if sync or self.staleness() > max_staleness:
+            # print("Resolving conflicts to sync with the latest chain from peers...")
+            self.resolve_conflicts()
+            metrics.inc('dreamchain_chain_reads_total', source='sync')
+        else:
+            metrics.inc('dreamchain_chain_reads_total', source='cache')
+        return list(self._chain_dicts())
+
+    def _chain_dicts(self):
+        # Blocks are only ever appended to a chain list; any other change
+        # swaps in a new list, so the cache is extended while the list is
+        # the same and rebuilt otherwise
+        snapshot = self.blockchain.snapshot()
+        blocks, dicts = self._chain_cache
+        if blocks is not snapshot._blocks or len(dicts) > len(snapshot):
+            blocks, dicts = snapshot._blocks, []
+        if len(dicts) < len(snapshot):
+            dicts = dicts + [block_to_dict(block) for block in snapshot[len(dicts):]]
+            self._chain_cache = (blocks, dicts)
+        return dicts
+
+    def staleness(self):
         """
-        # print("Resolving conflicts to sync with the latest chain from peers...")
-        self.resolve_conflicts()
-    
-        # Now return the local chain, which should be the latest after conflict resolution
-        return self.blockchain.chain
+        Seconds since the last sync with peers started (infinite if never).
+        """
+        if self.last_synced is None:
+            return float('inf')
+        return monotonic() - self.last_synced
+
+    def start_sync(self, interval=None):
+        """
+        Starts syncing with peers in the background every `interval`
+        seconds (half of max_staleness by default).
+        """
+        with self._sync_start_lock:
+            if self._sync_thread is not None:
+                return
+            if interval is None:
+                interval = self.max_staleness / 2
+            self._sync_stopped.clear()
+            self._sync_thread = Thread(target=self._sync_loop, args=(interval,), daemon=True)
+            self._sync_thread.start()
+
+    def stop_sync(self):
+        self._sync_stopped.set()
+        with self._sync_start_lock:
+            thread, self._sync_thread = self._sync_thread, None
+        if thread is not None:
+            thread.join()
+
+    def _sync_loop(self, interval):
+        while not self._sync_stopped.wait(max(interval - self.staleness(), 0.05)):
+            if self.staleness() >= interval:
+                try:
+                    self.resolve_conflicts()
+                    # Named chains are synced along, each with its own peers
+                    for blockchain in list(self.chains.values()):
+                        blockchain.resolve_conflicts()
+                except Exception as e:
+                    metrics.error('background_sync', e)
 
     def resolve_conflicts(self):
         """
         Resolves conflicts by applying the longest valid chain in the network.
         Fetches the chain from all peers and applies the longest one if valid.
+        Callers that arrive while a sync is running wait for it and then
+        start their own, unless another one started after they arrived.
         """
-        self.blockchain.resolve_conflicts()
+        requested = monotonic()
+        with self.sync_lock:
+            if self.last_synced is not None and self.last_synced >= requested:
+                return
+            self.last_synced = monotonic()
+            self.blockchain.resolve_conflicts()
         return
         # if self.blockchain.resolve_conflicts():
         #     print("Chain replaced with the longest one.")
@@ -0,0 +1,331 @@
+"""
+Light clients: block headers only, plus the transactions they care about.
+
+A light client doesn't download the chain. It hands full nodes a Bloom
+filter of the addresses it watches and gets back the block headers and,
+for each block, only the transactions whose sender or recipient match the
+filter, each with a Merkle proof against its block's header:
+
+    client = LightClient([('10.0.0.5', 5000)], addresses=['alice'])
+    client.sync()
+    for index, tx in client.transactions('alice'):
+        ...
+
+Headers are checked like a full node checks blocks (hash links, the hash
+itself and the consensus rules), so a peer can hide matching transactions
+but not invent them. What a client holds and downloads grows with the
+number of blocks and with its own transactions, not with everyone else's.
+Only blocks with a Merkle root (made by chains with merkle_roots=True)
+can be proven from their header; for a match in any other block the whole
+block is sent and hashed. Such headers can't be hashed themselves, so they
+rest on their links and the consensus rules alone, and are refused under
+rules that can't judge a header without its body (proof of authority
+signs the whole block of those).
+"""
+import hashlib
+import math
+import pickle
+import socket
+
+from .admission import loads_untrusted, namespaced
+from .blocks import (Block, BlockHeader, Transaction, merkle_proof, merkle_tree,
+                     verify_merkle_proof)
+from .consensus import ProofOfWork
+from .metrics import metrics, SIZE_BUCKETS
+
+# Filters are capped to bound what matching one costs a full node (BIP 37's
+# limits): about 15000 addresses at the default false positive rate
+MAX_FILTER_BYTES = 36000
+MAX_FILTER_HASHES = 50
+
+# Headers per GET_FILTERED response
+FILTERED_BATCH = 2000
+
+# Headers below our tip asked for again on every sync, so a reorg that
+# deep is noticed without starting over
+REORG_DEPTH = 16
+
+
+class BloomFilter:
+    """
+    A Bloom filter over strings (addresses): `size` bits set by `hashes`
+    hash functions, derived from one sha256 of the item and `tweak`. Never
+    misses an item added to it; other items match with the false positive
+    rate it was sized for, which hides from peers exactly what a client
+    watches.
+    """
+    def __init__(self, size, hashes, tweak=0, bits=None):
+        if not 0 < size <= MAX_FILTER_BYTES * 8 or not 0 < hashes <= MAX_FILTER_HASHES:
+            raise ValueError('Bloom filter too large')
+        self.size = size
+        self.hashes = hashes
+        self.tweak = tweak
+        self.bits = bytearray(bits) if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_items(cls, items, false_positive_rate=0.0001, tweak=0):
+        """
+        A filter holding `items`, sized for `false_positive_rate` (within
+        MAX_FILTER_BYTES).
+        """
+        items = list(items)
+        count = max(len(items), 1)
+        # Optimal size and number of hashes for `count` items
+        ln2 = 0.6931471805599453
+        size = int(-count * math.log(false_positive_rate) / (ln2 * ln2)) + 1
+        size = min(max(size, 8), MAX_FILTER_BYTES * 8)
+        hashes = min(max(int(size / count * ln2), 1), MAX_FILTER_HASHES)
+        bloom = cls(size, hashes, tweak)
+        for item in items:
+            bloom.add(item)
+        return bloom
+
+    def _positions(self, item):
+        digest = hashlib.sha256(f'{self.tweak}:{item}'.encode()).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:16], 'big') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+    def matches(self, transaction):
+        return transaction['sender'] in self or transaction['recipient'] in self
+
+    def to_wire(self):
+        return f'{self.size}:{self.hashes}:{self.tweak}:{self.bits.hex()}'.encode()
+
+    @classmethod
+    def from_wire(cls, data):
+        size, hashes, tweak, bits = data.decode().split(':')
+        bits = bytes.fromhex(bits)
+        if len(bits) != (int(size) + 7) // 8:
+            raise ValueError('Malformed Bloom filter')
+        return cls(int(size), int(hashes), int(tweak), bits)
+
+
+def filtered_blocks(blockchain, bloom, first, count=FILTERED_BATCH):
+    """
+    The GET_FILTERED response: the chain height, the headers of up to
+    `count` blocks from index `first` on (as tuples of BlockHeader's
+    arguments, to save the repeated keys), and for each of those blocks the
+    transactions matching `bloom` as {index: [(position, tx, proof)]}.
+    Matches in blocks without a Merkle root are sent as the block's whole
+    transaction list in 'blocks', and blocks whose body we no longer hold
+    are listed in 'missing'.
+    """
+    chain = blockchain.snapshot()
+    if blockchain.history_base:
+        # No complete chain to offer yet, as for GET_CHAIN
+        chain = []
+    last = min(len(chain), first + count - 1)
+    headers, matches, blocks, missing = [], {}, {}, []
+    for block in chain[max(first, 1) - 1:last]:
+        if 'transactions' in block:
+            transactions = block['transactions']
+            header = block.header()
+        else:
+            header = block
+            transactions = blockchain.archive.get(block['index']) \
+                if blockchain.archive is not None else None
+        headers.append((header.index, header.timestamp, header.proof, header.previous_hash,
+                        header.hash, header.merkle_root))
+        if transactions is None:
+            missing.append(header['index'])
+            continue
+        positions = [position for position, tx in enumerate(transactions) if bloom.matches(tx)]
+        if not positions:
+            continue
+        transactions = [Transaction.from_dict(tx) for tx in transactions]
+        if header.get('merkle_root') is None:
+            blocks[header['index']] = [tx.to_dict() for tx in transactions]
+            continue
+        levels = merkle_tree([tx.hash for tx in transactions])
+        matches[header['index']] = [(position, transactions[position].to_dict(),
+                                     merkle_proof(levels, position)) for position in positions]
+    metrics.inc('dreamchain_filtered_blocks_total', len(headers))
+    return {'height': len(chain), 'headers': headers, 'matches': matches, 'blocks': blocks,
+            'missing': missing}
+
+
+class LightClient:
+    """
+    Follows a chain through `peers` holding only its headers and the
+    transactions of `addresses`.
+
+    sync() asks every peer for the headers and matches past what we hold
+    (and the REORG_DEPTH headers below, to notice reorgs), checks them, and
+    adopts the longest valid chain it is offered, as a full node would.
+    `consensus` must be the chain's; `genesis_hash`, if given, pins the
+    chain followed. `namespace` picks one of a node's named chains.
+    """
+    def __init__(self, peers, addresses=(), false_positive_rate=0.0001, consensus=None,
+                 genesis_hash=None, namespace=None, timeout=30.0):
+        self.peers = list(peers)
+        self.addresses = frozenset(addresses)
+        self.bloom = BloomFilter.for_items(self.addresses, false_positive_rate)
+        self.consensus = consensus or ProofOfWork()
+        self.genesis_hash = genesis_hash
+        self.namespace = namespace
+        self.timeout = timeout
+        self.headers = []
+        # Block index -> [(position, transaction dict)] of our transactions
+        self.matches = {}
+        # Indices of blocks a peer had no body for, so they may hide matches
+        self.unchecked = set()
+        self.received_bytes = 0
+
+    @property
+    def height(self):
+        return len(self.headers)
+
+    def transactions(self, address=None):
+        """
+        The confirmed transactions of one watched address (or of all of
+        them) as (block index, transaction dict), oldest first.
+        """
+        return [(index, tx) for index in sorted(self.matches)
+                for position, tx in self.matches[index]
+                if address is None or address in (tx['sender'], tx['recipient'])]
+
+    def _request(self, peer, first):
+        message = b"GET_FILTERED %d " % first + self.bloom.to_wire()
+        s = socket.create_connection(peer, self.timeout)
+        try:
+            s.sendall(namespaced(message, self.namespace))
+            # GET_FILTERED is read to the end of what we send
+            s.shutdown(socket.SHUT_WR)
+            data = b""
+            while True:
+                part = s.recv(65536)
+                if not part:
+                    break
+                data += part
+        finally:
+            s.close()
+        self.received_bytes += len(data)
+        metrics.observe('dreamchain_message_bytes', len(data), SIZE_BUCKETS,
+                        direction='in', message='GET_FILTERED')
+        return loads_untrusted(data)
+
+    def _watched(self, transaction):
+        return transaction['sender'] in self.addresses or \
+            transaction['recipient'] in self.addresses
+
+    def _check(self, parent, response):
+        """
+        Checks a response's headers against `parent` (None for the genesis)
+        and its matches against the headers. Returns (headers, matches,
+        indices of blocks sent without a body) or None if anything doesn't
+        add up.
+        """
+        headers = [BlockHeader(*header) for header in response['headers']]
+        by_index = {}
+        for header in headers:
+            if not header.valid_hash():
+                return None
+            if parent is None:
+                if self.genesis_hash is not None and header.hash != self.genesis_hash:
+                    return None
+            elif header.previous_hash != parent.hash or header.index != parent.index + 1:
+                return None
+            elif not self.consensus.valid_block(parent, header):
+                return None
+            by_index[header.index] = parent = header
+
+        matches = {}
+        for index, found in response['matches'].items():
+            header = by_index.get(index)
+            if header is None or header.merkle_root is None:
+                return None
+            for position, tx, proof in found:
+                transaction_id = Transaction.from_dict(tx).hash
+                if not verify_merkle_proof(transaction_id, position, proof, header.merkle_root):
+                    return None
+                # The filter also matches other addresses now and then
+                if self._watched(tx):
+                    matches.setdefault(index, []).append((position, tx))
+        for index, transactions in response['blocks'].items():
+            header = by_index.get(index)
+            if header is None:
+                return None
+            block = Block(header.index, header.timestamp,
+                          [Transaction.from_dict(tx) for tx in transactions],
+                          header.proof, header.previous_hash)
+            if block.hash != header.hash:
+                return None
+            found = [(position, tx) for position, tx in enumerate(transactions)
+                     if self._watched(tx)]
+            if found:
+                matches[index] = found
+        return headers, matches, response['missing']
+
+    def _fetch(self, peer):
+        """
+        The peer's chain as (index of its first header, headers from there
+        on, matches in them, blocks among them sent without a body),
+        checked; None if the peer has nothing longer for us or sent
+        anything invalid.
+        """
+        first = max(1, len(self.headers) - REORG_DEPTH + 1)
+        headers, matches, missing = [], {}, []
+        while True:
+            response = self._request(peer, first + len(headers))
+            if response['height'] <= len(self.headers):
+                return None
+            if not headers and first > 1 and (
+                    not response['headers'] or
+                    response['headers'][0][4] != self.headers[first - 1].hash):
+                # Forked below our overlap, or a different chain: start over
+                first = 1
+                continue
+            parent = headers[-1] if headers else \
+                (self.headers[first - 2] if first > 1 else None)
+            checked = self._check(parent, response)
+            if checked is None:
+                metrics.inc('dreamchain_invalid_chains_total')
+                return None
+            headers.extend(checked[0])
+            matches.update(checked[1])
+            missing.extend(checked[2])
+            if not checked[0] or first + len(headers) > response['height']:
+                return first, headers, matches, missing
+
+    def sync(self):
+        """
+        Catches up with the longest valid chain among our peers. Returns
+        True if our chain changed.
+        """
+        changed = False
+        for peer in self.peers:
+            try:
+                fetched = self._fetch(peer)
+            except Exception as e:
+                metrics.error('light_sync', e)
+                # print(f"Error syncing headers from peer {peer}: {e}")
+                continue
+            if fetched is None:
+                continue
+            first, headers, matches, missing = fetched
+            if first - 1 + len(headers) <= len(self.headers):
+                continue
+            # What we knew from the first re-sent header up is replaced by the peer's
+            self.headers = self.headers[:first - 1] + headers
+            self.matches = {index: found for index, found in self.matches.items()
+                            if index < first}
+            self.matches.update(matches)
+            self.unchecked = {index for index in self.unchecked if index < first}
+            self.unchecked.update(missing)
+            changed = True
+        return changed
+
+    def state_size(self):
+        """
+        Bytes of pickled state: the headers and our own transactions.
+        """
+        return len(pickle.dumps((self.headers, self.matches)))
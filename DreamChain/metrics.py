@@ -0,0 +1,227 @@
+import os
+from bisect import bisect_left
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter, time
+
+# Default histogram buckets: seconds for timings, bytes for message sizes
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Span:
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics._finish_span(self, perf_counter() - self.started, exc_type)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Metrics:
+    """
+    Process-wide counters, gauges, histograms and timing spans.
+
+    Every recording method returns immediately when `enabled` is False, and
+    span() then hands back a shared no-op context manager, so leaving the
+    instrumentation in hot paths costs one attribute check.
+    """
+    def __init__(self, enabled=True, recent=256):
+        self.enabled = enabled
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # Most recent finished spans and errors, for ad-hoc tracing
+        self.recent_spans = deque(maxlen=recent)
+        self.recent_errors = deque(maxlen=recent)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def span(self, name, **labels):
+        """
+        Times a block of code into the `<name>_seconds` histogram:
+
+            with metrics.span('dreamchain_validate', kind='full'):
+                ...
+        """
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _Span(self, name, labels)
+
+    def _finish_span(self, span, seconds, exc_type):
+        self.observe(f'{span.name}_seconds', seconds, **span.labels)
+        with self.lock:
+            self.recent_spans.append((span.name, time() - seconds, seconds, span.labels,
+                                      exc_type.__name__ if exc_type else None))
+
+    def error(self, where, exc):
+        """
+        Counts an exception that was handled (and would otherwise be invisible).
+        """
+        if not self.enabled:
+            return
+        self.inc('dreamchain_errors_total', where=where, error=type(exc).__name__)
+        with self.lock:
+            self.recent_errors.append((time(), where, repr(exc)))
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+            self.recent_spans.clear()
+            self.recent_errors.clear()
+
+    def snapshot(self):
+        """
+        Returns all current values as plain dicts keyed by (name, labels).
+        """
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {key: {'buckets': h.buckets, 'counts': list(h.counts),
+                                     'sum': h.sum, 'count': h.count}
+                               for key, h in self.histograms.items()},
+            }
+
+    def render(self, extra_gauges=None):
+        """
+        Returns everything in the Prometheus text exposition format.
+        `extra_gauges` is an optional {(name, labels): value} mapping added
+        to the output, e.g. per-node state computed at scrape time.
+        """
+        snapshot = self.snapshot()
+        gauges = dict(snapshot['gauges'])
+        if extra_gauges:
+            gauges.update(extra_gauges)
+
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in sorted(snapshot['counters'].items()):
+            declare(name, 'counter')
+            lines.append(f'{name}{_labels(labels)} {value}')
+        for (name, labels), value in sorted(gauges.items()):
+            declare(name, 'gauge')
+            lines.append(f'{name}{_labels(labels)} {value}')
+        for (name, labels), histogram in sorted(snapshot['histograms'].items()):
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'] + ('+Inf',), histogram['counts']):
+                cumulative += count
+                bucket_labels = labels + (('le', str(bound)),)
+                lines.append(f'{name}_bucket{_labels(bucket_labels)} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {histogram["sum"]}')
+            lines.append(f'{name}_count{_labels(labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _label_value(value):
+    # The exposition format escapes backslashes, double quotes and newlines
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{_label_value(value)}"' for key, value in labels)
+    return '{' + pairs + '}'
+
+
+# Set DREAMCHAIN_METRICS=0 to start with instrumentation switched off
+metrics = Metrics(enabled=os.environ.get('DREAMCHAIN_METRICS', '1') != '0')
+
+
+def start_stats_server(port, blockchain=None, host='127.0.0.1'):
+    """
+    Serves the Prometheus text dump at http://host:port/metrics on a daemon
+    thread. Returns the server; call shutdown() on it to stop.
+    """
+    class StatsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            extra = blockchain.stats_gauges() if blockchain is not None else None
+            body = metrics.render(extra).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), StatsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
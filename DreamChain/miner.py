@@ -0,0 +1,133 @@
+from concurrent.futures import Future
+from threading import Thread, Condition, Event, Lock
+
+from .blocks import Transaction
+from .metrics import metrics
+
+# Seconds to wait before mining again after mining failed
+RETRY_INTERVAL = 1.0
+
+
+class Miner:
+    """
+    Background mining service for a DreamChain.
+
+    Mines continuously while the pool has transactions, restarting on the new
+    tip whenever another block lands first, and resolves the Future of every
+    submitted transaction once a block confirms it.
+
+    Confirmation is at depth 1: a Future resolves with the first block
+    that includes its transaction, and stays resolved if a reorg later
+    orphans that block (the transaction then goes back to the pool and is
+    mined again). If mining itself fails, say because this node may not
+    seal blocks, the pending Futures fail with the error.
+    """
+    def __init__(self, blockchain, broadcast=True):
+        self.blockchain = blockchain
+        self.broadcast = broadcast
+        self.blocks_mined = 0
+
+        self._wakeup = Condition()
+        self._abort = Event()
+        self._stopped = Event()
+        self._pending = {}
+        self._pending_lock = Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self.blockchain.add_listener(self._on_event)
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+            # Transactions replayed from the log are mined without waiting
+            # for a new one to arrive
+            with self._wakeup:
+                self._wakeup.notify()
+
+    def stop(self):
+        self._stopped.set()
+        self._abort.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.blockchain.remove_listener(self._on_event)
+
+    def submit(self, sender, recipient, data, signature=None):
+        """
+        Adds a transaction to the pool and returns a Future that resolves to
+        the block confirming it.
+        """
+        future = Future()
+        transaction_id = self.blockchain.transaction_id(
+            Transaction(sender, recipient, data, signature))
+        with self._pending_lock:
+            self._pending.setdefault(transaction_id, []).append(future)
+        try:
+            self.blockchain.new_transaction(sender, recipient, data, signature)
+        except Exception:
+            with self._pending_lock:
+                self._pending.pop(transaction_id, None)
+            raise
+        return future
+
+    def _on_event(self, event, payload):
+        if event == 'transaction':
+            with self._wakeup:
+                self._wakeup.notify()
+        elif event == 'block':
+            self._confirm([payload])
+        elif event == 'reorg':
+            fork, blocks = payload
+            self._confirm(blocks)
+            # Transactions of orphaned blocks are back in the pool
+            with self._wakeup:
+                self._wakeup.notify()
+
+    def _confirm(self, blocks):
+        with self._pending_lock:
+            if not self._pending:
+                return
+            resolved = []
+            for block in blocks:
+                for tx in block.get('transactions', []):
+                    for future in self._pending.pop(self.blockchain.transaction_id(tx), []):
+                        resolved.append((future, block))
+        for future, block in resolved:
+            future.set_result(block)
+
+    def _fail_pending(self, error):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for futures in pending.values():
+            for future in futures:
+                future.set_exception(error)
+
+    def _run(self):
+        blockchain = self.blockchain
+        while not self._stopped.is_set():
+            with self._wakeup:
+                while not blockchain.transactions and not self._stopped.is_set():
+                    self._wakeup.wait()
+            if self._stopped.is_set():
+                break
+
+            # None means the tip moved under us: rebuild on the new tip
+            try:
+                block = blockchain.mine(abort=self._abort)
+            except Exception as e:
+                metrics.error('miner', e)
+                # print(f"Error mining: {e}")
+                self._fail_pending(e)
+                self._stopped.wait(RETRY_INTERVAL)
+                continue
+            if block is None:
+                continue
+            self.blocks_mined += 1
+
+            if self.broadcast:
+                try:
+                    blockchain.broadcast_block(block)
+                except Exception as e:
+                    metrics.error('broadcast', e)
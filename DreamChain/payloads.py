@@ -0,0 +1,234 @@
+import hashlib
+import json
+import os
+import zlib
+from collections import OrderedDict
+from threading import Lock
+
+# A transaction whose large `data` was replaced by a reference carries
+# {'$payload': <sha256 of the canonical JSON>} in its place
+REF_KEY = '$payload'
+
+
+def encode_payload(data):
+    """
+    Returns (content hash, canonical JSON bytes) of a payload.
+    """
+    encoded = json.dumps(data, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest(), encoded
+
+
+def is_ref(data):
+    return isinstance(data, dict) and len(data) == 1 and REF_KEY in data
+
+
+def train_zdict(samples, size=32768):
+    """
+    Builds a zlib preset dictionary from sample payloads. zlib only looks at
+    the last 32KB of a dictionary and matches best near its end, so the most
+    common samples go last.
+    """
+    counts = {}
+    for data in samples:
+        encoded = encode_payload(data)[1]
+        counts[encoded] = counts.get(encoded, 0) + 1
+    zdict = b''
+    for encoded in sorted(counts, key=counts.get):
+        zdict += encoded
+    return zdict[-size:]
+
+
+class PayloadStore:
+    """
+    Content-addressed storage for large transaction payloads.
+
+    Payloads of at least `threshold` bytes of JSON are kept once per
+    distinct content: equal payloads in the pool and on the chain share one
+    object, and on the wire or in the archive they can be replaced by a
+    reference to their hash. With a `directory`, each payload is also
+    written there as one zlib-compressed file named after its hash, using
+    `zdict` as a shared preset dictionary when one is set, and only the
+    `cache_size` most recently used payloads stay in memory.
+    """
+    def __init__(self, directory=None, threshold=1024, zdict=None, level=6, cache_size=256):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.threshold = threshold
+        self.level = level
+        self.lock = Lock()
+        # Every payload, or with a directory an LRU cache of them
+        self.payloads = OrderedDict()
+        self.cache_size = cache_size if directory else None
+        # One reference object per payload, so a batch that repeats a
+        # reference pickles it once
+        self.refs = {}
+        self.set_zdict(zdict)
+
+    def set_zdict(self, zdict):
+        self.zdict = zdict or None
+        self.zdict_id = hashlib.sha256(zdict).hexdigest()[:16] if zdict else '-'
+
+    def compress(self, encoded, zdict=None):
+        if zdict:
+            compressor = zlib.compressobj(self.level, zdict=zdict)
+        else:
+            compressor = zlib.compressobj(self.level)
+        return compressor.compress(encoded) + compressor.flush()
+
+    @staticmethod
+    def decompress(compressed, zdict=None):
+        decompressor = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+        return decompressor.decompress(compressed) + decompressor.flush()
+
+    def _path(self, payload_hash):
+        return os.path.join(self.directory, f'{payload_hash}.z')
+
+    def _cache(self, payload_hash, data):
+        # Called with the lock held; returns the copy we keep
+        stored = self.payloads.setdefault(payload_hash, data)
+        if payload_hash not in self.refs:
+            self.refs[payload_hash] = {REF_KEY: payload_hash}
+        if self.cache_size is not None:
+            self.payloads.move_to_end(payload_hash)
+            while len(self.payloads) > self.cache_size:
+                evicted, _ = self.payloads.popitem(last=False)
+                self.refs.pop(evicted, None)
+        return stored
+
+    def _ref(self, payload_hash):
+        with self.lock:
+            return self.refs.setdefault(payload_hash, {REF_KEY: payload_hash})
+
+    def _store(self, payload_hash, data, encoded):
+        with self.lock:
+            stored = self._cache(payload_hash, data)
+        if stored is data and self.directory and not os.path.exists(self._path(payload_hash)):
+            # The file starts with the id of the dictionary it needs
+            tmp_path = self._path(payload_hash) + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self.zdict_id.encode().ljust(16) + self.compress(encoded, self.zdict))
+            os.replace(tmp_path, self._path(payload_hash))
+        return stored
+
+    def put(self, data):
+        """
+        Stores `data` if it is large. Returns (hash, shared object), or
+        (None, data) for small payloads.
+        """
+        if data is None or isinstance(data, (int, float, bool)):
+            return None, data
+        payload_hash, encoded = encode_payload(data)
+        if len(encoded) < self.threshold:
+            return None, data
+        return payload_hash, self._store(payload_hash, data, encoded)
+
+    def intern(self, data):
+        """
+        Returns the shared copy of a large payload (or `data` itself).
+        """
+        return self.put(data)[1]
+
+    def get(self, payload_hash):
+        """
+        Returns the payload with this hash, from memory or disk, or None.
+        """
+        with self.lock:
+            data = self.payloads.get(payload_hash)
+            if data is not None and self.cache_size is not None:
+                self.payloads.move_to_end(payload_hash)
+        if data is not None or not self.directory:
+            return data
+        try:
+            with open(self._path(payload_hash), 'rb') as f:
+                header, compressed = f.read(16), f.read()
+        except FileNotFoundError:
+            return None
+        zdict = self.zdict if header.strip() == self.zdict_id.encode() else None
+        if header.strip() != b'-' and zdict is None:
+            return None
+        data = json.loads(self.decompress(compressed, zdict))
+        with self.lock:
+            return self._cache(payload_hash, data)
+
+    def __contains__(self, payload_hash):
+        return self.get(payload_hash) is not None
+
+    def encode_transactions(self, transactions):
+        """
+        Dict forms of `transactions` with large payloads replaced by references.
+        """
+        encoded = []
+        for tx in transactions:
+            payload_hash, data = self.put(tx['data'])
+            if payload_hash is not None:
+                tx = dict(tx)
+                tx['data'] = self._ref(payload_hash)
+            elif not isinstance(tx, dict):
+                tx = dict(tx)
+            encoded.append(tx)
+        return encoded
+
+    def encode_block(self, block):
+        """
+        Replaces large payloads in a block dict by references, in place.
+        """
+        if block is not None and 'transactions' in block:
+            block['transactions'] = self.encode_transactions(block['transactions'])
+        return block
+
+    def missing(self, blocks):
+        """
+        Hashes referenced by the given block dicts that we don't hold.
+        """
+        return {tx['data'][REF_KEY] for block in blocks if block is not None
+                for tx in block.get('transactions', ())
+                if is_ref(tx['data']) and tx['data'][REF_KEY] not in self}
+
+    def resolve_transactions(self, transactions):
+        """
+        Replaces references with the payloads they point to, in place.
+        Raises KeyError for a payload we don't hold.
+        """
+        for tx in transactions:
+            if is_ref(tx['data']):
+                data = self.get(tx['data'][REF_KEY])
+                if data is None:
+                    raise KeyError(tx['data'][REF_KEY])
+                tx['data'] = data
+        return transactions
+
+    def resolve_block(self, block):
+        if block is not None and 'transactions' in block:
+            self.resolve_transactions(block['transactions'])
+        return block
+
+    def export(self, hashes, zdict_id='-'):
+        """
+        The GET_PAYLOADS response: {hash: compressed JSON}, compressed with
+        our preset dictionary if the requester has the same one.
+        """
+        zdict = self.zdict if zdict_id == self.zdict_id else None
+        exported = {}
+        for payload_hash in hashes:
+            data = self.get(payload_hash)
+            if data is not None:
+                exported[payload_hash] = self.compress(encode_payload(data)[1], zdict)
+        return {'zdict': self.zdict_id if zdict else '-', 'payloads': exported}
+
+    def load(self, response):
+        """
+        Stores the payloads of a GET_PAYLOADS response, skipping any whose
+        content doesn't match its hash. Returns the number stored.
+        """
+        zdict = self.zdict if response['zdict'] == self.zdict_id else None
+        if response['zdict'] != '-' and zdict is None:
+            return 0
+        stored = 0
+        for payload_hash, compressed in response['payloads'].items():
+            encoded = self.decompress(compressed, zdict)
+            if hashlib.sha256(encoded).hexdigest() != payload_hash:
+                continue
+            self._store(payload_hash, json.loads(encoded), encoded)
+            stored += 1
+        return stored
@@ -0,0 +1,165 @@
+"""
+Staged processing with bounded queues between the stages.
+
+A Pipeline pulls items from a source on one thread and passes them
+through its stages, each served by its own threads, so that waiting on
+the network in one stage overlaps with work in the others:
+
+    pipeline = Pipeline('sync', [('decode', decode, 1), ('verify', verify, 2),
+                                 ('link', link, 1)])
+    results = pipeline.run(batches, source_name='receive')
+
+Queues hold at most `queue_size` items, so a fast stage waits for a slow
+one instead of buffering everything. Single-worker stages see their items
+in source order; items leaving a multi-worker stage are put back in order
+by whichever stage reads them. Per stage, the queue depth is exposed as the
+dreamchain_pipeline_queue_depth gauge, and the time items wait in the
+queue and the time the stage takes as histograms.
+"""
+import heapq
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from time import perf_counter
+
+from .metrics import metrics
+
+# Seconds between checks for a stopped pipeline while blocked on a queue
+_POLL = 0.1
+
+_DONE = object()
+
+
+class Abort(Exception):
+    """
+    Raised by a stage to stop the pipeline; run() then returns None.
+    """
+
+
+class Pipeline:
+    """
+    `stages` are (name, function, workers) triples. Each function takes
+    the item the previous stage returned and returns the item for the
+    next; the last stage's results are what run() returns. The first
+    exception raised stops every stage.
+    """
+    def __init__(self, name, stages, queue_size=4):
+        self.name = name
+        self.stages = list(stages)
+        self.queue_size = queue_size
+
+    def run(self, source, source_name='source'):
+        """
+        Runs every item of `source` through the stages and returns the
+        results in source order, or None if a stage raised Abort.
+        """
+        queues = [Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        stopped = Event()
+        errors = []
+
+        def fail(e):
+            errors.append(e)
+            stopped.set()
+
+        threads = [Thread(target=self._produce, args=(source, source_name, queues[0], stopped,
+                                                      fail), daemon=True)]
+        names = [stage[0] for stage in self.stages] + ['results']
+        for position, (name, fn, workers) in enumerate(self.stages):
+            # Workers left in the stage; the last one to finish passes the end on
+            remaining = [workers, Lock()]
+            for _ in range(workers):
+                threads.append(Thread(target=self._work,
+                                      args=(name, fn, workers == 1, queues[position],
+                                            queues[position + 1], names[position + 1], stopped,
+                                            fail, remaining),
+                                      daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            results = [item for seq, finished, item in
+                       self._drain(queues[-1], 'results', True, stopped)]
+        finally:
+            stopped.set()
+            for thread in threads:
+                thread.join()
+        if errors:
+            if isinstance(errors[0], Abort):
+                return None
+            raise errors[0]
+        return results
+
+    def _put(self, queue, entry, stage, stopped):
+        while not stopped.is_set():
+            try:
+                queue.put(entry, timeout=_POLL)
+                metrics.set('dreamchain_pipeline_queue_depth', queue.qsize(),
+                            pipeline=self.name, stage=stage)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _drain(self, queue, stage, ordered, stopped):
+        """
+        Yields the items put on `queue` until the end marker, in source
+        order if `ordered`.
+        """
+        pending = []
+        expected = 0
+        while not stopped.is_set():
+            try:
+                entry = queue.get(timeout=_POLL)
+            except Empty:
+                continue
+            if entry is _DONE:
+                # Let the stage's other workers see the end too
+                queue.put(entry)
+                return
+            metrics.set('dreamchain_pipeline_queue_depth', queue.qsize(),
+                        pipeline=self.name, stage=stage)
+            if not ordered:
+                yield entry
+                continue
+            heapq.heappush(pending, entry)
+            while pending and pending[0][0] == expected:
+                yield heapq.heappop(pending)
+                expected += 1
+
+    def _produce(self, source, name, queue, stopped, fail):
+        try:
+            iterator = iter(source)
+            seq = 0
+            while not stopped.is_set():
+                started = perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                metrics.observe('dreamchain_pipeline_stage_seconds', perf_counter() - started,
+                                pipeline=self.name, stage=name)
+                if not self._put(queue, (seq, perf_counter(), item), self.stages[0][0], stopped):
+                    return
+                seq += 1
+            self._put(queue, _DONE, self.stages[0][0], stopped)
+        except Exception as e:
+            fail(e)
+
+    def _work(self, name, fn, ordered, inbox, outbox, following, stopped, fail, remaining):
+        try:
+            for seq, queued, item in self._drain(inbox, name, ordered, stopped):
+                started = perf_counter()
+                metrics.observe('dreamchain_pipeline_wait_seconds', started - queued,
+                                pipeline=self.name, stage=name)
+                result = fn(item)
+                finished = perf_counter()
+                metrics.observe('dreamchain_pipeline_stage_seconds', finished - started,
+                                pipeline=self.name, stage=name)
+                if not self._put(outbox, (seq, finished, result), following, stopped):
+                    return
+        except Exception as e:
+            fail(e)
+            return
+        with remaining[1]:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            self._put(outbox, _DONE, following, stopped)
@@ -0,0 +1,311 @@
+"""
+Opt-in sampling profiler for DreamChain nodes.
+
+    from DreamChain.profiling import profiler
+    profiler.start(allocations=True)
+    ...
+    profiler.stop()
+    profiler.write('node-8000')      # node-8000.collapsed and node-8000.json
+
+Or set DREAMCHAIN_PROFILE=<prefix> to profile the whole process and write
+the files at exit. A running node also answers GET_PROFILE with the current
+report.
+
+A background thread samples the stack of every thread. Samples are counted
+per function (self and total) and per activity label. Labels are set by
+the node's hot paths: 'serve GET_CHAIN', 'request GET_CHAIN', 'mine',
+'sync' and so on. The raw stacks come out in the collapsed format that
+flamegraph.pl and speedscope read. Time spent waiting for the chain and pool
+locks is measured directly. How late the sampler wakes up gives an estimate
+of GIL contention.
+"""
+import atexit
+import json
+import os
+import sys
+import tracemalloc
+from threading import Event, Lock, Thread, get_ident
+from time import perf_counter
+
+# Innermost frames of threads that are parked rather than working, e.g. a
+# server blocked in accept() or a miner waiting for transactions. Their
+# samples are counted as idle and left out of the breakdowns.
+IDLE_FUNCTIONS = {
+    'python3/socket.py:accept',
+    'python3/threading.py:wait',
+    'python3/selectors.py:select',
+}
+
+class _Label:
+    __slots__ = ('profiler', 'name', 'previous')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        labels = self.profiler.labels
+        ident = get_ident()
+        self.previous = labels.get(ident)
+        labels[ident] = self.name
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        labels = self.profiler.labels
+        if self.previous is None:
+            labels.pop(get_ident(), None)
+        else:
+            labels[get_ident()] = self.previous
+        return False
+
+
+class _NoopLabel:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_LABEL = _NoopLabel()
+
+
+class ProfiledLock:
+    """
+    Wraps a Lock or RLock and, while the profiler runs, records how long
+    acquirers had to wait for it. An uncontended acquire costs one extra
+    non-blocking attempt.
+    """
+    __slots__ = ('_lock', 'name')
+
+    def __init__(self, lock, name):
+        self._lock = lock
+        self.name = name
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        if not profiler.running:
+            return self._lock.acquire(True, timeout)
+        started = perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        profiler.lock_wait(self.name, perf_counter() - started)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._lock.release()
+        return False
+
+
+class Profiler:
+    """
+    Samples every thread's stack each `interval` seconds while running.
+    label() and lock_wait() return immediately when it is stopped.
+    """
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.running = False
+        self.lock = Lock()
+        self.labels = {}
+        self._stopped = Event()
+        self._thread = None
+        self._allocations = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = 0
+            self.idle_samples = 0
+            self.stacks = {}
+            self.self_counts = {}
+            self.total_counts = {}
+            self.label_counts = {}
+            self.lock_waits = {}
+            self.lateness = 0.0
+            self.ticks = 0
+            self.elapsed = 0.0
+
+    def start(self, allocations=False, frames=16):
+        """
+        Starts sampling. With `allocations`, tracemalloc records where memory
+        is allocated from now on.
+        """
+        if self.running:
+            return
+        if allocations:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self._allocations = tracemalloc.take_snapshot()
+        self.running = True
+        self._stopped.clear()
+        self._thread = Thread(target=self._run, name='dreamchain-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def label(self, name):
+        """
+        Attributes samples taken inside the block to `name`:
+
+            with profiler.label('serve GET_CHAIN'):
+                ...
+        """
+        if not self.running:
+            return _NOOP_LABEL
+        return _Label(self, name)
+
+    def lock_wait(self, name, seconds):
+        with self.lock:
+            waits = self.lock_waits.get(name)
+            if waits is None:
+                waits = self.lock_waits[name] = [0, 0.0, 0.0]
+            waits[0] += 1
+            waits[1] += seconds
+            waits[2] = max(waits[2], seconds)
+
+    def _run(self):
+        own = get_ident()
+        started = last = perf_counter()
+        while not self._stopped.wait(self.interval):
+            now = perf_counter()
+            # The sampler wakes late when other threads hold the GIL
+            lateness = max(0.0, now - last - self.interval)
+            self._sample(own, lateness)
+            last = perf_counter()
+        with self.lock:
+            self.elapsed += perf_counter() - started
+
+    def _sample(self, own, lateness):
+        frames = sys._current_frames()
+        stacks = []
+        for ident, frame in frames.items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f'{_module(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            stack.reverse()
+            stacks.append((self.labels.get(ident, 'other'), tuple(stack)))
+        del frames
+
+        with self.lock:
+            self.ticks += 1
+            self.lateness += lateness
+            for label, stack in stacks:
+                if stack and _idle_name(stack[-1]) in IDLE_FUNCTIONS:
+                    self.idle_samples += 1
+                    continue
+                self.samples += 1
+                key = (label,) + stack
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.label_counts[label] = self.label_counts.get(label, 0) + 1
+                if stack:
+                    self.self_counts[stack[-1]] = self.self_counts.get(stack[-1], 0) + 1
+                for function in set(stack):
+                    self.total_counts[function] = self.total_counts.get(function, 0) + 1
+
+    def collapsed(self):
+        """
+        Returns the samples in the collapsed-stack format, one
+        `label;outer;...;inner count` line per distinct stack.
+        """
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+        return ''.join(f'{";".join(key)} {count}\n' for key, count in stacks)
+
+    def allocations(self, limit=25):
+        """
+        Top allocation sites since start(), as (location, bytes, blocks).
+        """
+        if self._allocations is None or not tracemalloc.is_tracing():
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        stats = snapshot.compare_to(self._allocations, 'lineno')
+        return [(f'{_module(stat.traceback[0].filename)}:{stat.traceback[0].lineno}',
+                 stat.size_diff, stat.count_diff)
+                for stat in stats[:limit] if stat.size_diff > 0]
+
+    def report(self, limit=25):
+        """
+        Summary of everything collected so far, as a JSON-friendly dict.
+        """
+        with self.lock:
+            samples = self.samples or 1
+            functions = sorted(self.total_counts, key=self.total_counts.get, reverse=True)
+            result = {
+                'samples': self.samples,
+                'idle_samples': self.idle_samples,
+                'interval_seconds': self.interval,
+                'elapsed_seconds': self.elapsed,
+                'functions': [{
+                    'function': function,
+                    'self': self.self_counts.get(function, 0) / samples,
+                    'total': self.total_counts[function] / samples,
+                } for function in functions[:limit]],
+                'labels': {label: count / samples
+                           for label, count in sorted(self.label_counts.items())},
+                'lock_waits': {name: {'count': count, 'seconds': seconds, 'max_seconds': longest}
+                               for name, (count, seconds, longest) in self.lock_waits.items()},
+                'gil_lateness_seconds': self.lateness / self.ticks if self.ticks else 0.0,
+            }
+        result['allocations'] = [{'location': location, 'bytes': size, 'blocks': count}
+                                 for location, size, count in self.allocations(limit)]
+        return result
+
+    def write(self, prefix):
+        """
+        Writes <prefix>.collapsed and <prefix>.json.
+        """
+        with open(prefix + '.collapsed', 'w') as f:
+            f.write(self.collapsed())
+        with open(prefix + '.json', 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def _module(filename):
+    # Short, stable names: 'DreamChain/dreamchain.py' rather than a full path
+    parts = filename.replace('\\', '/').rsplit('/', 2)
+    return '/'.join(parts[-2:])
+
+
+def _idle_name(function):
+    # 'python3.11/socket.py:accept' -> 'python3/socket.py:accept'
+    if function.startswith('python3.'):
+        return 'python3' + function[function.index('/'):]
+    return function
+
+
+profiler = Profiler()
+
+# Set DREAMCHAIN_PROFILE=<prefix> to profile the whole process
+if os.environ.get('DREAMCHAIN_PROFILE'):
+    def _write_at_exit(prefix=os.environ['DREAMCHAIN_PROFILE']):
+        profiler.stop()
+        profiler.write(prefix)
+
+    profiler.start(allocations=os.environ.get('DREAMCHAIN_PROFILE_ALLOCATIONS') == '1')
+    atexit.register(_write_at_exit)
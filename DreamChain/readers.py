@@ -0,0 +1,541 @@
+"""
+Multi-process read serving.
+
+A node started with read workers keeps mining, validation and every chain
+update in its own process (the writer) and leaves the public port to
+worker processes that share it with SO_REUSEPORT, so the kernel spreads
+incoming connections across them:
+
+    node = Node(5000, read_workers=4)
+
+The writer publishes a view of the chain to files whenever its tip, its
+history or its peer list changes: the ready-made responses to the read
+requests in VIEW_REQUESTS. Workers map those files and answer those
+requests by sending slices of them, without holding a chain or touching the
+writer. Everything else (pushed blocks and registrations, SUBSCRIBE, the
+other GET_* requests) is forwarded to the writer over loopback and the
+reply relayed back.
+
+Reads from the view lag the writer by at most the time it takes to
+publish one; a worker picks up a new view on its next request.
+"""
+import argparse
+import io
+import json
+import mmap
+import os
+import pickle
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+from threading import Event, Lock, Thread
+
+from .admission import AdmissionControl, CHAIN_SERVES, read_message
+from .blocks import block_to_dict
+from .dreamchain import STREAM_BATCH, create_server, handle_request, _message_type
+from .metrics import metrics
+
+# Requests answered from the published view. Syncing nodes ask for the
+# stream with payload references; older ones for the plain stream.
+VIEW_REQUESTS = (b"GET_CHAIN", b"GET_CHAIN_STREAM", b"GET_CHAIN_STREAM refs", b"GET_INFO",
+                 b"GET_NODES")
+
+# Seconds a worker waits on the writer for a forwarded request
+FORWARD_TIMEOUT = 60.0
+
+# View: an index file, rewritten whole on every publish, and data files of
+# pickled blocks that are only ever appended to. The index file holds the
+# length of its JSON index, the index, then the small responses (GET_INFO,
+# GET_NODES and the framing around blocks). The index names the data files
+# and maps each request to the [file, offset, length] spans its response is
+# sent as, file '' being the index file's own small responses.
+_INDEX = struct.Struct('>Q')
+
+# Blocks are stored as pickle fragments: their protocol 2 opcodes without
+# the header and STOP, so responses are spliced together from the stored
+# blocks rather than pickling the chain again on every publish
+_PROTO = b'\x80\x02'
+_LIST_START = b']('      # EMPTY_LIST, MARK
+_LIST_END = b'e'         # APPENDS
+_TUPLE2 = b'\x86'
+_STOP = b'.'
+
+# Bytes of replaced blocks a data file may hold before it is rewritten
+COMPACT_MIN_BYTES = 1 << 20
+
+
+def _fragment(obj):
+    buffer = io.BytesIO()
+    pickler = pickle.Pickler(buffer, 2)
+    # No memo, so fragments never refer to one another
+    pickler.fast = True
+    pickler.dump(obj)
+    return buffer.getvalue()[len(_PROTO):-len(_STOP)]
+
+
+class BlockFile:
+    """
+    The writer's append-only file of block fragments. Blocks replaced by a
+    reorg stay behind as garbage and their successors are appended at the
+    end, so the chain is stored as a few runs of contiguous blocks (`runs`
+    lists the first block of each). Once it is more garbage than blocks the
+    file is rewritten as a new generation, leaving workers' mappings of the
+    old one intact.
+    """
+    def __init__(self, base):
+        self.base = base
+        self.generation = 0
+        self.starts = []
+        self.ends = []
+        self.runs = []
+        self.size = 0
+        self.garbage = 0
+        self.file = open(self.path, 'wb')
+
+    @property
+    def path(self):
+        return f'{self.base}.{self.generation}'
+
+    def __len__(self):
+        return len(self.starts)
+
+    def truncate(self, length):
+        """
+        Forgets the blocks from `length` on; their bytes become garbage.
+        """
+        if length >= len(self.starts):
+            return
+        self.garbage += sum(self.ends[i] - self.starts[i] for i in range(length, len(self.starts)))
+        del self.starts[length:], self.ends[length:]
+        while self.runs and self.runs[-1] >= length:
+            self.runs.pop()
+
+    def extend(self, fragments):
+        for fragment in fragments:
+            if not self.ends or self.ends[-1] != self.size:
+                self.runs.append(len(self.starts))
+            self.starts.append(self.size)
+            self.file.write(fragment)
+            self.size += len(fragment)
+            self.ends.append(self.size)
+        self.file.flush()
+        if self.garbage > COMPACT_MIN_BYTES and self.garbage > self.size - self.garbage:
+            self._compact()
+
+    def spans(self, first, last):
+        """
+        The (offset, length) spans holding blocks [first, last).
+        """
+        spans = []
+        limits = self.runs[1:] + [len(self.starts)]
+        for run, limit in zip(self.runs, limits):
+            low, high = max(first, run), min(last, limit)
+            if low < high:
+                spans.append((self.starts[low], self.ends[high - 1] - self.starts[low]))
+        return spans
+
+    def _compact(self):
+        old_path = self.path
+        starts, ends = [], []
+        with open(old_path, 'rb') as old:
+            self.generation += 1
+            with open(self.path, 'wb') as new:
+                for offset, length in self.spans(0, len(self.starts)):
+                    old.seek(offset)
+                    new.write(old.read(length))
+        shift = 0
+        previous_end = 0
+        for start, end in zip(self.starts, self.ends):
+            if start != previous_end:
+                shift += start - previous_end
+            starts.append(start - shift)
+            ends.append(end - shift)
+            previous_end = end
+        self.file.close()
+        self.file = open(self.path, 'ab')
+        self.starts, self.ends = starts, ends
+        self.runs = [0] if starts else []
+        self.size = ends[-1] if ends else 0
+        self.garbage = 0
+        # Workers may still be switching from the previous generation
+        try:
+            os.remove(f'{self.base}.{self.generation - 2}')
+        except FileNotFoundError:
+            pass
+        metrics.inc('dreamchain_view_compactions_total')
+
+    def close(self):
+        self.file.close()
+
+
+class ChainView:
+    """
+    A worker's read-only view: the index, reread when the writer replaces
+    it, and mappings of the data files it names, remapped as they grow.
+    Responses are memoryviews into the mappings, so they are shared with
+    the page cache rather than copied into each worker.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.lock = Lock()
+        self.identity = None
+        self.index = {}
+        self.mappings = {}
+
+    def _map(self, name, needed):
+        mapping = self.mappings.get(name)
+        if mapping is not None and len(mapping) >= needed:
+            return mapping
+        if not needed:
+            return memoryview(b'')
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def _current(self):
+        st = os.stat(self.path)
+        identity = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self.lock:
+            if identity == self.identity:
+                return self.index
+        with open(self.path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        size, = _INDEX.unpack_from(data, 0)
+        base = _INDEX.size + size
+        layout = json.loads(data[_INDEX.size:base])
+        needed = {}
+        for spans in layout['responses'].values():
+            for key, offset, length in spans:
+                needed[key] = max(needed.get(key, 0), offset + length)
+        buffers = {'': memoryview(data)[base:]}
+        mappings = {}
+        for key, name in layout['files'].items():
+            buffers[key] = mappings[name] = self._map(name, needed.get(key, 0))
+        index = {request.encode(): [(buffers[key], offset, length)
+                                    for key, offset, length in spans]
+                 for request, spans in layout['responses'].items()}
+        with self.lock:
+            # Old mappings are unmapped once the last response using them is sent
+            self.identity = (st.st_ino, st.st_mtime_ns, st.st_size)
+            self.index, self.mappings = index, mappings
+        metrics.inc('dreamchain_view_loads_total')
+        return index
+
+    def response(self, request):
+        """
+        The parts of the response to `request`, or None if the view doesn't
+        answer it.
+        """
+        try:
+            index = self._current()
+        except FileNotFoundError:
+            # The writer compacted a data file away between our reading of
+            # the index and mapping it; the index names its successor by now
+            index = self._current()
+        spans = index.get(request)
+        if spans is None:
+            return None
+        return [buffer[offset:offset + length] for buffer, offset, length in spans]
+
+
+class ViewPublisher:
+    """
+    Runs in the writer: publishes the view of `blockchain` to `path`, and
+    again whenever blocks arrive, the chain is swapped or the peer list
+    changes. Changes are picked up from chain events and, for peers, by
+    polling every `interval` seconds; a burst of blocks yields one publish
+    per build rather than one per block.
+
+    Only blocks past the point where the chain differs from the one last
+    published are pickled and written, so a publish costs what changed
+    rather than the whole chain.
+    """
+    def __init__(self, blockchain, path, interval=1.0):
+        self.blockchain = blockchain
+        self.path = path
+        self.interval = interval
+        self.state = None
+        # Blocks as sent in GET_CHAIN, and with payload references
+        self.files = {'chain': BlockFile(path + '.chain'), 'refs': BlockFile(path + '.refs')}
+        # Hashes of the blocks in the files, and the pruned height they had
+        self.hashes = []
+        self.pruned_height = 0
+        self.changed = Event()
+        self.stopped = Event()
+        self.publish()
+        blockchain.add_listener(self._on_event)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _on_event(self, kind, payload):
+        if kind != 'transaction':
+            self.changed.set()
+
+    def _state(self):
+        blockchain = self.blockchain
+        return (blockchain.tip_version, blockchain.history_version, blockchain.history_base,
+                frozenset(blockchain.nodes))
+
+    def _stored(self, chain, pruned_height):
+        """
+        Number of leading blocks of `chain` already in the files. Two chains
+        agree on every block below the first they differ on, so the hashes
+        can be bisected.
+        """
+        blockchain = self.blockchain
+        low, high = 0, min(len(self.hashes), len(chain))
+        while low < high:
+            middle = (low + high) // 2
+            if self.hashes[middle] == blockchain.hash(chain[middle]):
+                low = middle + 1
+            else:
+                high = middle
+        # Pruning keeps the hash but, for bodies not archived, changes what
+        # is sent
+        if pruned_height != self.pruned_height:
+            low = min(low, pruned_height, self.pruned_height)
+        return low
+
+    def _store(self, chain, pruned_height):
+        stored = self._stored(chain, pruned_height)
+        for blocks in self.files.values():
+            blocks.truncate(stored)
+        del self.hashes[stored:]
+        dicts = [block_to_dict(self.blockchain.with_body(block)) for block in chain[stored:]]
+        self.files['chain'].extend(_fragment(block) for block in dicts)
+        payloads = self.blockchain.payloads
+        self.files['refs'].extend(_fragment(payloads.encode_block(dict(block)))
+                                  for block in dicts)
+        self.hashes.extend(self.blockchain.hash(block) for block in chain[stored:])
+        self.pruned_height = pruned_height
+
+    def publish(self):
+        state = self._state()
+        blockchain = self.blockchain
+        with metrics.span('dreamchain_view_publish'):
+            pruned_height = blockchain.pruned_height
+            chain = blockchain.snapshot()
+            if blockchain.history_base:
+                # No complete chain to offer yet, as for GET_CHAIN
+                chain = []
+            self._store(chain, pruned_height)
+            self._write_index(len(chain), {request: handle_request(request, blockchain)
+                                           for request in (b"GET_INFO", b"GET_NODES")})
+        self.state = state
+        metrics.inc('dreamchain_view_publishes_total')
+
+    def _write_index(self, length, small):
+        blobs = []
+        offsets = {}
+        size = [0]
+
+        def blob(data):
+            if data not in offsets:
+                offsets[data] = size[0]
+                blobs.append(data)
+                size[0] += len(data)
+            return ['', offsets[data], len(data)]
+
+        def blocks(key, first, last):
+            return [[key, offset, length]
+                    for offset, length in self.files[key].spans(first, last)]
+
+        responses = {request.decode(): [blob(data)] for request, data in small.items()}
+        responses['GET_CHAIN'] = [blob(_PROTO + _fragment(length) + _LIST_START)] + \
+            blocks('chain', 0, length) + [blob(_LIST_END + _TUPLE2 + _STOP)]
+        for request, key in (('GET_CHAIN_STREAM', 'chain'), ('GET_CHAIN_STREAM refs', 'refs')):
+            # As stream_chain sends it: the length, then STREAM_BATCH blocks per pickle
+            spans = [blob(pickle.dumps(length))]
+            for first in range(0, length, STREAM_BATCH):
+                spans += [blob(_PROTO + _LIST_START)] + \
+                    blocks(key, first, min(first + STREAM_BATCH, length)) + \
+                    [blob(_LIST_END + _STOP)]
+            responses[request] = spans
+        index = json.dumps({
+            'files': {key: os.path.basename(blocks.path) for key, blocks in self.files.items()},
+            'responses': responses,
+        }).encode()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_INDEX.pack(len(index)))
+            f.write(index)
+            for data in blobs:
+                f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def _run(self):
+        while True:
+            self.changed.wait(self.interval)
+            self.changed.clear()
+            if self.stopped.is_set():
+                break
+            if self._state() != self.state:
+                try:
+                    self.publish()
+                except Exception as e:
+                    metrics.error('view_publish', e)
+
+    def stop(self):
+        self.blockchain.remove_listener(self._on_event)
+        self.stopped.set()
+        self.changed.set()
+        self.thread.join()
+        for blocks in self.files.values():
+            blocks.close()
+
+
+def forward(client_socket, request, writer):
+    """
+    Sends a request to the writer and relays its reply until the writer
+    closes the connection; for SUBSCRIBE, that is for as long as the
+    subscription lasts.
+    """
+    upstream = socket.create_connection(writer, FORWARD_TIMEOUT)
+    try:
+        upstream.sendall(request)
+        # Pushes are read to the end of the stream
+        upstream.shutdown(socket.SHUT_WR)
+        if request.startswith(b"SUBSCRIBE"):
+            upstream.settimeout(None)
+        while True:
+            part = upstream.recv(65536)
+            if not part:
+                break
+            client_socket.sendall(part)
+    finally:
+        upstream.close()
+
+
+def _relay_subscription(client_socket, request, writer):
+    try:
+        client_socket.settimeout(None)
+        forward(client_socket, request, writer)
+    except Exception as e:
+        metrics.error('relay_subscription', e)
+    finally:
+        client_socket.close()
+
+
+def handle_read(client_socket, view, writer, admission):
+    try:
+        client_socket.settimeout(admission.read_timeout)
+        request = read_message(client_socket, admission.max_message)
+        message_type = _message_type(request)
+        if message_type == 'SUBSCRIBE':
+            # The subscription lasts as long as the client wants; relay it on
+            # its own thread, as the writer does, rather than an admission one
+            metrics.inc('dreamchain_read_worker_requests_total', message=message_type,
+                        served='writer')
+            Thread(target=_relay_subscription, args=(client_socket, request, writer),
+                   daemon=True).start()
+            client_socket = None
+            return
+        limited = message_type in CHAIN_SERVES
+        if limited and not admission.start_chain_serve(client_socket.getpeername()[0]):
+            return
+        try:
+            parts = view.response(request)
+            if parts is None:
+                metrics.inc('dreamchain_read_worker_requests_total', message=message_type,
+                            served='writer')
+                forward(client_socket, request, writer)
+                return
+            metrics.inc('dreamchain_read_worker_requests_total', message=message_type,
+                        served='view')
+            for part in parts:
+                client_socket.sendall(part)
+        finally:
+            if limited:
+                admission.finish_chain_serve()
+    except Exception as e:
+        metrics.error('handle_read', e)
+    finally:
+        if client_socket is not None:
+            client_socket.close()
+
+
+def serve_reads(server, view, writer, admission):
+    """
+    A worker's accept loop: admits connections as the writer's server does
+    and answers them from `view`, forwarding the rest to `writer`.
+    """
+    def handle(client):
+        handle_read(client, view, writer, admission)
+
+    while True:
+        try:
+            client, addr = server.accept()
+        except OSError:
+            break
+        admission.submit(client, addr, handle)
+
+
+def _exit_with_parent(parent):
+    # A worker outliving its writer would keep serving a frozen view
+    while os.getppid() == parent:
+        Event().wait(1.0)
+    os._exit(0)
+
+
+class ReadWorkers:
+    """
+    Starts `workers` read worker processes for the writer's `blockchain`
+    on the public `port`, plus the view publisher and the loopback server
+    they forward other requests to (served by start_server, like the
+    public port of a single-process node). `limits` are the keyword
+    arguments of each worker's AdmissionControl; per-peer limits apply
+    per worker.
+    """
+    def __init__(self, blockchain, port, workers, directory=None, host='0.0.0.0', limits=None):
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='dreamchain-view-')
+        os.makedirs(directory, exist_ok=True)
+        self.view_path = os.path.join(directory, f'view-{port}')
+        self.publisher = ViewPublisher(blockchain, self.view_path)
+        self.server = create_server(0, host='127.0.0.1')
+        writer = '%s:%d' % self.server.getsockname()
+
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, (package_root, env.get('PYTHONPATH'))))
+        command = [sys.executable, '-m', 'DreamChain.readers', str(port), self.view_path, writer,
+                   '--host', host, '--limits', json.dumps(limits or {})]
+        self.processes = [subprocess.Popen(command, stdout=subprocess.PIPE, env=env)
+                          for _ in range(workers)]
+        # Return once every worker is listening
+        for process in self.processes:
+            if process.stdout.readline().strip() != b'ready':
+                self.stop()
+                raise RuntimeError(f'read worker failed to start on port {port}')
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+            process.stdout.close()
+        self.publisher.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='DreamChain read worker')
+    parser.add_argument('port', type=int)
+    parser.add_argument('view', help='view file published by the writer')
+    parser.add_argument('writer', help='host:port the writer serves forwarded requests on')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--limits', default='{}', help='AdmissionControl arguments as JSON')
+    args = parser.parse_args(argv)
+
+    host, port = args.writer.rsplit(':', 1)
+    server = create_server(args.port, host=args.host, reuse_port=True)
+    admission = AdmissionControl(**json.loads(args.limits))
+    Thread(target=_exit_with_parent, args=(os.getppid(),), daemon=True).start()
+    print('ready', flush=True)
+    serve_reads(server, ChainView(args.view), (host, int(port)), admission)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Transaction gossip and compact block relay.
+
+Nodes pass new pool transactions on to their peers in small batches, so
+by the time a block is mined its peers usually hold its transactions
+already. The block is then announced in compact form: its header, its
+hash and a short ID per transaction. A receiver rebuilds the block from
+its own pool and asks the announcer only for the transactions it lacks
+(GET_BLOCK_TXS).
+"""
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+
+from .blocks import Block, Transaction
+from .metrics import metrics
+
+# Optional messages a node understands, advertised in GET_INFO: compact
+# block announcements, and (while it relays) gossiped transactions. Peers
+# without them get full blocks and no transactions.
+FEATURE_COMPACT = 'compact'
+FEATURE_TRANSACTIONS = 'transactions'
+
+# Bytes of a transaction ID kept as its short ID. A collision only makes
+# the rebuilt block fail its hash check, after which the receiver fetches
+# every transaction.
+SHORT_ID_BYTES = 8
+
+
+def short_id(transaction):
+    return bytes.fromhex(Transaction.from_dict(transaction).hash[:2 * SHORT_ID_BYTES])
+
+
+def compact_block(block, origin, held=None):
+    """
+    The compact announcement of `block`. Transactions for which `held`
+    (a transaction ID -> bool lookup) isn't true are included whole, since
+    peers are unlikely to have them yet. `origin` is our address, where
+    receivers fetch what they still miss.
+    """
+    header = block.header()
+    prefilled = {}
+    for position, tx in enumerate(block.transactions):
+        if held is None or not held(Transaction.from_dict(tx).hash):
+            prefilled[position] = Transaction.from_dict(tx).to_dict()
+    return {
+        'index': header.index,
+        'timestamp': header.timestamp,
+        'proof': header.proof,
+        'previous_hash': header.previous_hash,
+        'merkle_root': header.merkle_root,
+        'hash': header.hash,
+        # Packed into one string of SHORT_ID_BYTES per transaction
+        'short_ids': b''.join(short_id(tx) for tx in block.transactions),
+        'prefilled': prefilled,
+        'origin': origin,
+    }
+
+
+def rebuild(compact, pool):
+    """
+    Fills in a compact block's transactions from `pool` and its prefilled
+    ones. Returns (transactions with None where missing, missing positions).
+    """
+    index = {short_id(tx): tx for tx in pool}
+    short_ids = compact['short_ids']
+    transactions = []
+    missing = []
+    for position in range(len(short_ids) // SHORT_ID_BYTES):
+        tx = compact['prefilled'].get(position)
+        if tx is None:
+            tx = index.get(short_ids[position * SHORT_ID_BYTES:(position + 1) * SHORT_ID_BYTES])
+        if tx is None:
+            missing.append(position)
+        transactions.append(tx)
+    return transactions, missing
+
+
+def assemble(compact, transactions):
+    """
+    The full block, or None if it doesn't hash to the announced hash or its
+    transactions don't match its Merkle root.
+    """
+    block = Block(compact['index'], compact['timestamp'],
+                  [Transaction.from_dict(tx) for tx in transactions],
+                  compact['proof'], compact['previous_hash'], compact.get('merkle_root'))
+    if block.hash != compact['hash'] or not block.valid_merkle_root():
+        return None
+    return block
+
+
+class TransactionRelay:
+    """
+    Gossips a chain's new pool transactions to its peers.
+
+    Transactions entering the pool (added locally or received from a peer)
+    are queued and pushed to every peer each `interval` seconds, up to
+    `max_batch` per push. Received transactions already seen are dropped,
+    which stops the flood; the IDs of the last `known_size` transactions
+    seen are remembered, along with whether peers have been sent them.
+    """
+    def __init__(self, blockchain, interval=0.05, max_batch=1000, known_size=100000):
+        self.blockchain = blockchain
+        self.interval = interval
+        self.max_batch = max_batch
+        self.known_size = known_size
+        self.lock = Lock()
+        self.queue = []
+        # Transaction ID -> True once peers have it (we sent it, or a peer
+        # sent it to us)
+        self.known = OrderedDict()
+        self.stopped = Event()
+        blockchain.add_listener(self._on_event)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _remember(self, transaction_id, shared):
+        # Called with the lock held
+        self.known[transaction_id] = shared or self.known.get(transaction_id, False)
+        self.known.move_to_end(transaction_id)
+        while len(self.known) > self.known_size:
+            self.known.popitem(last=False)
+
+    def shared(self, transaction_id):
+        """
+        True if peers should already hold this transaction.
+        """
+        return self.known.get(transaction_id, False)
+
+    def _on_event(self, kind, payload):
+        if kind == 'transaction':
+            with self.lock:
+                self._remember(payload.hash, False)
+                self.queue.append(payload)
+        elif kind in ('block', 'reorg'):
+            # Confirmed transactions that turn up late must not re-enter the pool
+            blocks = [payload] if kind == 'block' else payload[1]
+            with self.lock:
+                for block in blocks:
+                    for tx in (block or {}).get('transactions', ()):
+                        self._remember(Transaction.from_dict(tx).hash, False)
+
+    def receive(self, transactions):
+        """
+        Adds the transactions a peer pushed that we haven't seen; they are
+        passed on in turn. Returns how many were new.
+        """
+        fresh = []
+        with self.lock:
+            for tx in transactions:
+                transaction = Transaction.from_dict(tx)
+                if transaction.hash not in self.known:
+                    fresh.append(transaction)
+                self._remember(transaction.hash, True)
+        added = 0
+        for transaction in fresh:
+            try:
+                self.blockchain.new_transaction(transaction.sender, transaction.recipient,
+                                                transaction.data, transaction.signature)
+                added += 1
+            except ValueError:
+                metrics.inc('dreamchain_relay_transactions_total', result='invalid')
+        metrics.inc('dreamchain_relay_transactions_total', added, result='received')
+        metrics.inc('dreamchain_relay_transactions_total', len(transactions) - len(fresh),
+                    result='duplicate')
+        return added
+
+    def flush(self):
+        """
+        Pushes the queued transactions to every peer now.
+        """
+        with self.lock:
+            batch, self.queue = self.queue[:self.max_batch], self.queue[self.max_batch:]
+        if not batch:
+            return 0
+        for node in self.blockchain.nodes:
+            if FEATURE_TRANSACTIONS in self.blockchain.features_of_peer(node):
+                self.blockchain.send_transactions_to_peer(node, batch)
+        with self.lock:
+            for transaction in batch:
+                self._remember(transaction.hash, True)
+        return len(batch)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                while self.flush() == self.max_batch:
+                    pass
+            except Exception as e:
+                metrics.error('relay', e)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.blockchain.remove_listener(self._on_event)
@@ -0,0 +1,168 @@
+"""
+Ed25519 transaction signatures.
+
+A signed transaction's sender is the hex-encoded public key of the signer:
+
+    from DreamChain.signatures import generate_key, public_key, sign_transaction
+    key = generate_key()
+    transaction = sign_transaction(key, 'recipient', {'amount': 5})
+    blockchain.new_transaction(transaction.sender, transaction.recipient, transaction.data,
+                               transaction.signature)
+
+Needs the optional `cryptography` package (pip install DreamChain[signatures]);
+nodes that only ever see unsigned transactions never import it.
+"""
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+from .blocks import Transaction
+
+
+def _ed25519():
+    try:
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+    except ImportError:
+        raise ImportError("Transaction signatures need the 'cryptography' package: "
+                          "pip install DreamChain[signatures]")
+    return ed25519
+
+
+def generate_key():
+    """
+    Returns a new private key.
+    """
+    return _ed25519().Ed25519PrivateKey.generate()
+
+
+def public_key(private_key):
+    """
+    The hex public key for `private_key`, used as the sender address.
+    """
+    from cryptography.hazmat.primitives import serialization
+    return private_key.public_key().public_bytes(
+        serialization.Encoding.Raw, serialization.PublicFormat.Raw).hex()
+
+
+def sign_transaction(private_key, recipient, data):
+    """
+    Builds a transaction from the key's address to `recipient`, signed.
+    """
+    transaction = Transaction(public_key(private_key), recipient, data)
+    transaction.signature = private_key.sign(transaction.payload()).hex()
+    return transaction
+
+
+def _verify_batch(items):
+    """
+    Checks a batch of (sender, signature, payload) triples; returns a list
+    of booleans. Runs in worker processes.
+    """
+    ed25519 = _ed25519()
+    results = []
+    for sender, signature, payload in items:
+        try:
+            key = ed25519.Ed25519PublicKey.from_public_bytes(bytes.fromhex(sender))
+            key.verify(bytes.fromhex(signature), payload)
+            results.append(True)
+        except Exception:
+            results.append(False)
+    return results
+
+
+class SignatureVerifier:
+    """
+    Verifies transaction signatures in batches.
+
+    Verified transaction IDs are remembered in an LRU of `cache_size`
+    entries, so a transaction checked when it entered the pool is not
+    checked again when it shows up in a block. Batches of more than
+    `threshold` signatures are split across a pool of worker processes;
+    smaller ones are checked in-process.
+    """
+    def __init__(self, processes=None, cache_size=100000, threshold=512, batch=256):
+        self.processes = processes or os.cpu_count() or 1
+        self.cache_size = cache_size
+        self.threshold = threshold
+        self.batch = batch
+        self.lock = Lock()
+        self.verified = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._pool = None
+
+    def _get_pool(self):
+        with self.lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.processes)
+            return self._pool
+
+    def shutdown(self):
+        with self.lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+    def verify(self, transactions, require=False):
+        """
+        Returns True if every signed transaction has a valid signature and,
+        with `require`, every transaction is signed.
+        """
+        pending = []
+        with self.lock:
+            for transaction in transactions:
+                if transaction.__class__ is not Transaction:
+                    transaction = Transaction.from_dict(transaction)
+                if transaction.signature is None:
+                    if require:
+                        return False
+                    continue
+                transaction_id = transaction.hash
+                if transaction_id in self.verified:
+                    self.verified.move_to_end(transaction_id)
+                    self.hits += 1
+                else:
+                    pending.append(transaction)
+            self.misses += len(pending)
+        if not pending:
+            return True
+
+        items = [(tx.sender, tx.signature, tx.payload()) for tx in pending]
+        if self.processes > 1 and len(items) > self.threshold:
+            batches = [items[i:i + self.batch] for i in range(0, len(items), self.batch)]
+            results = [ok for batch in self._get_pool().map(_verify_batch, batches) for ok in batch]
+        else:
+            results = _verify_batch(items)
+        if not all(results):
+            return False
+
+        with self.lock:
+            for transaction in pending:
+                self.verified[transaction.hash] = True
+            while len(self.verified) > self.cache_size:
+                self.verified.popitem(last=False)
+        return True
+
+    def verify_blocks(self, blocks, require=False):
+        """
+        Verifies the transactions of many blocks as one batch.
+        """
+        return self.verify([tx for block in blocks if block is not None
+                            for tx in block.get('transactions', [])], require)
+
+
+_default = None
+_default_lock = Lock()
+
+
+def default_verifier():
+    """
+    The process-wide verifier that DreamChain instances use by default, so
+    its cache is shared by every chain in the process.
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = SignatureVerifier()
+        return _default
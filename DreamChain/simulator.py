@@ -0,0 +1,305 @@
+"""
+Local multi-node network simulator.
+
+Starts many nodes on localhost ports, either in this process or spread over
+several subprocesses, degrades the links between them and drives a
+transaction and mining workload:
+
+    python -m DreamChain.simulator --nodes 50 --miners 5 --duration 30 \\
+        --latency-ms 5:50 --loss 0.02 --partition-at 10 --heal-at 20
+
+At the end it reports propagation delay, fork rate and throughput as JSON.
+Nodes join over a clean network; the configured conditions apply from the
+moment the workload starts.
+"""
+import argparse
+import json
+import random
+import socket
+import subprocess
+import sys
+from threading import Event, Lock, Thread
+from time import sleep, time
+
+from .dreamchain import DreamChain, Node
+from .admission import AdmissionControl
+
+
+class NetworkConditions:
+    """
+    Link behaviour applied to every outbound connection a node makes: a
+    random one-way delay, a chance of the connection being dropped, and an
+    optional partition into groups that can't reach each other.
+    """
+    def __init__(self, latency=(0, 0), loss=0.0, seed=None):
+        self.latency = latency
+        self.loss = loss
+        self.groups = None
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.dropped = 0
+        self.partitioned = 0
+
+    def partition(self, groups):
+        """
+        Splits the network: `groups` is a list of sets of ports.
+        """
+        self.groups = {port: i for i, group in enumerate(groups) for port in group}
+
+    def heal(self):
+        self.groups = None
+
+    def before_connect(self, source_port, node):
+        groups = self.groups
+        if groups is not None and groups.get(source_port) != groups.get(node[1]):
+            with self.lock:
+                self.partitioned += 1
+            raise ConnectionRefusedError('simulated partition')
+        with self.lock:
+            delay = self.random.uniform(*self.latency)
+            lost = self.random.random() < self.loss
+            if lost:
+                self.dropped += 1
+        if lost:
+            raise ConnectionResetError('simulated packet loss')
+        if delay:
+            sleep(delay)
+
+
+def split_halves(ports):
+    ports = sorted(ports)
+    middle = len(ports) // 2
+    return [set(ports[:middle]), set(ports[middle:])]
+
+
+class Simulation:
+    """
+    Runs the nodes on `ports` (the first port of the whole network is the
+    master) and records when each node first sees each block.
+    """
+    def __init__(self, ports, master_port, miners, conditions, sync_interval=None):
+        self.ports = ports
+        self.master_port = master_port
+        self.miner_ports = [port for port in ports if port < master_port + miners]
+        self.conditions = conditions
+        self.sync_interval = sync_interval
+        self.nodes = {}
+        self.seen = {}
+        self.seen_lock = Lock()
+        self.submitted = 0
+        self.stopped = Event()
+
+    def start(self):
+        for port in self.ports:
+            master = None if port == self.master_port else ('127.0.0.1', self.master_port)
+            if master is not None:
+                _wait_for_port(self.master_port)
+            # Every node connects from localhost, so per-peer limits would
+            # lump them all together
+            node = Node(port, master, admission=AdmissionControl(rate=None, max_connections=None))
+            node.blockchain.add_listener(self._listener(port))
+            self.nodes[port] = node
+
+        # The master learns about every node as it registers; the others
+        # only know the nodes that joined before them
+        for node in self.nodes.values():
+            node.blockchain.network = self.conditions
+        for port in self.miner_ports:
+            self.nodes[port].start_miner()
+        if self.sync_interval:
+            Thread(target=self._sync_loop, daemon=True).start()
+
+    def _listener(self, port):
+        def record(event, payload):
+            if event == 'block':
+                blocks = [payload]
+            elif event == 'reorg':
+                blocks = payload[1]
+            else:
+                return
+            now = time()
+            with self.seen_lock:
+                for block in blocks:
+                    self.seen.setdefault(DreamChain.hash(block), {}).setdefault(port, now)
+        return record
+
+    def _sync_loop(self):
+        while not self.stopped.wait(self.sync_interval):
+            for node in list(self.nodes.values()):
+                node.resolve_conflicts()
+
+    def submit(self, rng):
+        if not self.miner_ports:
+            return
+        node = self.nodes[rng.choice(self.miner_ports)]
+        node.add_transaction(f'sender-{rng.randrange(1000)}', f'recipient-{rng.randrange(1000)}',
+                             {'submitted': time()})
+        self.submitted += 1
+
+    def stop(self):
+        self.stopped.set()
+        for node in self.nodes.values():
+            node.stop()
+
+    def observations(self):
+        """
+        Raw results in a JSON-friendly form, mergeable across processes.
+        """
+        longest = max(self.nodes.values(), key=lambda node: len(node.blockchain.chain))
+        chain = longest.blockchain.snapshot()
+        return {
+            'nodes': len(self.nodes),
+            'seen': {block_hash: {str(port): t for port, t in seen.items()}
+                     for block_hash, seen in self.seen.items()},
+            'mined': sum(node.blockchain.mining_stats()['mined'] for node in self.nodes.values()),
+            'submitted': self.submitted,
+            'chain': [(DreamChain.hash(block), len(block.get('transactions', [])))
+                      for block in chain if block is not None],
+            'dropped': self.conditions.dropped,
+            'partitioned': self.conditions.partitioned,
+        }
+
+
+def _wait_for_port(port, timeout=30):
+    deadline = time() + timeout
+    while time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            sleep(0.05)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def report(observations, duration, started):
+    """
+    Merges per-process observations into propagation, fork rate and
+    throughput figures.
+    """
+    nodes = sum(o['nodes'] for o in observations)
+    seen = {}
+    for o in observations:
+        for block_hash, times in o['seen'].items():
+            seen.setdefault(block_hash, {}).update(times)
+    canonical = max((o['chain'] for o in observations), key=len)
+    mined = sum(o['mined'] for o in observations)
+
+    # Blocks mined during the run that ended up on the longest chain
+    run_blocks = [(block_hash, txs) for block_hash, txs in canonical
+                  if block_hash in seen and min(seen[block_hash].values()) >= started]
+    delays, full_delays, coverage = [], [], []
+    for block_hash, txs in run_blocks:
+        times = sorted(seen[block_hash].values())
+        delays.extend(t - times[0] for t in times[1:])
+        coverage.append(len(times) / nodes)
+        if len(times) == nodes:
+            full_delays.append(times[-1] - times[0])
+    confirmed = sum(txs for block_hash, txs in run_blocks)
+
+    return {
+        'nodes': nodes,
+        'duration_seconds': duration,
+        'blocks_mined': mined,
+        'blocks_on_longest_chain': len(run_blocks),
+        'fork_rate': (mined - len(run_blocks)) / mined if mined else 0.0,
+        'transactions_submitted': sum(o['submitted'] for o in observations),
+        'transactions_confirmed': confirmed,
+        'throughput_tx_per_sec': confirmed / duration,
+        'blocks_per_sec': len(run_blocks) / duration,
+        'propagation_p50_seconds': _percentile(delays, 0.5),
+        'propagation_p90_seconds': _percentile(delays, 0.9),
+        'propagation_max_seconds': max(delays) if delays else None,
+        'full_propagation_p50_seconds': _percentile(full_delays, 0.5),
+        'mean_coverage': sum(coverage) / len(coverage) if coverage else 0.0,
+        'connections_dropped': sum(o['dropped'] for o in observations),
+        'connections_partitioned': sum(o['partitioned'] for o in observations),
+    }
+
+
+def run_shard(args, ports, started_event=None):
+    """
+    Runs the nodes on `ports` for args.duration seconds under the configured
+    conditions and workload, and returns their observations.
+    """
+    all_ports = list(range(args.port, args.port + args.nodes))
+    conditions = NetworkConditions((args.latency[0] / 1000, args.latency[1] / 1000),
+                                   args.loss, args.seed)
+    simulation = Simulation(ports, args.port, args.miners, conditions, args.sync_interval)
+    simulation.start()
+    # Transactions go to the miners, so with several shards each submits
+    # for its share of them and together they make up --tx-rate
+    miners = min(args.miners, args.nodes)
+    tx_rate = args.tx_rate * len(simulation.miner_ports) / miners if miners else 0
+    rng = random.Random(args.seed)
+    started = time()
+    try:
+        while time() - started < args.duration:
+            elapsed = time() - started
+            if args.partition_at is not None and elapsed >= args.partition_at \
+                    and conditions.groups is None and \
+                    (args.heal_at is None or elapsed < args.heal_at):
+                conditions.partition(split_halves(all_ports))
+            if args.heal_at is not None and elapsed >= args.heal_at:
+                conditions.heal()
+            if tx_rate:
+                simulation.submit(rng)
+                sleep(1 / tx_rate)
+            else:
+                sleep(0.1)
+        # Let in-flight blocks settle before collecting
+        conditions.heal()
+        sleep(args.settle)
+        observations = simulation.observations()
+    finally:
+        simulation.stop()
+    observations['started'] = started
+    return observations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='DreamChain local network simulator')
+    parser.add_argument('--nodes', type=int, default=10)
+    parser.add_argument('--miners', type=int, default=3, help='nodes (from the master up) that mine')
+    parser.add_argument('--duration', type=float, default=20, help='workload seconds')
+    parser.add_argument('--tx-rate', type=float, default=20, help='transactions per second')
+    parser.add_argument('--latency-ms', default='0:0', help='min:max one-way delay per connection')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability a connection is dropped')
+    parser.add_argument('--partition-at', type=float, help='seconds in: split the network in two')
+    parser.add_argument('--heal-at', type=float, help='seconds in: heal the partition')
+    parser.add_argument('--sync-interval', type=float, help='resolve_conflicts on every node this often')
+    parser.add_argument('--settle', type=float, default=2, help='seconds to wait before collecting')
+    parser.add_argument('--processes', type=int, default=1, help='spread nodes over subprocesses')
+    parser.add_argument('--port', type=int, default=8000, help='first port; it hosts the master')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--shard', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    args.latency = [float(ms) for ms in args.latency_ms.split(':')]
+
+    all_ports = list(range(args.port, args.port + args.nodes))
+    if args.shard is not None:
+        # Child process: run our slice of the ports and hand back raw results
+        index, count = (int(part) for part in args.shard.split('/'))
+        print(json.dumps(run_shard(args, all_ports[index::count])))
+        return
+
+    if args.processes <= 1:
+        observations = [run_shard(args, all_ports)]
+    else:
+        children = [subprocess.Popen([sys.executable, '-m', 'DreamChain.simulator',
+                                      '--shard', f'{i}/{args.processes}'] + list(argv or sys.argv[1:]),
+                                     stdout=subprocess.PIPE)
+                    for i in range(args.processes)]
+        observations = [json.loads(child.communicate()[0]) for child in children]
+
+    started = min(o['started'] for o in observations)
+    print(json.dumps(report(observations, args.duration, started), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
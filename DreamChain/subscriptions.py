@@ -0,0 +1,336 @@
+"""
+Push-based subscriptions to a node's new blocks, reorgs and transactions.
+
+In-process consumers subscribe to the chain directly:
+
+    subscription = blockchain.subscriptions.subscribe(events=('block', 'reorg'))
+    for event in subscription:
+        print(event.kind, event.payload)
+
+Remote consumers open a long-lived connection to the node server and read
+length-prefixed pickled frames:
+
+    for kind, payload in follow(('127.0.0.1', 5000), recipient='alice'):
+        ...
+
+Every subscriber has its own bounded queue, so a slow consumer never holds
+up the node or the other subscribers; what happens when its queue is full
+is set by its policy (POLICIES).
+"""
+import json
+import pickle
+import socket
+import struct
+from collections import deque
+from threading import Condition, Lock, Thread
+
+from .admission import loads_untrusted, namespaced
+from .blocks import block_to_dict
+from .metrics import metrics
+
+EVENTS = ('block', 'reorg', 'transaction')
+
+# When a subscriber's queue is full: drop its oldest queued event, drop the
+# new event, or close the subscription
+POLICIES = ('drop_oldest', 'drop_newest', 'disconnect')
+
+_HEADER = struct.Struct('>I')
+
+
+def _transaction_dict(transaction):
+    return transaction if isinstance(transaction, dict) else transaction.to_dict()
+
+
+class Event:
+    """
+    One chain event: `kind` is 'block', 'reorg' or 'transaction' and
+    `payload` what the chain's listeners receive. The wire frame is built
+    once and shared by every remote subscriber.
+    """
+    __slots__ = ('kind', 'payload', '_frame')
+
+    def __init__(self, kind, payload):
+        self.kind = kind
+        self.payload = payload
+        self._frame = None
+
+    def frame(self):
+        if self._frame is None:
+            if self.kind == 'block':
+                payload = block_to_dict(self.payload)
+            elif self.kind == 'reorg':
+                fork, blocks = self.payload
+                payload = (fork, [block_to_dict(block) for block in blocks])
+            else:
+                payload = _transaction_dict(self.payload)
+            self._frame = encode_frame((self.kind, payload))
+        return self._frame
+
+    def __repr__(self):
+        return f'Event({self.kind!r})'
+
+
+def encode_frame(message):
+    data = pickle.dumps(message)
+    return _HEADER.pack(len(data)) + data
+
+
+def _read_exactly(s, size):
+    data = b""
+    while len(data) < size:
+        part = s.recv(size - len(data))
+        if not part:
+            raise EOFError('connection closed')
+        data += part
+    return data
+
+
+def read_frame(s):
+    size, = _HEADER.unpack(_read_exactly(s, _HEADER.size))
+    return loads_untrusted(_read_exactly(s, size))
+
+
+class Subscription:
+    """
+    A subscriber's bounded queue of events. Iterating blocks until the next
+    event and ends when the subscription is closed.
+
+    `sender` and `recipient` restrict transaction events, and block events,
+    to transactions (or blocks containing transactions) that match. Reorgs
+    are always delivered, since they can undo anything seen before.
+    """
+    def __init__(self, hub, events=EVENTS, sender=None, recipient=None, queue_size=1000,
+                 policy='drop_oldest'):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown slow-consumer policy {policy!r}')
+        self.hub = hub
+        self.events = frozenset(events)
+        self.sender = sender
+        self.recipient = recipient
+        self.queue_size = queue_size
+        self.policy = policy
+        self.unfiltered = sender is None and recipient is None
+        self.queue = deque()
+        self.condition = Condition(Lock())
+        self.waiting = 0
+        self.closed = False
+        self.dropped = 0
+
+    def _matches_transaction(self, transaction):
+        return ((self.sender is None or transaction['sender'] == self.sender) and
+                (self.recipient is None or transaction['recipient'] == self.recipient))
+
+    def matches(self, event):
+        if event.kind not in self.events:
+            return False
+        if self.unfiltered:
+            return True
+        if event.kind == 'transaction':
+            return self._matches_transaction(event.payload)
+        if event.kind == 'block':
+            return any(self._matches_transaction(tx)
+                       for tx in event.payload.get('transactions', ()))
+        return True
+
+    def put(self, event):
+        """
+        Queues an event without ever blocking the caller, applying the
+        slow-consumer policy if the queue is full.
+        """
+        with self.condition:
+            if self.closed:
+                return
+            if len(self.queue) >= self.queue_size:
+                self.dropped += 1
+                metrics.inc('dreamchain_subscription_dropped_total', policy=self.policy)
+                if self.policy == 'drop_newest':
+                    return
+                if self.policy == 'disconnect':
+                    self._close()
+                    return
+                self.queue.popleft()
+            self.queue.append(event)
+            if self.waiting:
+                self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Returns the next event, or None if the subscription was closed or
+        nothing arrived within `timeout` seconds.
+        """
+        with self.condition:
+            if not self.queue and not self.closed:
+                self.waiting += 1
+                self.condition.wait(timeout)
+                self.waiting -= 1
+            if self.queue:
+                return self.queue.popleft()
+            return None
+
+    def __iter__(self):
+        while True:
+            event = self.get()
+            if event is None:
+                return
+            yield event
+
+    def _close(self):
+        self.closed = True
+        self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self._close()
+        self.hub.unsubscribe(self)
+
+
+class SubscriptionHub:
+    """
+    Fans a chain's events out to its subscribers. It listens on the chain
+    once, and queues each event for the subscribers it matches, which is
+    all the work done on the thread that changed the chain. Subscribers
+    that filter on an address are looked up by it, so they cost nothing
+    for events that don't concern them.
+
+    Remote subscribers each get a sender thread that writes their queue to
+    the socket; at most `max_remote` are served at once.
+    """
+    def __init__(self, blockchain, max_remote=64, heartbeat=15.0):
+        self.blockchain = blockchain
+        self.max_remote = max_remote
+        self.heartbeat = heartbeat
+        self.lock = Lock()
+        self.remote = 0
+        self._update(())
+        blockchain.add_listener(self._on_event)
+
+    def _update(self, subscribers):
+        # Copy-on-write, so publishing never takes the lock: all subscribers,
+        # the unfiltered ones, and the filtered ones by sender (or, if they
+        # only filter on recipient, by recipient)
+        unfiltered, by_sender, by_recipient = [], {}, {}
+        for subscription in subscribers:
+            if subscription.unfiltered:
+                unfiltered.append(subscription)
+            elif subscription.sender is not None:
+                by_sender.setdefault(subscription.sender, []).append(subscription)
+            else:
+                by_recipient.setdefault(subscription.recipient, []).append(subscription)
+        self.subscribers = subscribers
+        self.routes = (tuple(unfiltered), by_sender, by_recipient)
+
+    def subscribe(self, events=EVENTS, sender=None, recipient=None, queue_size=1000,
+                  policy='drop_oldest'):
+        subscription = Subscription(self, events, sender, recipient, queue_size, policy)
+        with self.lock:
+            self._update(self.subscribers + (subscription,))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscribers:
+                self._update(tuple(s for s in self.subscribers if s is not subscription))
+
+    def _targets(self, kind, payload):
+        unfiltered, by_sender, by_recipient = self.routes
+        if kind == 'reorg':
+            return self.subscribers
+        if kind == 'transaction':
+            transactions = (payload,)
+        else:
+            transactions = payload.get('transactions', ())
+        if not by_sender and not by_recipient:
+            return unfiltered
+        targets = {}
+        for tx in transactions:
+            for subscription in by_sender.get(tx['sender'], ()):
+                targets[id(subscription)] = subscription
+            for subscription in by_recipient.get(tx['recipient'], ()):
+                targets[id(subscription)] = subscription
+        return unfiltered + tuple(targets.values())
+
+    def _on_event(self, kind, payload):
+        if not self.subscribers:
+            return
+        event = Event(kind, payload)
+        for subscription in self._targets(kind, payload):
+            if kind in subscription.events and (subscription.unfiltered or
+                                                subscription.matches(event)):
+                subscription.put(event)
+                if subscription.closed:
+                    self.unsubscribe(subscription)
+
+    def attach(self, client_socket, request):
+        """
+        Serves a SUBSCRIBE request: `SUBSCRIBE {json options}`, the options
+        being subscribe()'s keyword arguments. Returns True if the
+        subscription took over the connection.
+        """
+        options = json.loads(request[len(b"SUBSCRIBE"):].strip() or b'{}')
+        options = {key: options[key] for key in ('events', 'sender', 'recipient', 'queue_size',
+                                                 'policy') if key in options}
+        if 'events' in options:
+            options['events'] = [kind for kind in options['events'] if kind in EVENTS]
+        options['queue_size'] = min(int(options.get('queue_size', 1000)), 10000)
+        with self.lock:
+            if self.remote >= self.max_remote:
+                metrics.inc('dreamchain_admission_rejected_total', reason='subscribers')
+                return False
+            self.remote += 1
+        try:
+            subscription = self.subscribe(**options)
+        except Exception:
+            with self.lock:
+                self.remote -= 1
+            raise
+        client_socket.settimeout(None)
+        Thread(target=self._send, args=(client_socket, subscription), daemon=True).start()
+        return True
+
+    def _send(self, client_socket, subscription):
+        metrics.inc('dreamchain_subscriptions_total')
+        try:
+            client_socket.sendall(encode_frame(('subscribed', {
+                'height': len(self.blockchain.chain),
+                'tip_version': self.blockchain.tip_version,
+            })))
+            while True:
+                event = subscription.get(self.heartbeat)
+                if event is not None:
+                    client_socket.sendall(event.frame())
+                elif subscription.closed:
+                    break
+                else:
+                    # Heartbeat, which also finds out when the peer has gone
+                    client_socket.sendall(encode_frame(('ping', None)))
+        except OSError:
+            pass
+        finally:
+            subscription.close()
+            client_socket.close()
+            with self.lock:
+                self.remote -= 1
+
+
+def follow(node, events=EVENTS, sender=None, recipient=None, queue_size=1000,
+           policy='drop_oldest', namespace=None):
+    """
+    Subscribes to a remote node (to its chain called `namespace`, if given)
+    and yields (kind, payload) for each event, with blocks and transactions
+    as plain dicts. Ends when the node closes the connection, e.g. under
+    the 'disconnect' policy.
+    """
+    options = {'events': list(events), 'sender': sender, 'recipient': recipient,
+               'queue_size': queue_size, 'policy': policy}
+    s = socket.create_connection(node)
+    try:
+        s.sendall(namespaced(b"SUBSCRIBE " + json.dumps(options).encode(), namespace))
+        while True:
+            try:
+                kind, payload = read_frame(s)
+            except EOFError:
+                return
+            if kind not in ('subscribed', 'ping'):
+                yield kind, payload
+    finally:
+        s.close()
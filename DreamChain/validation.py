@@ -0,0 +1,163 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+from .blocks import Block, block_from_dict
+
+# The chain being validated and the consensus judging it, inherited by
+# forked workers so that neither has to be pickled across to them
+_shared_chain = None
+_shared_consensus = None
+
+
+def _validate_range(consensus, parent, blocks):
+    """
+    Checks `blocks` against their parents under `consensus`, and the hash
+    links between them. The link from the first block to its parent is left
+    to the caller, which knows the parent's hash.
+
+    Returns (offset of the first bad block or None, hashes of the blocks).
+    """
+    hashes = []
+    last_hash = None
+    for offset, block in enumerate(blocks):
+        if block.__class__ is not Block:
+            block = block_from_dict(block)
+            if not isinstance(block, Block):
+                return offset, hashes
+        if last_hash is not None and block.previous_hash != last_hash:
+            return offset, hashes
+        if not block.valid_merkle_root() or not consensus.valid_block(parent, block):
+            return offset, hashes
+        last_hash, parent = block.hash, block
+        hashes.append(last_hash)
+    return None, hashes
+
+
+def _validate_shared(first, last):
+    # Worker side: blocks[first:last] of the inherited chain
+    return _validate_range(_shared_consensus, _shared_chain[first - 1],
+                           _shared_chain[first:last])
+
+
+class ParallelValidator:
+    """
+    Validates long chains across a pool of worker processes.
+
+    The chain is cut into ranges that workers hash and check independently;
+    the links across range boundaries are then checked here from the hashes
+    the workers return. Those hashes are also cached on the blocks, so the
+    adopted chain never needs hashing again.
+
+    Workers are forked for each validation and read the chain from the
+    memory they inherit, which is what makes this faster than validating
+    in-process: sending blocks to a long-lived pool costs about as much as
+    hashing them. Chains shorter than `threshold` blocks, machines with a
+    single CPU and platforms without fork() validate in-process.
+
+    Forking a process that runs other threads is hazardous: the child gets
+    a copy of every lock as it was, including ones (the allocator's,
+    logging's, the metrics registry's) that another thread held at that
+    instant, and hangs if it ever takes one. So by default workers are
+    only forked while the calling process has no other threads, which
+    rules them out in a running node; passing `processes` explicitly
+    forks regardless, for callers that know their threads are idle.
+    """
+    def __init__(self, processes=None, threshold=10000):
+        self.forced = processes is not None
+        self.processes = processes or os.cpu_count() or 1
+        self.threshold = threshold
+        # One forked validation at a time, since workers read a global
+        self.lock = Lock()
+
+    @property
+    def enabled(self):
+        if self.processes <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            return False
+        return self.forced or threading.active_count() == 1
+
+    def validate(self, chain, start, consensus):
+        """
+        Checks chain[start + 1:] against its predecessors under `consensus`
+        (see consensus.py). Returns True if every block is valid.
+        """
+        if not isinstance(chain, list):
+            chain = list(chain)
+        if len(chain) <= start + 1:
+            return True
+        parent = block_from_dict(chain[start])
+        if parent is None:
+            return False
+        if not self.enabled or len(chain) - start - 1 < self.threshold:
+            ranges = [(start + 1, len(chain))]
+            results = [_validate_range(consensus, parent, chain[start + 1:])]
+        else:
+            ranges, results = self._validate_forked(chain, start, consensus)
+
+        # Stitch: each range's first block must link to the hash of the
+        # block before it, which the previous range (or the parent) computed
+        last_hash = parent.hash
+        for (first, last), (failed, hashes) in zip(ranges, results):
+            if failed is not None:
+                return False
+            if chain[first]['previous_hash'] != last_hash:
+                return False
+            for block, block_hash in zip(chain[first:last], hashes):
+                if block.__class__ is Block and block._hash is None:
+                    block._hash = block_hash
+            last_hash = hashes[-1]
+        return True
+
+    def _validate_forked(self, chain, start, consensus):
+        global _shared_chain, _shared_consensus
+        count = len(chain) - start - 1
+        # A few ranges per worker so one slow range doesn't hold up the rest
+        size = -(-count // (self.processes * 4))
+        ranges = [(first, min(first + size, len(chain)))
+                  for first in range(start + 1, len(chain), size)]
+
+        with self.lock:
+            _shared_chain, _shared_consensus = chain, consensus
+            try:
+                context = multiprocessing.get_context('fork')
+                with ProcessPoolExecutor(self.processes, mp_context=context) as pool:
+                    futures = [pool.submit(_validate_shared, first, last)
+                               for first, last in ranges]
+                    results = []
+                    for future in futures:
+                        results.append(future.result())
+                        if results[-1][0] is not None:
+                            # Stop at the first invalid range
+                            for pending in futures:
+                                pending.cancel()
+                            break
+            finally:
+                _shared_chain = _shared_consensus = None
+        return ranges[:len(results)], results
+
+
+def validate_batch(consensus, parent, blocks):
+    """
+    Checks a batch of blocks against each other and the first of them
+    against `parent` under `consensus`, except for its hash link to
+    `parent`: batches checked concurrently are linked in order afterwards.
+    The block hashes are cached on the way.
+    """
+    return _validate_range(consensus, block_from_dict(parent), blocks)[0] is None
+
+
+_default = None
+_default_lock = Lock()
+
+
+def default_validator():
+    """
+    The process-wide validator that DreamChain instances use by default.
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = ParallelValidator()
+        return _default
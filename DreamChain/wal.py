@@ -0,0 +1,262 @@
+import json
+import os
+import struct
+import zlib
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
+
+from .blocks import Transaction
+from .metrics import metrics
+
+# Durability of TransactionLog.append():
+#   'always' - fsynced on its own before append() returns
+#   'group'  - fsynced in a batch with concurrent appends before it returns
+#   'async'  - returns at once; batches are fsynced in the background
+SYNC_MODES = ('always', 'group', 'async')
+
+# Record: payload length, CRC32 of kind + payload, kind, payload
+_HEADER = struct.Struct('>IIc')
+_ADD = b'A'
+_REMOVE = b'R'
+
+
+def _record(kind, payload):
+    return _HEADER.pack(len(payload), zlib.crc32(kind + payload), kind) + payload
+
+
+class TransactionLog:
+    """
+    Write-ahead log of the transaction pool.
+
+    Accepted transactions are appended as 'add' records and the ones that
+    leave the pool (mined or confirmed by a peer's block) as 'remove'
+    records, so replaying the log rebuilds the pool after a crash or
+    restart. A torn record at the end, from a crash mid-write, is cut off.
+
+    With sync='group', appends that arrive within `interval` seconds of
+    each other share one write and fsync, and no append waits for its fsync
+    to start longer than that; a batch is also flushed early once it holds
+    `max_batch` records. Removals never wait for their fsync: losing one
+    only means replaying a transaction that the next sync drops again.
+
+    The log is rewritten with only the live transactions once it holds
+    more than `compact_min` records and over twice as many as are live.
+
+    A failed write or fsync leaves the file in an unknown state, so the log
+    stops there: the appends waiting on that batch, and every later one,
+    raise its OSError instead of reporting records durable.
+    """
+    def __init__(self, path, sync='group', interval=0.002, max_batch=1024, compact_min=10000):
+        if sync not in SYNC_MODES:
+            raise ValueError(f'Unknown sync mode {sync!r}')
+        self.path = path
+        self.sync = sync
+        self.interval = interval
+        self.max_batch = max_batch
+        self.compact_min = compact_min
+        self.condition = Condition(Lock())
+        self.live = OrderedDict()
+        self.records = 0
+        self.pending = []
+        self.seq = 0
+        self.flushed = 0
+        self.closed = False
+        # The OSError of a failed write; nothing is written after one
+        self.error = None
+        self.fsyncs = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        self.file = open(path, 'ab')
+        self._thread = None
+        if sync != 'always':
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            length, crc, kind = _HEADER.unpack_from(data, offset)
+            end = offset + _HEADER.size + length
+            payload = data[offset + _HEADER.size:end]
+            if end > len(data) or zlib.crc32(kind + payload) != crc:
+                break
+            self._apply(kind, payload)
+            self.records += 1
+            offset = end
+        if offset < len(data):
+            # Torn or corrupt tail from a crash; everything before it stands
+            metrics.inc('dreamchain_wal_truncated_total')
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+
+    def _apply(self, kind, payload):
+        if kind == _ADD:
+            transaction = Transaction.from_dict(json.loads(payload))
+            self.live[transaction.hash] = payload
+        elif kind == _REMOVE:
+            for transaction_id in json.loads(payload):
+                self.live.pop(transaction_id, None)
+
+    def replay(self):
+        """
+        The transactions the log holds, in the order they were added.
+        """
+        with self.condition:
+            return [Transaction.from_dict(json.loads(payload)) for payload in self.live.values()]
+
+    def append(self, transaction, wait=True):
+        """
+        Logs a transaction entering the pool. Returns once the record is as
+        durable as the sync mode promises (or at once, without `wait`).
+        Raises the OSError of a failed write, unless not waiting.
+        """
+        payload = json.dumps(transaction.to_dict(), sort_keys=True).encode()
+        with self.condition:
+            if self.error is not None:
+                if wait:
+                    raise self.error
+                self.live[transaction.hash] = payload
+                return
+            self.live[transaction.hash] = payload
+            seq = self._queue(_record(_ADD, payload))
+            if self.sync == 'always':
+                self._flush_now()
+                return
+            if wait and self.sync == 'group':
+                while self.flushed < seq and not self.closed and self.error is None:
+                    self.condition.wait()
+                if self.flushed < seq and self.error is not None:
+                    raise self.error
+
+    def remove(self, transactions):
+        """
+        Logs transactions leaving the pool.
+        """
+        transaction_ids = [tx.hash for tx in transactions]
+        if not transaction_ids:
+            return
+        with self.condition:
+            for transaction_id in transaction_ids:
+                self.live.pop(transaction_id, None)
+            if self.error is not None:
+                return
+            self._queue(_record(_REMOVE, json.dumps(transaction_ids).encode()))
+            if self.sync == 'always':
+                try:
+                    self._flush_now()
+                except OSError:
+                    # Kept in self.error for the appends to report
+                    pass
+
+    def _queue(self, record):
+        self.pending.append(record)
+        self.records += 1
+        self.seq += 1
+        if len(self.pending) == 1 or len(self.pending) >= self.max_batch:
+            self.condition.notify_all()
+        return self.seq
+
+    def _write(self, batch):
+        self.file.write(b''.join(batch))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.fsyncs += 1
+        metrics.inc('dreamchain_wal_fsyncs_total')
+        metrics.observe('dreamchain_wal_batch_records', len(batch), (1, 2, 4, 8, 16, 32, 64, 128,
+                                                                     256, 512, 1024))
+
+    def _flush_now(self):
+        # sync='always': write and fsync under the lock, one caller at a time
+        batch, self.pending = self.pending, []
+        try:
+            self._write(batch)
+        except OSError as e:
+            self._fail(e)
+            raise
+        self.flushed = self.seq
+        try:
+            self._maybe_compact()
+        except OSError as e:
+            # The records are written; only later appends see the failure
+            self._fail(e)
+
+    def _fail(self, error):
+        # Called with the lock held
+        metrics.error('wal_write', error)
+        self.error = error
+        self.pending = []
+        self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                # Give concurrent appends up to `interval` to join the batch
+                if self.interval and not self.closed:
+                    self.condition.wait_for(
+                        lambda: len(self.pending) >= self.max_batch or self.closed, self.interval)
+                batch, self.pending = self.pending, []
+                seq = self.seq
+            try:
+                self._write(batch)
+            except OSError as e:
+                with self.condition:
+                    self._fail(e)
+                return
+            with self.condition:
+                self.flushed = seq
+                try:
+                    self._maybe_compact()
+                except OSError as e:
+                    self._fail(e)
+                    return
+                self.condition.notify_all()
+
+    def _maybe_compact(self):
+        # Called with the lock held, so no record is added meanwhile. Records
+        # still pending are already reflected in `live`, so they are dropped.
+        if self.records <= self.compact_min or self.records <= 2 * len(self.live):
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for payload in self.live.values():
+                f.write(_record(_ADD, payload))
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.replace(tmp_path, self.path)
+        # Make the rename itself durable
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.file = open(self.path, 'ab')
+        self.records = len(self.live)
+        self.pending = []
+        self.flushed = self.seq
+        metrics.inc('dreamchain_wal_compactions_total')
+
+    def close(self):
+        """
+        Flushes what is pending and closes the log.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        with self.condition:
+            if self.pending and self.error is None:
+                self._flush_now()
+            self.file.close()
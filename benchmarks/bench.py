@@ -0,0 +1,843 @@
+"""
+Reproducible benchmarks for DreamChain.
+
+    python benchmarks/bench.py                          # all benchmarks, JSON on stdout
+    python benchmarks/bench.py --only validation --sizes 1000,10000
+    python benchmarks/bench.py --output after.json --baseline before.json
+
+Every benchmark returns a flat dict of numbers. The report is a single JSON
+document with the environment and all results, so two runs can be diffed;
+with --baseline the relative change of every number is also printed to
+stderr.
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import platform
+import socket
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime, timezone
+from threading import Event, Thread
+from time import perf_counter, process_time, sleep
+
+from common import DreamChain, build_chain, best_of, fixed_point_proof, wait_until
+from DreamChain.blocks import block_from_dict, block_to_dict
+from DreamChain.admission import AdmissionControl
+from DreamChain.dreamchain import COMPACT_BLOCK, Node, stream_chain
+from DreamChain.lightclient import LightClient
+from DreamChain.metrics import metrics
+from DreamChain.payloads import PayloadStore, encode_payload, train_zdict
+from DreamChain.validation import ParallelValidator
+from DreamChain.profiling import profiler
+from DreamChain.relay import compact_block
+from DreamChain.wal import TransactionLog
+
+
+def bench_hashing(args):
+    """
+    Raw proof checks per second, block hashes per second, and the average
+    time to find a real proof of work.
+    """
+    count = 200000
+    seconds = best_of(lambda: [DreamChain.valid_proof(12345, proof) for proof in range(count)],
+                      args.repeat)
+    block = build_chain(2).last_block
+    block_seconds = best_of(lambda: [DreamChain.hash(block) for _ in range(count // 10)],
+                            args.repeat)
+
+    blockchain = DreamChain(0)
+    started = perf_counter()
+    last_proof = blockchain.last_block['proof']
+    for _ in range(args.proofs):
+        last_proof = blockchain.proof_of_work(last_proof)
+    pow_seconds = (perf_counter() - started) / args.proofs
+
+    return {
+        'proof_checks_per_sec': count / seconds,
+        'block_hashes_per_sec': (count // 10) / block_seconds,
+        'seconds_per_proof_of_work': pow_seconds,
+    }
+
+
+def bench_validation(args):
+    """
+    valid_chain() throughput at each chain size, on a chain as it arrives
+    from a peer (no cached hashes): in-process, and across a pool of
+    --processes workers.
+    """
+    results = {}
+    for size in args.sizes:
+        blockchain = build_chain(size)
+        wire = [block_to_dict(block) for block in blockchain.chain]
+        for name, validator in (('', ParallelValidator(processes=1)),
+                                ('parallel_', ParallelValidator(args.processes, threshold=0))):
+            blockchain.validator = validator
+            best = None
+            for _ in range(args.repeat):
+                chain = [block_from_dict(block) for block in wire]
+                started = perf_counter()
+                valid = blockchain.valid_chain(chain)
+                elapsed = perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            results[f'{name}blocks_per_sec_{size}'] = size / best
+            results[f'{name}valid_{size}'] = valid
+    results['processes'] = args.processes
+    return results
+
+
+def bench_serialization(args):
+    """
+    Cost of the GET_CHAIN wire format: converting the chain to dicts and
+    pickling (length, chain), then unpickling and converting back.
+    """
+    results = {}
+    for size in args.sizes:
+        chain = list(build_chain(size).chain)
+
+        def dump():
+            return pickle.dumps((len(chain), [block_to_dict(block) for block in chain]))
+
+        def load():
+            length, blocks = pickle.loads(payload)
+            return [block_from_dict(block) for block in blocks]
+
+        payload = dump()
+        dump_seconds = best_of(dump, args.repeat)
+        load_seconds = best_of(load, args.repeat)
+        results[f'bytes_per_block_{size}'] = len(payload) / size
+        results[f'serialize_mb_per_sec_{size}'] = len(payload) / dump_seconds / 1e6
+        results[f'deserialize_mb_per_sec_{size}'] = len(payload) / load_seconds / 1e6
+        results[f'serialize_blocks_per_sec_{size}'] = size / dump_seconds
+        results[f'deserialize_blocks_per_sec_{size}'] = size / load_seconds
+    return results
+
+
+def _allocated(make):
+    """
+    Returns what make() returned and the bytes allocated to build it.
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        value = make()
+        return value, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory(args):
+    """
+    Bytes per block held in memory, for the record types against the plain
+    dicts they replaced. Both forms share the same field values, so the
+    difference is the per-object overhead. Records are measured with their
+    hashes cached, as they are on a live chain.
+    """
+    results = {}
+    for size in args.sizes:
+        dicts = [block_to_dict(block) for block in build_chain(size).chain]
+        _, dict_bytes = _allocated(lambda: [
+            dict(block, transactions=[dict(tx) for tx in block['transactions']])
+            for block in dicts])
+        records, record_bytes = _allocated(lambda: [block_from_dict(block) for block in dicts])
+        _, hash_bytes = _allocated(lambda: [block.hash for block in records])
+        results[f'bytes_per_block_dicts_{size}'] = dict_bytes / size
+        results[f'bytes_per_block_records_{size}'] = (record_bytes + hash_bytes) / size
+        results[f'saving_{size}'] = 1 - (record_bytes + hash_bytes) / dict_bytes
+    return results
+
+
+def bench_signatures(args):
+    """
+    Signature checks per second for a batch of signed transactions:
+    in-process, across --processes workers, and from the verified cache.
+    Needs the optional cryptography package.
+    """
+    from DreamChain.signatures import SignatureVerifier, generate_key, sign_transaction
+
+    key = generate_key()
+    transactions = [sign_transaction(key, f'recipient-{i % 97}', {'seq': i})
+                    for i in range(args.signatures)]
+    for transaction in transactions:
+        transaction.hash
+    results = {'processes': args.processes}
+    for name, processes in (('inline', 1), ('parallel', args.processes)):
+        verifier = SignatureVerifier(processes=processes, threshold=0)
+        best = None
+        for _ in range(args.repeat):
+            verifier.verified.clear()
+            started = perf_counter()
+            verifier.verify(transactions)
+            elapsed = perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        results[f'{name}_per_sec'] = len(transactions) / best
+        cached = best_of(lambda: verifier.verify(transactions), args.repeat)
+        verifier.shutdown()
+    results['cached_per_sec'] = len(transactions) / cached
+    return results
+
+
+def bench_sync(args):
+    """
+    End-to-end sync with in-process nodes on localhost: time for each new
+    node to join and download a `sync_length` chain from the master, then
+    time for one freshly mined block to reach every node.
+    """
+    master = Node(args.port)
+    nodes = []
+    try:
+        build_chain(args.sync_length, blockchain=master.blockchain)
+        started = perf_counter()
+        for i in range(1, args.nodes):
+            nodes.append(Node(args.port + i, ('127.0.0.1', args.port)))
+        join_seconds = perf_counter() - started
+        synced = all(len(node.blockchain.chain) == args.sync_length for node in nodes)
+
+        started = perf_counter()
+        block = None
+        while block is None:
+            block = master.blockchain.mine()
+        mine_seconds = perf_counter() - started
+        master.blockchain.broadcast_block(block)
+        propagation = wait_until(
+            lambda: all(len(node.blockchain.chain) > args.sync_length for node in nodes))
+    finally:
+        for node in [master] + nodes:
+            node.stop()
+
+    return {
+        'nodes': args.nodes,
+        'chain_length': args.sync_length,
+        'join_seconds_total': join_seconds,
+        'join_seconds_per_node': join_seconds / max(len(nodes), 1),
+        'all_synced': synced,
+        'mine_seconds': mine_seconds,
+        'propagation_seconds': propagation,
+    }
+
+
+def _report(seq):
+    # A large payload with a fixed layout and varying values, the kind that
+    # shares most of its bytes with its neighbours
+    return {
+        'type': 'sensor-report',
+        'station': f'station-{seq % 13}',
+        'firmware': 'dreamchain-sensor-firmware-2.4.1',
+        'readings': [{'channel': channel, 'value': (seq * 31 + channel * 7) % 1000,
+                      'unit': 'millivolt'} for channel in range(24)],
+    }
+
+
+def bench_payloads(args):
+    """
+    Bytes on the wire for a chain that repeats large payloads: the streamed
+    chain with inline payloads, with interned payloads (pickled once per
+    batch) and with references, then the payloads themselves as raw JSON,
+    zlib and zlib with a preset dictionary trained on earlier payloads.
+    """
+    length = min(args.sizes)
+    proof = fixed_point_proof()
+    results = {'chain_length': length}
+    for name, threshold in (('inline', float('inf')), ('interned', 1024)):
+        blockchain = DreamChain(0)
+        blockchain.payloads.threshold = threshold
+        blockchain.chain[0]['proof'] = proof
+        while len(blockchain.chain) < length:
+            height = len(blockchain.chain)
+            # A copy each time, as if it had arrived from a client
+            blockchain.new_transaction('sender', 'recipient', _report(height % 50))
+            blockchain.new_transaction('sender', 'recipient', {'height': height})
+            blockchain.new_block(proof)
+        results[f'stream_bytes_{name}'] = sum(len(part) for part in stream_chain(blockchain))
+    results['stream_bytes_refs'] = sum(len(part) for part in stream_chain(blockchain, refs=True))
+
+    reports = [_report(seq) for seq in range(100, 200)]
+    hashes = [encode_payload(data)[0] for data in reports]
+    trained = PayloadStore(zdict=train_zdict(_report(seq) for seq in range(100)))
+    plain = PayloadStore()
+    for data in reports:
+        trained.put(data)
+        plain.put(data)
+    results['payload_bytes_raw'] = sum(len(encode_payload(data)[1]) for data in reports)
+    results['payload_bytes_zlib'] = len(pickle.dumps(plain.export(hashes)))
+    results['payload_bytes_zdict'] = len(pickle.dumps(trained.export(hashes, trained.zdict_id)))
+    return results
+
+
+def _abuser(port, source, message, hold, stop, counts):
+    # One misbehaving peer on its own loopback address, reconnecting as fast
+    # as it can: sends `message` and reads the reply, or just sits on the
+    # connection for `hold` seconds
+    while not stop.is_set():
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.settimeout(30)
+            s.bind((source, 0))
+            s.connect(('127.0.0.1', port))
+            if hold:
+                stop.wait(hold)
+                continue
+            s.sendall(message)
+            if message.startswith(b"GET_"):
+                received = 0
+                while True:
+                    part = s.recv(65536)
+                    if not part:
+                        break
+                    received += len(part)
+                counts['served' if received else 'refused'] += 1
+            else:
+                counts['served'] += 1
+        except OSError:
+            counts['refused'] += 1
+        finally:
+            s.close()
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+def bench_admission(args):
+    """
+    Load test for the peer server. A well-behaved client polls GET_INFO
+    while abusive peers flood it with whole-chain requests, oversized pushes
+    and idle connections, against a server with no limits and one with the
+    default AdmissionControl. Reports the client's latency in milliseconds
+    and how many abusive requests were served.
+    """
+    unlimited = dict(workers=1024, queue_size=100000, rate=None, max_connections=None,
+                     max_chain_serves=1024)
+    scenarios = (('idle', {}, False), ('unlimited', unlimited, True), ('limited', {}, True))
+    results = {'chain_length': args.sync_length, 'seconds': args.load_seconds}
+    for offset, (name, limits, abusive) in enumerate(scenarios):
+        port = args.port + 50 + offset
+        node = Node(port, admission=AdmissionControl(**limits))
+        build_chain(args.sync_length, blockchain=node.blockchain)
+        stop = Event()
+        counts = {'served': 0, 'refused': 0}
+        abusers = []
+        if abusive:
+            junk = b"\x80" + bytes(16 * 1024 * 1024)
+            for i in range(args.abusers):
+                abusers.append(Thread(target=_abuser, args=(port, '127.0.0.2', b"GET_CHAIN", 0,
+                                                             stop, counts)))
+                abusers.append(Thread(target=_abuser, args=(port, '127.0.0.3', None, 5,
+                                                             stop, counts)))
+            abusers.append(Thread(target=_abuser, args=(port, '127.0.0.4', junk, 0, stop, counts)))
+        for thread in abusers:
+            thread.start()
+
+        latencies, failures = [], 0
+        started = perf_counter()
+        try:
+            while perf_counter() - started < args.load_seconds:
+                sent = perf_counter()
+                try:
+                    node.blockchain.request_from_peer(('127.0.0.1', port), b"GET_INFO")
+                    latencies.append((perf_counter() - sent) * 1000)
+                except Exception:
+                    failures += 1
+                sleep(0.02)
+        finally:
+            stop.set()
+            for thread in abusers:
+                thread.join()
+            node.stop()
+        results[f'{name}_p50_ms'] = _percentile(latencies, 0.5)
+        results[f'{name}_p99_ms'] = _percentile(latencies, 0.99)
+        results[f'{name}_max_ms'] = max(latencies) if latencies else None
+        results[f'{name}_failures'] = failures
+        if abusive:
+            results[f'{name}_abusive_served'] = counts['served']
+            results[f'{name}_abusive_refused'] = counts['refused']
+    return results
+
+
+def bench_api(args):
+    """
+    A dashboard polling the HTTP API for the latest 100 blocks, through
+    Flask's test client: polls per second when every response is rebuilt,
+    when it comes from the response cache, and when it is a conditional
+    request answered with 304. Needs Flask.
+    """
+    from DreamChain.api import create_app
+
+    blockchain = build_chain(min(args.sizes))
+    app = create_app(blockchain)
+    api = app.config['CHAIN_API']
+    client = app.test_client()
+    path = f'/blocks?from={len(blockchain.chain) - 99}'
+    first = client.get(path)
+    etag = first.headers['ETag']
+    polls = 200
+
+    def uncached():
+        for _ in range(polls):
+            api.cache.clear()
+            client.get(path)
+
+    def cached():
+        for _ in range(polls):
+            client.get(path)
+
+    def conditional():
+        for _ in range(polls):
+            client.get(path, headers={'If-None-Match': etag})
+
+    results = {'chain_length': len(blockchain.chain), 'response_bytes': len(first.data)}
+    for name, run in (('uncached', uncached), ('cached', cached), ('not_modified', conditional)):
+        results[f'{name}_per_sec'] = polls / best_of(run, args.repeat)
+    return results
+
+
+def bench_subscriptions(args):
+    """
+    Cost of fanning events out to in-process subscribers: microseconds to
+    add one pool transaction with 0, 100 and 1000 subscribers that all
+    receive it, and with 1000 subscribers filtering on a recipient that
+    matches none of them.
+    """
+    results = {}
+    transactions = 2000
+    for name, count, recipient in (('0', 0, None), ('100', 100, None), ('1000', 1000, None),
+                                   ('1000_filtered', 1000, 'nobody')):
+        blockchain = DreamChain(0)
+        subscriptions = [blockchain.subscriptions.subscribe(recipient=recipient,
+                                                            queue_size=transactions)
+                         for _ in range(count)]
+
+        def publish():
+            blockchain.transactions = []
+            for subscription in subscriptions:
+                subscription.queue.clear()
+            for i in range(transactions):
+                blockchain.new_transaction('sender', 'recipient', {'seq': i})
+
+        results[f'us_per_event_{name}'] = best_of(publish, args.repeat) / transactions * 1e6
+    return results
+
+
+def bench_mempool(args):
+    """
+    Pool ingestion with --threads concurrent callers of new_transaction,
+    for each write-ahead log setting: transactions per second, worst-case
+    seconds for one call, and fsyncs per transaction. 'memory' has no log;
+    'group_0ms' batches only what piles up during an fsync.
+    """
+    settings = (
+        ('memory', None),
+        ('async', dict(sync='async')),
+        ('group_2ms', dict(sync='group', interval=0.002)),
+        ('group_0ms', dict(sync='group', interval=0)),
+        ('always', dict(sync='always')),
+    )
+    per_thread = max(args.wal_transactions // args.threads, 1)
+    results = {'threads': args.threads, 'transactions': per_thread * args.threads}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, options in settings:
+            log = None
+            if options is not None:
+                log = TransactionLog(os.path.join(directory, f'{name}.wal'), **options)
+            blockchain = DreamChain(0, wal=log)
+            slowest = []
+
+            def ingest(thread):
+                worst = 0
+                for i in range(per_thread):
+                    started = perf_counter()
+                    blockchain.new_transaction(f'sender-{thread}', 'recipient', {'seq': i})
+                    worst = max(worst, perf_counter() - started)
+                slowest.append(worst)
+
+            threads = [Thread(target=ingest, args=(i,)) for i in range(args.threads)]
+            started = perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if log is not None:
+                log.close()
+            elapsed = perf_counter() - started
+            results[f'{name}_per_sec'] = results['transactions'] / elapsed
+            results[f'{name}_max_call_seconds'] = max(slowest)
+            if log is not None:
+                results[f'{name}_fsyncs_per_tx'] = log.fsyncs / results['transactions']
+    return results
+
+
+def _reader(port, stop, counts, request=b"GET_CHAIN"):
+    # Polls `request` and reads the raw reply, without unpickling it
+    while not stop.is_set():
+        try:
+            s = socket.create_connection(('127.0.0.1', port), 30)
+            try:
+                s.sendall(request)
+                while s.recv(65536):
+                    pass
+            finally:
+                s.close()
+            counts['served'] += 1
+        except OSError:
+            counts['failed'] += 1
+
+
+def _busy(stop):
+    # Stands in for the writer's miner
+    digest = b''
+    while not stop.is_set():
+        digest = hashlib.sha256(digest).digest()
+
+
+def bench_readers(args):
+    """
+    GET_CHAIN and sync stream (GET_CHAIN_STREAM refs, as syncing nodes
+    ask for it) throughput, with --threads clients polling a --sync-length
+    chain for --load-seconds each while a thread in the writer hashes as a
+    miner would: served by the writer itself, and by --processes read
+    workers from the published view.
+    """
+    results = {'chain_length': args.sync_length, 'seconds': args.load_seconds}
+    no_limits = dict(rate=None, max_connections=None, max_chain_serves=1024)
+    requests = (('reads', b"GET_CHAIN"), ('streams', b"GET_CHAIN_STREAM refs"))
+    for offset, workers in enumerate((0, args.processes)):
+        port = args.port + 60 + offset
+        if workers:
+            node = Node(port, read_workers=workers, read_limits=no_limits)
+        else:
+            node = Node(port, admission=AdmissionControl(**no_limits))
+        build_chain(args.sync_length, blockchain=node.blockchain)
+        if node.readers is not None:
+            node.readers.publisher.publish()
+        name = f'{workers}_workers'
+        for kind, request in requests:
+            stop = Event()
+            counts = {'served': 0, 'failed': 0}
+            threads = [Thread(target=_busy, args=(stop,))]
+            threads += [Thread(target=_reader, args=(port, stop, counts, request))
+                        for _ in range(args.threads)]
+            for thread in threads:
+                thread.start()
+            sleep(args.load_seconds)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            results[f'{name}_{kind}_per_sec'] = counts['served'] / args.load_seconds
+            results[f'{name}_{kind}_failures'] = counts['failed']
+        node.stop()
+    return results
+
+
+def bench_consensus(args):
+    """
+    Proof of work against proof of authority with one authority and
+    --interval-ms slots: seconds from starting a block to having it (with
+    one pool transaction each time), process CPU seconds spent per block,
+    and blocks validated per second.
+    """
+    from DreamChain.consensus import ProofOfAuthority
+    from DreamChain.signatures import generate_key, public_key
+
+    key = generate_key()
+    modes = (('pow', None),
+             ('poa', ProofOfAuthority([public_key(key)], key=key, interval_ms=args.interval_ms)))
+    results = {'blocks': args.proofs, 'interval_ms': args.interval_ms}
+    for name, consensus in modes:
+        blockchain = DreamChain(0, consensus=consensus)
+        latencies = []
+        cpu_started = process_time()
+        for i in range(args.proofs):
+            blockchain.new_transaction('sender', 'recipient', {'seq': i})
+            started = perf_counter()
+            blockchain.mine()
+            latencies.append(perf_counter() - started)
+        results[f'{name}_cpu_seconds_per_block'] = (process_time() - cpu_started) / args.proofs
+        results[f'{name}_seconds_per_block'] = sum(latencies) / len(latencies)
+        results[f'{name}_max_seconds_per_block'] = max(latencies)
+        chain = list(blockchain.chain)
+        seconds = best_of(lambda: blockchain.validator.validate(chain, 0, blockchain.consensus),
+                          args.repeat)
+        results[f'{name}_validated_blocks_per_sec'] = (len(chain) - 1) / seconds
+    return results
+
+
+def bench_namespaces(args):
+    """
+    A peer that only follows one of 4 data streams, syncing it from a node
+    that keeps them in one mixed --sync-length chain or in 4 named chains:
+    seconds to stream and validate what it has to download.
+    """
+    streams = 4
+    node = Node(args.port + 70)
+    try:
+        build_chain(args.sync_length, blockchain=node.blockchain)
+        for i in range(streams):
+            build_chain(args.sync_length // streams, blockchain=node.add_chain(f'stream-{i}'))
+        peer = ('127.0.0.1', node.port)
+        mixed = DreamChain(0)
+        named = DreamChain(0, namespace='stream-0')
+        results = {'streams': streams, 'chain_length': args.sync_length}
+        for name, blockchain in (('mixed', mixed), ('namespaced', named)):
+            seconds = best_of(lambda: blockchain.stream_chain_from_peer(peer), args.repeat)
+            results[f'{name}_sync_seconds'] = seconds
+            results[f'{name}_blocks'] = len(blockchain.stream_chain_from_peer(peer))
+    finally:
+        node.stop()
+    return results
+
+
+def bench_relay(args):
+    """
+    Block propagation to --nodes in-process nodes, announcing full blocks
+    and compact ones, for blocks of 100 and 2000 transactions that every
+    node already received by gossip: bytes sent to each peer and seconds
+    until every node has the block.
+    """
+    # All nodes share localhost, so per-peer limits would lump them together
+    def limits():
+        return AdmissionControl(rate=None, max_connections=None)
+
+    master = Node(args.port + 80, admission=limits())
+    nodes = []
+    try:
+        build_chain(2, blockchain=master.blockchain)
+        for i in range(1, args.nodes):
+            nodes.append(Node(args.port + 80 + i, ('127.0.0.1', master.port), admission=limits()))
+        results = {'nodes': args.nodes}
+        proof = fixed_point_proof()
+        for count in (100, 2000):
+            for mode in ('full', 'compact'):
+                height = len(master.blockchain.chain)
+                for i in range(count):
+                    data = {'seq': i, 'memo': f'{i:0200d}', 'block': f'{mode}_{count}'}
+                    master.blockchain.new_transaction('sender', f'recipient-{i}', data)
+                wait_until(lambda: all(len(node.blockchain.transactions) >= count
+                                       for node in nodes))
+                block = master.blockchain.new_block(proof)
+                if mode == 'full':
+                    size = len(pickle.dumps(block_to_dict(block)))
+                else:
+                    compact = compact_block(block, ('127.0.0.1', master.port),
+                                            master.blockchain.relay.shared)
+                    size = len(COMPACT_BLOCK + pickle.dumps(compact))
+                master.blockchain.compact_blocks = mode == 'compact'
+                started = perf_counter()
+                master.blockchain.broadcast_block(block)
+                wait_until(lambda: all(len(node.blockchain.chain) > height for node in nodes))
+                results[f'{mode}_{count}_seconds'] = perf_counter() - started
+                results[f'{mode}_{count}_bytes_per_peer'] = size
+    finally:
+        for node in [master] + nodes:
+            node.stop()
+    return results
+
+
+def bench_light(args):
+    """
+    Following one address on a --sync-length chain of 20-transaction
+    blocks: bytes downloaded, bytes of state kept and seconds for a full
+    streamed sync and for a light client, then for the light client to
+    catch up on 10 more blocks.
+    """
+    node = Node(args.port + 90, merkle_roots=True)
+    try:
+        build_chain(args.sync_length, transactions_per_block=20, blockchain=node.blockchain)
+        peer = ('127.0.0.1', node.port)
+        full = DreamChain(0)
+        started = perf_counter()
+        chain = full.stream_chain_from_peer(peer)
+        full_seconds = perf_counter() - started
+        full_bytes = sum(len(part) for part in stream_chain(node.blockchain))
+
+        client = LightClient([peer], addresses=['recipient-5'])
+        started = perf_counter()
+        client.sync()
+        light_seconds = perf_counter() - started
+        light_bytes = client.received_bytes
+        build_chain(args.sync_length + 10, transactions_per_block=20, blockchain=node.blockchain)
+        started = perf_counter()
+        client.sync()
+        catch_up_seconds = perf_counter() - started
+    finally:
+        node.stop()
+    return {
+        'chain_length': args.sync_length,
+        'full_sync_seconds': full_seconds,
+        'full_bytes_received': full_bytes,
+        'full_state_bytes': len(pickle.dumps([block_to_dict(block) for block in chain])),
+        'light_sync_seconds': light_seconds,
+        'light_bytes_received': light_bytes,
+        'light_state_bytes': client.state_size(),
+        'light_transactions': len(client.transactions()),
+        'light_catch_up_seconds': catch_up_seconds,
+        'light_catch_up_bytes': client.received_bytes - light_bytes,
+    }
+
+
+class _Throttled:
+    """
+    A file-like stream read at no more than `rate` bytes per second, for
+    a link slower than loopback.
+    """
+    def __init__(self, stream, rate):
+        self.stream = stream
+        self.rate = rate
+
+    def _wait(self, data):
+        sleep(len(data) / self.rate)
+        return data
+
+    def read(self, size=-1):
+        return self._wait(self.stream.read(size))
+
+    def readline(self, size=-1):
+        return self._wait(self.stream.readline(size))
+
+    def readinto(self, buffer):
+        count = self.stream.readinto(buffer)
+        sleep(count / self.rate)
+        return count
+
+
+def bench_pipeline(args):
+    """
+    Streamed sync of a --sync-length chain of 20-transaction blocks over
+    loopback and over a 5 MB/s link: seconds, and the seconds each sync
+    stage spent busy, which add up to more than the total when network
+    and CPU work overlap.
+    """
+    node = Node(args.port + 100)
+    try:
+        build_chain(args.sync_length, transactions_per_block=20, blockchain=node.blockchain)
+        peer = ('127.0.0.1', node.port)
+        results = {'chain_length': args.sync_length}
+        for name, rate in (('loopback', None), ('5mbps', 5 * 1024 * 1024)):
+            metrics.reset()
+            blockchain = DreamChain(0)
+            s = socket.create_connection(peer)
+            try:
+                s.sendall(b"GET_CHAIN_STREAM refs")
+                stream = s.makefile('rb')
+                started = perf_counter()
+                chain = blockchain._read_chain_stream(
+                    stream if rate is None else _Throttled(stream, rate), peer, 0)
+                results[f'{name}_seconds'] = perf_counter() - started
+            finally:
+                s.close()
+            results[f'{name}_valid'] = chain is not None and len(chain) == args.sync_length
+            for (metric, labels), histogram in metrics.histograms.items():
+                if metric == 'dreamchain_pipeline_stage_seconds':
+                    results[f"{name}_{dict(labels)['stage']}_busy_seconds"] = histogram.sum
+    finally:
+        node.stop()
+    return results
+
+
+BENCHMARKS = {
+    'hashing': bench_hashing,
+    'validation': bench_validation,
+    'serialization': bench_serialization,
+    'memory': bench_memory,
+    'signatures': bench_signatures,
+    'sync': bench_sync,
+    'payloads': bench_payloads,
+    'admission': bench_admission,
+    'api': bench_api,
+    'subscriptions': bench_subscriptions,
+    'mempool': bench_mempool,
+    'readers': bench_readers,
+    'consensus': bench_consensus,
+    'namespaces': bench_namespaces,
+    'relay': bench_relay,
+    'light': bench_light,
+    'pipeline': bench_pipeline,
+}
+
+
+def compare(results, baseline):
+    """
+    Prints the relative change of every shared numeric result to stderr.
+    """
+    for name, values in results.items():
+        for key, value in values.items():
+            before = baseline.get(name, {}).get(key)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if not isinstance(before, (int, float)) or not before:
+                continue
+            change = (value - before) / before * 100
+            print(f'{name}.{key}: {before:.6g} -> {value:.6g} ({change:+.1f}%)', file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--only', action='append', choices=sorted(BENCHMARKS),
+                        help='run only this benchmark (repeatable)')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma-separated chain sizes for validation/serialization/memory')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per timing, best is kept')
+    parser.add_argument('--proofs', type=int, default=5,
+                        help='real proofs of work (and sealed blocks) to time')
+    parser.add_argument('--interval-ms', type=int, default=100,
+                        help='proof-of-authority slot length for consensus')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='worker processes for parallel validation')
+    parser.add_argument('--signatures', type=int, default=5000, help='signed transactions to verify')
+    parser.add_argument('--nodes', type=int, default=4, help='in-process nodes for sync')
+    parser.add_argument('--sync-length', type=int, default=5000, help='chain length for sync')
+    parser.add_argument('--port', type=int, default=7100, help='first localhost port for sync')
+    parser.add_argument('--abusers', type=int, default=8,
+                        help='flooding and idle connections per kind for admission')
+    parser.add_argument('--load-seconds', type=float, default=10,
+                        help='duration of each admission scenario')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent clients for mempool and readers')
+    parser.add_argument('--wal-transactions', type=int, default=4000,
+                        help='transactions to ingest per mempool setting')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', help='JSON report to compare against')
+    parser.add_argument('--profile', metavar='PREFIX',
+                        help='profile the run, writing PREFIX.collapsed and PREFIX.json')
+    args = parser.parse_args(argv)
+    args.sizes = [int(size) for size in args.sizes.split(',')]
+
+    fixed_point_proof()
+    if args.profile:
+        profiler.start(allocations=True)
+    results = {}
+    for name in args.only or BENCHMARKS:
+        with profiler.label(f'bench {name}'):
+            try:
+                results[name] = BENCHMARKS[name](args)
+            except ImportError as e:
+                # Benchmarks of optional features need their extras installed
+                results[name] = {'skipped': str(e)}
+    if args.profile:
+        profiler.stop()
+        profiler.write(args.profile)
+
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {key: value for key, value in vars(args).items()
+                       if key not in ('output', 'baseline', 'profile')},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import os
+import sys
+from functools import lru_cache
+from time import perf_counter, sleep
+
+# Benchmarks run from a source checkout, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DreamChain.dreamchain import DreamChain
+
+
+@lru_cache(maxsize=None)
+def fixed_point_proof():
+    """
+    Returns a proof p for which valid_proof(p, p) holds. A chain whose
+    genesis and blocks all use p is valid without mining every block, which
+    is what makes 100k-block fixtures affordable.
+    """
+    proof = 0
+    while not DreamChain.valid_proof(proof, proof):
+        proof += 1
+    return proof
+
+
+def build_chain(length, transactions_per_block=4, blockchain=None):
+    """
+    Fills `blockchain` (a fresh DreamChain by default) up to `length` valid
+    blocks with small transactions.
+    """
+    if blockchain is None:
+        blockchain = DreamChain(0)
+    proof = fixed_point_proof()
+    if len(blockchain.chain) == 1:
+        blockchain.chain[0]['proof'] = proof
+
+    while len(blockchain.chain) < length:
+        height = len(blockchain.chain)
+        for i in range(transactions_per_block):
+            blockchain.new_transaction(f'sender-{i}', f'recipient-{height % 97}',
+                                       {'height': height, 'seq': i})
+        blockchain.new_block(proof)
+    return blockchain
+
+
+def best_of(fn, repeat):
+    """
+    Runs fn() `repeat` times and returns the fastest wall-clock time.
+    """
+    best = None
+    for _ in range(repeat):
+        started = perf_counter()
+        fn()
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def wait_until(predicate, timeout=60, interval=0.005):
+    """
+    Polls predicate() until it is true; returns the seconds waited or None.
+    """
+    started = perf_counter()
+    while perf_counter() - started < timeout:
+        if predicate():
+            return perf_counter() - started
+        sleep(interval)
+    return None
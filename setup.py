@@ -15,6 +15,9 @@ setup(
         'flask'
         
     ],
+    extras_require={
+        'signatures': ['cryptography'],
+    },
     author='Jackson Makl',
     author_email='jlm487@georgetown.edu',
     description='A Python client to interact with the DataPlatform API.',